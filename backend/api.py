@@ -1,18 +1,27 @@
-﻿from fastapi import APIRouter, HTTPException, status
+﻿import asyncio
+import io
+
+from fastapi import APIRouter, HTTPException, Query, Request, status
 from typing import Optional
 
 from pydantic import BaseModel, EmailStr
 
 from . import credentials as credential_service
 from .auth import (
-    confirm_two_factor,
-    create_user,
-    disable_two_factor,
-    initiate_two_factor_setup,
-    verify_user,
+    BUSY_MESSAGE,
+    complete_two_factor_login_async,
+    confirm_two_factor_async,
+    create_user_async,
+    disable_two_factor_async,
+    initiate_two_factor_setup_async,
+    verify_user_async,
 )
+from .hashing import hashing_pool
+from .provisioning import FORMATS, max_body_bytes, provision_users, read_users
 
 router = APIRouter(prefix="/api", tags=["api"])
+# One bulk job at a time: each hashes thousands of passwords on the shared pool.
+_provisioning = asyncio.Lock()
 
 
 class RegisterRequest(BaseModel):
@@ -27,6 +36,11 @@ class LoginRequest(BaseModel):
     otp_code: Optional[str] = None
 
 
+class TwoFactorLoginRequest(BaseModel):
+    ticket: str
+    otp_code: str
+
+
 class CredentialCreateRequest(BaseModel):
     user_id: int
     title: str
@@ -50,57 +64,131 @@ def ping():
 
 
 @router.post("/register", status_code=status.HTTP_201_CREATED)
-def api_register(payload: RegisterRequest):
-    ok, res = create_user(payload.username, payload.password, payload.email)
+async def api_register(payload: RegisterRequest):
+    ok, res = await create_user_async(payload.username, payload.password, payload.email)
     if not ok:
+        if res == BUSY_MESSAGE:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=res)
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=res)
     return {"message": "user created", **res}
 
 
+async def _read_body(request: Request, limit: int) -> str:
+    too_large = HTTPException(
+        status_code=status.HTTP_413_CONTENT_TOO_LARGE, detail=f"Request body is larger than {limit} bytes"
+    )
+    if int(request.headers.get("content-length") or 0) > limit:
+        raise too_large
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > limit:
+            raise too_large
+        chunks.append(chunk)
+    try:
+        return b"".join(chunks).decode("utf-8-sig")
+    except UnicodeDecodeError as exc:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Body is not UTF-8: {exc.reason}") from exc
+
+
+@router.post("/users/bulk")
+async def api_bulk_provision(request: Request, fmt: str = Query("jsonl", alias="format"), batch_size: int = 500):
+    """Create users from a CSV or JSONL request body; per-record errors come back in the report."""
+    if fmt not in FORMATS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"format must be one of {FORMATS}")
+    if _provisioning.locked():
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="A provisioning job is already running"
+        )
+    async with _provisioning:
+        body = await _read_body(request, max_body_bytes())
+        # Runs on a thread and hashes on the shared pool; keep the event loop free while it runs.
+        report = await asyncio.to_thread(
+            provision_users, read_users(io.StringIO(body), fmt), batch_size, pool=hashing_pool
+        )
+    return {"message": "provisioning finished", **report}
+
+
 @router.post("/login")
-def api_login(payload: LoginRequest):
-    ok, res = verify_user(payload.username, payload.password, payload.otp_code)
+async def api_login(payload: LoginRequest, request: Request):
+    client_ip = request.client.host if request.client else None
+    ok, res = await verify_user_async(payload.username, payload.password, payload.otp_code, client_ip=client_ip)
     if ok:
         return {"message": "login successful", **res}
 
+    if isinstance(res, dict) and res.get("code") == "throttled":
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=res["message"],
+            headers={"Retry-After": str(res["retry_after"])},
+        )
+
     if isinstance(res, dict) and res.get("code") == "2fa_required":
         return {"message": "two_factor_required", **res}
 
+    if res == BUSY_MESSAGE:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=res)
     raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=res)
 
 
+@router.post("/login/2fa")
+async def api_login_two_factor(payload: TwoFactorLoginRequest, request: Request):
+    client_ip = request.client.host if request.client else None
+    ok, res = await complete_two_factor_login_async(payload.ticket, payload.otp_code, client_ip=client_ip)
+    if not ok:
+        if isinstance(res, dict) and res.get("code") == "throttled":
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail=res["message"],
+                headers={"Retry-After": str(res["retry_after"])},
+            )
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=res)
+    return {"message": "login successful", **res}
+
+
 @router.post("/2fa/setup")
-def api_2fa_setup(user_id: int):
-    ok, res = initiate_two_factor_setup(user_id)
+async def api_2fa_setup(user_id: int):
+    ok, res = await initiate_two_factor_setup_async(user_id)
     if not ok:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=res)
     return res
 
 
 @router.post("/2fa/confirm")
-def api_2fa_confirm(user_id: int, code: str):
-    ok, message = confirm_two_factor(user_id, code)
+async def api_2fa_confirm(user_id: int, code: str):
+    ok, message = await confirm_two_factor_async(user_id, code)
     if not ok:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=message)
     return {"message": message}
 
 
 @router.post("/2fa/disable")
-def api_2fa_disable(user_id: int):
-    ok, message = disable_two_factor(user_id)
+async def api_2fa_disable(user_id: int):
+    ok, message = await disable_two_factor_async(user_id)
     if not ok:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=message)
     return {"message": message}
 
 
 @router.get("/credentials/{user_id}")
-def api_list_credentials(user_id: int, include_sensitive: bool = False):
-    return credential_service.list_credentials(user_id, include_sensitive=include_sensitive)
+async def api_list_credentials(user_id: int, include_sensitive: bool = False, lazy: bool = False):
+    return await credential_service.list_credentials_async(user_id, include_sensitive=include_sensitive, lazy=lazy)
+
+
+@router.get("/credentials/{user_id}/reveal")
+async def api_reveal_secret(user_id: int, handle: str, field: str = "password"):
+    if field not in credential_service.SECRET_FIELDS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Unknown field")
+    value = await credential_service.reveal_secret_async(user_id, handle, field)
+    if value is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Credential not found")
+    return {field: value}
 
 
 @router.post("/credentials")
-def api_create_credential(payload: CredentialCreateRequest):
-    ok, res = credential_service.create_credential(
+async def api_create_credential(payload: CredentialCreateRequest):
+    ok, res = await credential_service.create_credential_async(
         payload.user_id,
         payload.title,
         payload.password,
@@ -113,8 +201,8 @@ def api_create_credential(payload: CredentialCreateRequest):
 
 
 @router.put("/credentials")
-def api_update_credential(payload: CredentialUpdateRequest):
-    ok, res = credential_service.update_credential(
+async def api_update_credential(payload: CredentialUpdateRequest):
+    ok, res = await credential_service.update_credential_async(
         payload.user_id,
         payload.credential_id,
         title=payload.title,
@@ -128,8 +216,8 @@ def api_update_credential(payload: CredentialUpdateRequest):
 
 
 @router.delete("/credentials/{user_id}/{credential_id}")
-def api_delete_credential(user_id: int, credential_id: int):
-    ok, message = credential_service.delete_credential(user_id, credential_id)
+async def api_delete_credential(user_id: int, credential_id: int):
+    ok, message = await credential_service.delete_credential_async(user_id, credential_id)
     if not ok:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=message)
     return {"message": message}
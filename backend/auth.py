@@ -1,167 +1,597 @@
-﻿from datetime import datetime
-from typing import Optional, Tuple, Union
+﻿import os
+import secrets
+import threading
+from typing import List, Optional, Sequence, Tuple, Union
+
+from sqlalchemy import Row, Select, delete, or_, select
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from .cache import TTLCache
+from .data_keys import forget_user_cipher
+from .db import AsyncReadSessionLocal, ReadSessionLocal
+from .hashing import HashingBusyError, hashing_pool, pwd_context
+from .login_activity import login_activity
+from .models import User, UserDataKey, UserSession
+from .security import build_totp_uri, generate_totp_secret, verify_totp
+from .sessions import forget_user_sessions, lock_master_key, mark_unlocked
+from .shards import delete_user_rows
+from .throttle import login_throttle
+from .user_index import user_index
+from .writer import writer
 
-from passlib.context import CryptContext
-from sqlalchemy.exc import SQLAlchemyError
+BUSY_MESSAGE = "Сервер перегружен, попробуйте войти чуть позже"
+TICKET_EXPIRED_MESSAGE = "Сессия входа истекла, войдите заново"
+USER_NOT_FOUND_MESSAGE = "Пользователь не найден"
+USERNAME_TAKEN_MESSAGE = "Пользователь с таким именем уже существует"
+EMAIL_TAKEN_MESSAGE = "Этот e-mail уже привязан к другому пользователю"
 
-from .db import SessionLocal
-from .models import User
-from .security import build_totp_uri, generate_totp_secret, verify_totp
+PREAUTH_TICKET_TTL_ENV = "APP_PREAUTH_TICKET_TTL"
+PREAUTH_MAX_ATTEMPTS = 5
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Tickets issued after a correct password while the second factor is pending.
+# ticket -> {"user_id", "username", "otp_secret", "attempts"}; single-use, dropped after too many wrong codes.
+_preauth_tickets = TTLCache(maxsize=10000, ttl=float(os.getenv(PREAUTH_TICKET_TTL_ENV) or 300))
+_preauth_lock = threading.Lock()
 
 
 def _normalize(value: Optional[str]) -> str:
     return (value or "").strip()
 
 
+def _credentials_error(username: str, password: str) -> Optional[str]:
+    if len(username) < 5:
+        return "Имя пользователя должно быть не короче 5 символов"
+    if len(password) < 8:
+        return "Пароль должен содержать минимум 8 символов"
+    return None
+
+
+def _integrity_error_message(exc: IntegrityError) -> Optional[str]:
+    """Map a users UNIQUE violation to the matching user-facing message."""
+    detail = str(exc.orig)
+    if "users.username" in detail:
+        return USERNAME_TAKEN_MESSAGE
+    if "users.email" in detail:
+        return EMAIL_TAKEN_MESSAGE
+    return None
+
+
+def _taken_checks(username: str, email: str) -> List[Tuple[str, str]]:
+    """(column, value) pairs the user index cannot rule out, so they need a query."""
+    # Early check only to avoid hashing for a taken name; the insert enforces uniqueness.
+    checks = []
+    if not user_index.definitely_missing("username", username):
+        checks.append(("username", username))
+    if email and not user_index.definitely_missing("email", email):
+        checks.append(("email", email))
+    return checks
+
+
+def _username_query(username: str) -> Select:
+    return select(User).where(User.username == username)
+
+
+def _taken_query(checks: List[Tuple[str, str]]) -> Select:
+    return select(User.username, User.email).where(or_(*(getattr(User, kind) == value for kind, value in checks)))
+
+
+def _taken_error(rows: Sequence[Row], checks: List[Tuple[str, str]], generation: int) -> Optional[str]:
+    for kind, value in checks:
+        if any(getattr(row, kind) == value for row in rows):
+            return USERNAME_TAKEN_MESSAGE if kind == "username" else EMAIL_TAKEN_MESSAGE
+    for kind, value in checks:
+        user_index.confirmed_missing(kind, value, generation)
+    return None
+
+
+def _new_user_error(db: Session, username: str, password: str, email: str) -> Optional[str]:
+    error = _credentials_error(username, password)
+    if error:
+        return error
+    checks = _taken_checks(username, email)
+    if not checks:
+        return None
+    generation = user_index.generation
+    return _taken_error(db.execute(_taken_query(checks)).all(), checks, generation)
+
+
+async def _new_user_error_async(db: AsyncSession, username: str, password: str, email: str) -> Optional[str]:
+    error = _credentials_error(username, password)
+    if error:
+        return error
+    checks = _taken_checks(username, email)
+    if not checks:
+        return None
+    generation = user_index.generation
+    return _taken_error((await db.execute(_taken_query(checks))).all(), checks, generation)
+
+
+def _add_user(db: Session, username: str, email: str, password_hash: str) -> int:
+    user = User(
+        username=username,
+        password_hash=password_hash,
+        email=email or None,
+    )
+    db.add(user)
+    db.flush()
+    return user.id
+
+
+def _insert_conflict(exc: IntegrityError, username: str, email: str) -> Tuple[bool, str]:
+    """A concurrent signup won the race for the username or email; anything else is re-raised."""
+    message = _integrity_error_message(exc)
+    if message == USERNAME_TAKEN_MESSAGE:
+        user_index.added(username=username)
+    elif message == EMAIL_TAKEN_MESSAGE:
+        user_index.added(email=email)
+    else:
+        raise exc
+    return False, message
+
+
+def _insert_user(username: str, email: str, password_hash: str) -> Tuple[bool, Union[str, dict]]:
+    try:
+        user_id = writer.run(_add_user, username, email, password_hash)
+    except IntegrityError as exc:
+        return _insert_conflict(exc, username, email)
+    user_index.added(username, email)
+    return True, {"user_id": user_id}
+
+
+async def _insert_user_async(username: str, email: str, password_hash: str) -> Tuple[bool, Union[str, dict]]:
+    try:
+        user_id = await writer.run_async(_add_user, username, email, password_hash)
+    except IntegrityError as exc:
+        return _insert_conflict(exc, username, email)
+    user_index.added(username, email)
+    return True, {"user_id": user_id}
+
+
 def create_user(username: str, password: str, email: Optional[str] = None) -> Tuple[bool, Union[str, dict]]:
-    db = SessionLocal()
-    try:
-        username = _normalize(username)
-        email = _normalize(email)
-        password = password or ""
-
-        if len(username) < 5:
-            return False, "Имя пользователя должно быть не короче 5 символов"
-        if len(password) < 8:
-            return False, "Пароль должен содержать минимум 8 символов"
-
-        existing = db.query(User).filter(User.username == username).first()
-        if existing:
-            return False, "Пользователь с таким именем уже существует"
-
-        if email:
-            existing_email = db.query(User).filter(User.email == email).first()
-            if existing_email:
-                return False, "Этот e-mail уже привязан к другому пользователю"
-
-        user = User(
-            username=username,
-            password_hash=pwd_context.hash(password),
-            email=email or None,
-        )
-        db.add(user)
-        db.commit()
-        db.refresh(user)
-        return True, {"user_id": user.id}
+    username = _normalize(username)
+    email = _normalize(email)
+    password = password or ""
+
+    db = ReadSessionLocal()
+    try:
+        error = _new_user_error(db, username, password, email)
+        if error:
+            return False, error
+        return _insert_user(username, email, pwd_context.hash(password))
     except SQLAlchemyError as exc:
-        db.rollback()
         return False, f"Ошибка базы данных: {str(exc)}"
     finally:
         db.close()
 
 
-def verify_user(username: str, password: str, otp_code: Optional[str] = None) -> Tuple[bool, Union[str, dict]]:
-    db = SessionLocal()
+async def create_user_async(
+    username: str, password: str, email: Optional[str] = None
+) -> Tuple[bool, Union[str, dict]]:
+    """create_user for event-loop callers: queries go through aiosqlite and the writer, the hash to the pool."""
+    username = _normalize(username)
+    email = _normalize(email)
+    password = password or ""
+
     try:
-        user = db.query(User).filter(User.username == _normalize(username)).first()
-        if not user:
-            return False, "Пользователь не найден"
+        async with AsyncReadSessionLocal() as db:
+            error = await _new_user_error_async(db, username, password, email)
+        if error:
+            return False, error
+
+        try:
+            password_hash = await hashing_pool.hash(password)
+        except HashingBusyError:
+            return False, BUSY_MESSAGE
+        return await _insert_user_async(username, email, password_hash)
+    except SQLAlchemyError as exc:
+        return False, f"Ошибка базы данных: {str(exc)}"
 
-        if not pwd_context.verify(password or "", user.password_hash):
-            return False, "Неверный пароль"
 
-        if user.is_2fa_enabled:
-            if not otp_code:
-                return False, {"code": "2fa_required", "user_id": user.id}
-            if not verify_totp(user.otp_secret, otp_code):
-                return False, "Неверный одноразовый код"
+def _write_rehash(db: Session, user_id: int, old_hash: str, new_hash: str) -> None:
+    # Skipped when the password was changed in the meantime.
+    db.query(User).filter(User.id == user_id, User.password_hash == old_hash).update(
+        {"password_hash": new_hash}, synchronize_session=False
+    )
+
+
+def _finish_login(
+    user: User, otp_code: Optional[str], new_hash: Optional[str] = None
+) -> Tuple[bool, Union[str, dict]]:
+    """Second factor and bookkeeping once the password has been checked."""
+    if new_hash:
+        # Stored with an older bcrypt cost: upgraded in the background, the login does not wait for it.
+        writer.submit(_write_rehash, user.id, user.password_hash, new_hash)
+    if user.is_2fa_enabled:
+        if not otp_code:
+            return False, {"code": "2fa_required", "user_id": user.id, "ticket": _issue_ticket(user)}
+        if not verify_totp(user.otp_secret, otp_code, user_id=user.id):
+            return False, "Неверный одноразовый код"
 
-        user.last_login_at = datetime.utcnow()
-        db.commit()
-        return True, {"user_id": user.id}
+    # Only a complete login clears the window: a known password alone must not reset the limit on codes.
+    login_throttle.succeeded(user.username)
+    login_activity.record(user.id)
+    return True, {"user_id": user.id}
+
+
+def _issue_ticket(user: User) -> str:
+    ticket = secrets.token_urlsafe(32)
+    _preauth_tickets.set(
+        ticket, {"user_id": user.id, "username": user.username, "otp_secret": user.otp_secret, "attempts": 0}
+    )
+    return ticket
+
+
+def _redeem_ticket(ticket: str, otp_code: str, client_ip: Optional[str]) -> Tuple[Optional[dict], Union[str, dict]]:
+    """(ticket entry, None) once the code matches the ticket's secret, else (None, error)."""
+    with _preauth_lock:
+        entry = _preauth_tickets.get(ticket or "")
+        if entry is None:
+            return None, TICKET_EXPIRED_MESSAGE
+        throttled = _throttled(entry["username"], client_ip)
+        if throttled:
+            return None, throttled
+        if not verify_totp(entry["otp_secret"], otp_code, user_id=entry["user_id"]):
+            entry["attempts"] += 1
+            if entry["attempts"] >= PREAUTH_MAX_ATTEMPTS:
+                _preauth_tickets.pop(ticket)
+            return None, "Неверный одноразовый код"
+        _preauth_tickets.pop(ticket)
+    return entry, None
+
+
+def _ticket_secret_query(entry: dict) -> Select:
+    # A ticket carries the secret from when it was issued: 2FA disabled or re-enrolled since then voids it.
+    return select(User.id).where(
+        User.id == entry["user_id"], User.is_2fa_enabled.is_(True), User.otp_secret == entry["otp_secret"]
+    )
+
+
+def _ticket_login(entry: dict, still_enabled: bool) -> Tuple[bool, Union[str, dict]]:
+    if not still_enabled:
+        return False, TICKET_EXPIRED_MESSAGE
+    login_throttle.succeeded(entry["username"])
+    login_activity.record(entry["user_id"])
+    return True, {"user_id": entry["user_id"]}
+
+
+def complete_two_factor_login(
+    ticket: str, otp_code: str, client_ip: Optional[str] = None
+) -> Tuple[bool, Union[str, dict]]:
+    """Finish a login with the pre-auth ticket from verify_user: a TOTP check and one key lookup, no password hash.
+
+    Each code counts against the same per-user login window as a password attempt,
+    so fetching fresh tickets does not buy extra guesses.
+    """
+    entry, error = _redeem_ticket(ticket, otp_code, client_ip)
+    if entry is None:
+        return False, error
+    db = ReadSessionLocal()
+    try:
+        return _ticket_login(entry, db.execute(_ticket_secret_query(entry)).first() is not None)
     except SQLAlchemyError as exc:
-        db.rollback()
         return False, f"Ошибка базы данных: {str(exc)}"
     finally:
         db.close()
 
 
-def set_master_key(user_id: int, master_key: str) -> Tuple[bool, str]:
-    if len(master_key or "") < 8:
-        return False, "Мастер-ключ должен быть не короче 8 символов"
+async def complete_two_factor_login_async(
+    ticket: str, otp_code: str, client_ip: Optional[str] = None
+) -> Tuple[bool, Union[str, dict]]:
+    """complete_two_factor_login for event-loop callers: the read goes through aiosqlite."""
+    entry, error = _redeem_ticket(ticket, otp_code, client_ip)
+    if entry is None:
+        return False, error
+    try:
+        async with AsyncReadSessionLocal() as db:
+            row = (await db.execute(_ticket_secret_query(entry))).first()
+    except SQLAlchemyError as exc:
+        return False, f"Ошибка базы данных: {str(exc)}"
+    return _ticket_login(entry, row is not None)
+
 
-    db = SessionLocal()
+def _throttled(username: str, client_ip: Optional[str]) -> Optional[dict]:
+    retry_after = login_throttle.acquire(_normalize(username), client_ip)
+    if not retry_after:
+        return None
+    return {
+        "code": "throttled",
+        "retry_after": retry_after,
+        "message": f"Слишком много попыток входа, повторите через {retry_after} с",
+    }
+
+
+def verify_user(
+    username: str, password: str, otp_code: Optional[str] = None, client_ip: Optional[str] = None
+) -> Tuple[bool, Union[str, dict]]:
+    throttled = _throttled(username, client_ip)
+    if throttled:
+        return False, throttled
+
+    username = _normalize(username)
+    if user_index.definitely_missing("username", username):
+        return False, USER_NOT_FOUND_MESSAGE
+
+    db = ReadSessionLocal()
     try:
-        user = db.query(User).filter(User.id == user_id).first()
+        generation = user_index.generation
+        user = db.execute(_username_query(username)).scalar()
         if not user:
-            return False, "Пользователь не найден"
+            user_index.confirmed_missing("username", username, generation)
+            return False, USER_NOT_FOUND_MESSAGE
 
-        user.master_key = pwd_context.hash(master_key)
-        db.commit()
-        return True, "Мастер-ключ сохранён"
+        valid, new_hash = pwd_context.verify_and_update(password or "", user.password_hash)
+        if not valid:
+            return False, "Неверный пароль"
+        return _finish_login(user, otp_code, new_hash)
     except SQLAlchemyError as exc:
-        db.rollback()
         return False, f"Ошибка базы данных: {str(exc)}"
     finally:
         db.close()
 
 
-def verify_master_key(user_id: int, master_key: str) -> bool:
-    db = SessionLocal()
+async def verify_user_async(
+    username: str, password: str, otp_code: Optional[str] = None, client_ip: Optional[str] = None
+) -> Tuple[bool, Union[str, dict]]:
+    """verify_user for event-loop callers: the lookup goes through aiosqlite, the bcrypt check to the hashing pool."""
+    throttled = _throttled(username, client_ip)
+    if throttled:
+        return False, throttled
+
+    username = _normalize(username)
+    if user_index.definitely_missing("username", username):
+        return False, USER_NOT_FOUND_MESSAGE
+
+    try:
+        generation = user_index.generation
+        async with AsyncReadSessionLocal() as db:
+            user = (await db.execute(_username_query(username))).scalar()
+        if not user:
+            user_index.confirmed_missing("username", username, generation)
+            return False, USER_NOT_FOUND_MESSAGE
+    except SQLAlchemyError as exc:
+        return False, f"Ошибка базы данных: {str(exc)}"
+
+    try:
+        valid, new_hash = await hashing_pool.verify_and_update(password or "", user.password_hash)
+        if not valid:
+            return False, "Неверный пароль"
+    except HashingBusyError:
+        return False, BUSY_MESSAGE
+    return _finish_login(user, otp_code, new_hash)
+
+
+def _master_key_error(master_key: str) -> Optional[str]:
+    if len(master_key or "") < 8:
+        return "Мастер-ключ должен быть не короче 8 символов"
+    return None
+
+
+def _write_master_key(db: Session, user_id: int, master_key_hash: str) -> bool:
+    return bool(db.query(User).filter(User.id == user_id).update({"master_key": master_key_hash}))
+
+
+def _master_key_stored(user_id: int, found: bool) -> Tuple[bool, str]:
+    if not found:
+        return False, USER_NOT_FOUND_MESSAGE
+    lock_master_key(user_id)
+    forget_user_sessions(user_id)
+    return True, "Мастер-ключ сохранён"
+
+
+def _store_master_key(user_id: int, master_key_hash: str) -> Tuple[bool, str]:
+    try:
+        return _master_key_stored(user_id, writer.run(_write_master_key, user_id, master_key_hash))
+    except SQLAlchemyError as exc:
+        return False, f"Ошибка базы данных: {str(exc)}"
+
+
+async def _store_master_key_async(user_id: int, master_key_hash: str) -> Tuple[bool, str]:
+    try:
+        return _master_key_stored(user_id, await writer.run_async(_write_master_key, user_id, master_key_hash))
+    except SQLAlchemyError as exc:
+        return False, f"Ошибка базы данных: {str(exc)}"
+
+
+def set_master_key(user_id: int, master_key: str) -> Tuple[bool, str]:
+    error = _master_key_error(master_key)
+    if error:
+        return False, error
+    return _store_master_key(user_id, pwd_context.hash(master_key))
+
+
+async def set_master_key_async(user_id: int, master_key: str) -> Tuple[bool, str]:
+    error = _master_key_error(master_key)
+    if error:
+        return False, error
     try:
-        user = db.query(User).filter(User.id == user_id).first()
-        if not user or not user.master_key:
-            return False
-        return pwd_context.verify(master_key, user.master_key)
+        master_key_hash = await hashing_pool.hash(master_key)
+    except HashingBusyError:
+        return False, BUSY_MESSAGE
+    return await _store_master_key_async(user_id, master_key_hash)
+
+
+def _user_query(user_id: int) -> Select:
+    return select(User).where(User.id == user_id)
+
+
+def _load_master_key_hash(user_id: int) -> Optional[str]:
+    db = ReadSessionLocal()
+    try:
+        user = db.execute(_user_query(user_id)).scalar()
+        return user.master_key if user else None
     finally:
         db.close()
 
 
+async def _load_master_key_hash_async(user_id: int) -> Optional[str]:
+    async with AsyncReadSessionLocal() as db:
+        user = (await db.execute(_user_query(user_id))).scalar()
+    return user.master_key if user else None
+
+
+def verify_master_key(user_id: int, master_key: str) -> bool:
+    master_key_hash = _load_master_key_hash(user_id)
+    if not master_key_hash:
+        return False
+    return pwd_context.verify(master_key, master_key_hash)
+
+
+async def verify_master_key_async(user_id: int, master_key: str) -> bool:
+    """verify_master_key for event-loop callers. Raises HashingBusyError when the pool is saturated."""
+    master_key_hash = await _load_master_key_hash_async(user_id)
+    if not master_key_hash:
+        return False
+    return await hashing_pool.verify(master_key, master_key_hash)
+
+
+def unlock_master_key(session_id: str, user_id: int, master_key: str) -> bool:
+    """Verify the master key once and keep the session unlocked (see sessions.is_unlocked)."""
+    if not verify_master_key(user_id, master_key):
+        return False
+    mark_unlocked(session_id, user_id)
+    return True
+
+
+async def unlock_master_key_async(session_id: str, user_id: int, master_key: str) -> bool:
+    """unlock_master_key for event-loop callers. Raises HashingBusyError when the pool is saturated."""
+    if not await verify_master_key_async(user_id, master_key):
+        return False
+    mark_unlocked(session_id, user_id)
+    return True
+
+
+def _write_otp_secret(db: Session, user_id: int, secret: str) -> Optional[str]:
+    """Store a new, not yet confirmed TOTP secret; returns the username for the otpauth URI."""
+    user = db.execute(_user_query(user_id)).scalar()
+    if not user:
+        return None
+    user.otp_secret = secret
+    user.is_2fa_enabled = False
+    return user.username
+
+
+def _two_factor_setup(secret: str, username: Optional[str]) -> Tuple[bool, Union[str, dict]]:
+    if username is None:
+        return False, USER_NOT_FOUND_MESSAGE
+    return True, {"secret": secret, "otpauth_uri": build_totp_uri(secret, username)}
+
+
 def initiate_two_factor_setup(user_id: int) -> Tuple[bool, Union[str, dict]]:
-    db = SessionLocal()
+    secret = generate_totp_secret()
     try:
-        user = db.query(User).filter(User.id == user_id).first()
-        if not user:
-            return False, "Пользователь не найден"
-
-        secret = generate_totp_secret()
-        user.otp_secret = secret
-        user.is_2fa_enabled = False
-        db.commit()
-        uri = build_totp_uri(secret, user.username)
-        return True, {"secret": secret, "otpauth_uri": uri}
+        return _two_factor_setup(secret, writer.run(_write_otp_secret, user_id, secret))
     except SQLAlchemyError as exc:
-        db.rollback()
         return False, f"Ошибка базы данных: {str(exc)}"
-    finally:
-        db.close()
 
 
-def confirm_two_factor(user_id: int, otp_code: str) -> Tuple[bool, str]:
-    db = SessionLocal()
+async def initiate_two_factor_setup_async(user_id: int) -> Tuple[bool, Union[str, dict]]:
+    secret = generate_totp_secret()
     try:
-        user = db.query(User).filter(User.id == user_id).first()
-        if not user or not user.otp_secret:
-            return False, "2FA ещё не инициализирована"
+        return _two_factor_setup(secret, await writer.run_async(_write_otp_secret, user_id, secret))
+    except SQLAlchemyError as exc:
+        return False, f"Ошибка базы данных: {str(exc)}"
 
-        if not verify_totp(user.otp_secret, otp_code):
-            return False, "Неверный одноразовый код"
 
-        user.is_2fa_enabled = True
-        db.commit()
-        return True, "Двухфакторная аутентификация включена"
+def _otp_code_error(user: Optional[User], otp_code: str) -> Optional[str]:
+    if not user or not user.otp_secret:
+        return "2FA ещё не инициализирована"
+    if not verify_totp(user.otp_secret, otp_code, user_id=user.id):
+        return "Неверный одноразовый код"
+    return None
+
+
+def _enable_two_factor(db: Session, user_id: int, otp_secret: str) -> bool:
+    # Only for the secret the code was checked against, in case setup was restarted meanwhile.
+    return bool(
+        db.query(User)
+        .filter(User.id == user_id, User.otp_secret == otp_secret)
+        .update({"is_2fa_enabled": True})
+    )
+
+
+def _two_factor_enabled(user_id: int, updated: bool) -> Tuple[bool, str]:
+    if not updated:
+        return False, "2FA ещё не инициализирована"
+    forget_user_sessions(user_id)
+    return True, "Двухфакторная аутентификация включена"
+
+
+def confirm_two_factor(user_id: int, otp_code: str) -> Tuple[bool, str]:
+    db = ReadSessionLocal()
+    try:
+        user = db.execute(_user_query(user_id)).scalar()
+        error = _otp_code_error(user, otp_code)
+        if error:
+            return False, error
+        return _two_factor_enabled(user_id, writer.run(_enable_two_factor, user_id, user.otp_secret))
     except SQLAlchemyError as exc:
-        db.rollback()
         return False, f"Ошибка базы данных: {str(exc)}"
     finally:
         db.close()
 
 
+async def confirm_two_factor_async(user_id: int, otp_code: str) -> Tuple[bool, str]:
+    try:
+        async with AsyncReadSessionLocal() as db:
+            user = (await db.execute(_user_query(user_id))).scalar()
+        error = _otp_code_error(user, otp_code)
+        if error:
+            return False, error
+        return _two_factor_enabled(user_id, await writer.run_async(_enable_two_factor, user_id, user.otp_secret))
+    except SQLAlchemyError as exc:
+        return False, f"Ошибка базы данных: {str(exc)}"
+
+
+def _clear_two_factor(db: Session, user_id: int) -> bool:
+    return bool(
+        db.query(User).filter(User.id == user_id).update({"is_2fa_enabled": False, "otp_secret": None})
+    )
+
+
+def _two_factor_disabled(user_id: int, found: bool) -> Tuple[bool, str]:
+    if not found:
+        return False, USER_NOT_FOUND_MESSAGE
+    forget_user_sessions(user_id)
+    return True, "2FA отключена"
+
+
 def disable_two_factor(user_id: int) -> Tuple[bool, str]:
-    db = SessionLocal()
     try:
-        user = db.query(User).filter(User.id == user_id).first()
-        if not user:
-            return False, "Пользователь не найден"
+        return _two_factor_disabled(user_id, writer.run(_clear_two_factor, user_id))
+    except SQLAlchemyError as exc:
+        return False, f"Ошибка базы данных: {str(exc)}"
 
-        user.is_2fa_enabled = False
-        user.otp_secret = None
-        db.commit()
-        return True, "2FA отключена"
+
+async def disable_two_factor_async(user_id: int) -> Tuple[bool, str]:
+    try:
+        return _two_factor_disabled(user_id, await writer.run_async(_clear_two_factor, user_id))
     except SQLAlchemyError as exc:
-        db.rollback()
         return False, f"Ошибка базы данных: {str(exc)}"
-    finally:
-        db.close()
+
+
+def _delete_user(db: Session, user_id: int) -> bool:
+    db.execute(delete(UserSession).where(UserSession.user_id == user_id))
+    db.execute(delete(UserDataKey).where(UserDataKey.user_id == user_id))
+    return bool(db.execute(delete(User).where(User.id == user_id)).rowcount)
+
+
+def delete_user(user_id: int) -> Tuple[bool, str]:
+    """Delete a user with their sessions, data key, credentials and keys.
+
+    Credentials and keys may live in shard files the ORM cascade cannot reach, so they are
+    deleted first, from every storage. Other workers drop cached sessions within the session
+    cache TTL.
+    """
+    try:
+        delete_user_rows(user_id)
+        found = writer.run(_delete_user, user_id)
+    except SQLAlchemyError as exc:
+        return False, f"Ошибка базы данных: {str(exc)}"
+    if not found:
+        return False, USER_NOT_FOUND_MESSAGE
+    forget_user_sessions(user_id)
+    lock_master_key(user_id)
+    forget_user_cipher(user_id)
+    return True, "Пользователь удалён"
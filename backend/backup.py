@@ -0,0 +1,436 @@
+"""Online backups and compact snapshots of the database.
+
+Two kinds of copy, both checked with PRAGMA quick_check and stored next to a
+.sha256 file:
+
+- backup: the SQLite online backup API, APP_BACKUP_STEP_PAGES pages per step
+  with APP_BACKUP_STEP_PAUSE seconds between steps. The source keeps one read
+  transaction open for the whole copy, so the copy is a consistent snapshot
+  and, under WAL, writers carry on meanwhile. (Without it every commit from
+  another connection would restart the copy from the first page.)
+- snapshot: VACUUM INTO, a defragmented copy without free pages. It costs more
+  I/O, so it runs less often.
+
+BackupScheduler takes a backup every APP_BACKUP_INTERVAL and a snapshot every
+APP_SNAPSHOT_INTERVAL seconds (0 turns either off). It keeps the newest
+APP_BACKUP_KEEP of each in APP_BACKUP_DIR (data/backups by default). With
+sharded credentials (see shards.py) every shard file is copied as well, before
+app.db: data keys in app.db are only ever added, so the app.db copy has the key
+of every credential in the shard copies taken before it.
+
+    python -m backend.backup [--snapshot] [--list] [--verify FILE] [--restore FILE]
+
+Restore only while the app is stopped. It verifies the file first, writes it
+over the database file it was taken from and keeps that file's current content
+as e.g. app.db.before-restore.
+"""
+import argparse
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+from .db import DATA_DIR, DATABASE_PATH
+from .shards import main_storage, shard_dir, storages
+
+logger = logging.getLogger(__name__)
+
+BACKUP_DIR_ENV = "APP_BACKUP_DIR"
+BACKUP_INTERVAL_ENV = "APP_BACKUP_INTERVAL"
+SNAPSHOT_INTERVAL_ENV = "APP_SNAPSHOT_INTERVAL"
+BACKUP_KEEP_ENV = "APP_BACKUP_KEEP"
+BACKUP_STEP_PAGES_ENV = "APP_BACKUP_STEP_PAGES"
+BACKUP_STEP_PAUSE_ENV = "APP_BACKUP_STEP_PAUSE"
+DEFAULT_BACKUP_DIR = DATA_DIR / "backups"
+DEFAULT_BACKUP_INTERVAL = 6 * 3600
+DEFAULT_SNAPSHOT_INTERVAL = 24 * 3600
+DEFAULT_KEEP = 7
+DEFAULT_STEP_PAGES = 256
+DEFAULT_STEP_PAUSE = 0.005
+RETRY_DELAY = 300
+
+KINDS = ("backup", "snapshot")
+
+PathLike = Union[str, Path]
+
+
+class BackupError(Exception):
+    pass
+
+
+def backup_dir() -> Path:
+    return Path(os.getenv(BACKUP_DIR_ENV) or DEFAULT_BACKUP_DIR)
+
+
+def sha256_file(path: PathLike) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for chunk in iter(lambda: handle.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def checksum_path(path: PathLike) -> Path:
+    path = Path(path)
+    return path.with_name(path.name + ".sha256")
+
+
+def _read_only(path: Path) -> sqlite3.Connection:
+    return sqlite3.connect(f"{path.resolve().as_uri()}?mode=ro", uri=True)
+
+
+def _quick_check(connection: sqlite3.Connection) -> str:
+    return "; ".join(row[0] for row in connection.execute("PRAGMA quick_check").fetchall())
+
+
+def _target(directory: Path, kind: str, source: Path) -> Path:
+    directory.mkdir(parents=True, exist_ok=True)
+    stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S-%f")
+    return directory / f"{source.stem}-{kind}-{stamp}.db"
+
+
+@contextmanager
+def _writing(path: Path) -> Iterator[Path]:
+    """A temporary name next to path, removed when the copy fails, so no half-written file looks like a backup."""
+    partial = path.with_name(path.name + ".partial")
+    try:
+        yield partial
+    except BaseException:
+        partial.unlink(missing_ok=True)
+        raise
+
+
+def _finish(partial: Path, path: Path, metrics: dict) -> dict:
+    started = time.perf_counter()
+    connection = sqlite3.connect(partial, isolation_level=None)
+    try:
+        # A copy of a WAL database is marked WAL too; a standalone file is easier to move and open read-only.
+        connection.execute("PRAGMA journal_mode = DELETE")
+        result = _quick_check(connection)
+    finally:
+        connection.close()
+    if result != "ok":
+        raise BackupError(f"{path.name} failed quick_check: {result}")
+    os.replace(partial, path)
+    digest = sha256_file(path)
+    checksum_path(path).write_text(f"{digest}  {path.name}\n", encoding="utf-8")
+    size = path.stat().st_size
+    metrics.update(
+        path=str(path),
+        bytes=size,
+        sha256=digest,
+        verify_seconds=round(time.perf_counter() - started, 3),
+        mb_per_second=round(size / 1e6 / metrics["copy_seconds"], 1) if metrics["copy_seconds"] else 0.0,
+    )
+    return metrics
+
+
+def online_backup(
+    source: PathLike = DATABASE_PATH,
+    directory: Optional[PathLike] = None,
+    step_pages: Optional[int] = None,
+    pause: Optional[float] = None,
+) -> dict:
+    """Copy source with the online backup API in small steps; returns the copy's metrics."""
+    source = Path(source)
+    step_pages = step_pages or int(os.getenv(BACKUP_STEP_PAGES_ENV) or DEFAULT_STEP_PAGES)
+    pause = float(os.getenv(BACKUP_STEP_PAUSE_ENV) or DEFAULT_STEP_PAUSE) if pause is None else pause
+    path = _target(Path(directory) if directory else backup_dir(), "backup", source)
+    progress = {"steps": 0, "restarts": 0, "pages": 0, "remaining": None}
+
+    def step(_status: int, remaining: int, total: int) -> None:
+        if progress["remaining"] is not None and remaining > progress["remaining"]:
+            progress["restarts"] += 1
+        progress.update(steps=progress["steps"] + 1, pages=total, remaining=remaining)
+        time.sleep(pause)
+
+    started_at = datetime.utcnow().isoformat(sep=" ", timespec="seconds")
+    started = time.perf_counter()
+    with _writing(path) as partial:
+        source_connection = sqlite3.connect(source, isolation_level=None)
+        target = sqlite3.connect(partial)
+        try:
+            source_connection.execute("BEGIN")
+            source_connection.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+            source_connection.backup(target, pages=step_pages, progress=step)
+            source_connection.execute("COMMIT")
+        finally:
+            target.close()
+            source_connection.close()
+        metrics = {
+            "kind": "backup",
+            "started_at": started_at,
+            "copy_seconds": round(time.perf_counter() - started, 3),
+            "pages": progress["pages"],
+            "steps": progress["steps"],
+            "restarts": progress["restarts"],
+        }
+        _finish(partial, path, metrics)
+    metrics["seconds"] = round(time.perf_counter() - started, 3)
+    return metrics
+
+
+def snapshot(source: PathLike = DATABASE_PATH, directory: Optional[PathLike] = None) -> dict:
+    """Write a compacted copy of source with VACUUM INTO; returns the copy's metrics."""
+    source = Path(source)
+    path = _target(Path(directory) if directory else backup_dir(), "snapshot", source)
+    started_at = datetime.utcnow().isoformat(sep=" ", timespec="seconds")
+    started = time.perf_counter()
+    with _writing(path) as partial:
+        connection = sqlite3.connect(source, isolation_level=None)
+        try:
+            connection.execute("VACUUM INTO ?", (str(partial),))
+        finally:
+            connection.close()
+        metrics = {
+            "kind": "snapshot",
+            "started_at": started_at,
+            "copy_seconds": round(time.perf_counter() - started, 3),
+        }
+        _finish(partial, path, metrics)
+    metrics["seconds"] = round(time.perf_counter() - started, 3)
+    return metrics
+
+
+def verify(path: PathLike) -> Tuple[bool, str]:
+    """Check a copy against its .sha256 file and run quick_check on it."""
+    path = Path(path)
+    if not path.is_file():
+        return False, f"{path} does not exist"
+    checksum_file = checksum_path(path)
+    if not checksum_file.is_file():
+        return False, f"{checksum_file.name} is missing"
+    expected = checksum_file.read_text(encoding="utf-8").split()[0]
+    actual = sha256_file(path)
+    if actual != expected:
+        return False, f"checksum mismatch: expected {expected}, got {actual}"
+    connection = _read_only(path)
+    try:
+        result = _quick_check(connection)
+    finally:
+        connection.close()
+    if result != "ok":
+        return False, f"quick_check: {result}"
+    return True, "ok"
+
+
+def list_backups(
+    directory: Optional[PathLike] = None, kind: Optional[str] = None, source: Optional[PathLike] = None
+) -> List[Path]:
+    """Backup and snapshot files, oldest first; only those of one database file when source is given."""
+    directory = Path(directory) if directory else backup_dir()
+    if not directory.is_dir():
+        return []
+    kinds = [kind] if kind else KINDS
+    prefix = Path(source).stem if source else "*"
+    files = [path for name in kinds for path in directory.glob(f"{prefix}-{name}-*.db")]
+    return sorted(files, key=lambda path: path.name.rsplit("-", 3)[-3:])
+
+
+def prune(
+    directory: Optional[PathLike] = None,
+    kind: str = "backup",
+    keep: Optional[int] = None,
+    source: PathLike = DATABASE_PATH,
+) -> List[Path]:
+    """Delete all but the newest `keep` copies of one kind of one database file; returns the deleted files."""
+    keep = keep or int(os.getenv(BACKUP_KEEP_ENV) or DEFAULT_KEEP)
+    removed = list_backups(directory, kind, source)[:-keep]
+    for path in removed:
+        path.unlink(missing_ok=True)
+        checksum_path(path).unlink(missing_ok=True)
+    return removed
+
+
+def _copy(source: sqlite3.Connection, target_path: Path) -> None:
+    target = sqlite3.connect(target_path)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+
+
+def database_files() -> List[Path]:
+    """Every shard file when credentials are sharded, then app.db, in the order they must be copied."""
+    return [*(storage.path for storage in storages() if storage is not main_storage), DATABASE_PATH]
+
+
+def restore_target(path: PathLike) -> Path:
+    """The database file a copy was taken from, going by its name (app-backup-... or shard-001-snapshot-...)."""
+    name = Path(path).name
+    for kind in KINDS:
+        if f"-{kind}-" in name:
+            stem = name.rsplit(f"-{kind}-", 1)[0]
+            return DATABASE_PATH if stem == DATABASE_PATH.stem else shard_dir() / f"{stem}.db"
+    raise BackupError(f"Cannot tell which database {name} belongs to; pass the target explicitly")
+
+
+def restore(path: PathLike, target: Optional[PathLike] = None) -> dict:
+    """Replace target (by default the file the copy was taken from) with a verified copy; the app must not be running."""
+    path = Path(path)
+    target = Path(target) if target else restore_target(path)
+    ok, message = verify(path)
+    if not ok:
+        raise BackupError(f"Refusing to restore {path.name}: {message}")
+    started = time.perf_counter()
+    kept = None
+    if target.exists():
+        kept = target.with_name(target.name + ".before-restore")
+        current = sqlite3.connect(target)
+        try:
+            _copy(current, kept)
+        finally:
+            current.close()
+
+    backup = _read_only(path)
+    try:
+        _copy(backup, target)
+    finally:
+        backup.close()
+    restored = sqlite3.connect(target)
+    try:
+        result = _quick_check(restored)
+    finally:
+        restored.close()
+    if result != "ok":
+        raise BackupError(f"Restored database failed quick_check: {result}; the previous one is in {kept}")
+    return {
+        "kind": "restore",
+        "path": str(path),
+        "target": str(target),
+        "previous": str(kept) if kept else None,
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+class BackupScheduler:
+    def __init__(
+        self,
+        directory: Optional[PathLike] = None,
+        backup_interval: Optional[float] = None,
+        snapshot_interval: Optional[float] = None,
+        keep: Optional[int] = None,
+        sources: Optional[Sequence[PathLike]] = None,
+    ):
+        self.directory = Path(directory) if directory else backup_dir()
+        self.intervals = {
+            "backup": float(os.getenv(BACKUP_INTERVAL_ENV) or DEFAULT_BACKUP_INTERVAL)
+            if backup_interval is None
+            else backup_interval,
+            "snapshot": float(os.getenv(SNAPSHOT_INTERVAL_ENV) or DEFAULT_SNAPSHOT_INTERVAL)
+            if snapshot_interval is None
+            else snapshot_interval,
+        }
+        self.keep = keep or int(os.getenv(BACKUP_KEEP_ENV) or DEFAULT_KEEP)
+        self.sources = [Path(source) for source in sources] if sources else None
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.last: Dict[str, List[dict]] = {}
+        self.runs = 0
+        self.failures = 0
+
+    def run(self, kind: str) -> List[dict]:
+        """Take one backup or snapshot of every database file now and prune old ones."""
+        results = []
+        for source in self.sources or database_files():
+            if kind == "backup":
+                metrics = online_backup(source, self.directory)
+            else:
+                metrics = snapshot(source, self.directory)
+            metrics["pruned"] = len(prune(self.directory, kind, self.keep, source))
+            results.append(metrics)
+            logger.info(
+                "Database %s %s: %.1f MB in %.2f s (copy %.2f s, verify %.2f s)",
+                kind,
+                Path(metrics["path"]).name,
+                metrics["bytes"] / 1e6,
+                metrics["seconds"],
+                metrics["copy_seconds"],
+                metrics["verify_seconds"],
+            )
+        self.last[kind] = results
+        self.runs += 1
+        return results
+
+    def _next_run(self, kind: str) -> float:
+        """Due time from the newest existing copy, so restarting the app does not take a fresh one every time."""
+        copies = list_backups(self.directory, kind, (self.sources or [DATABASE_PATH])[0])
+        if not copies:
+            return time.time()
+        return copies[-1].stat().st_mtime + self.intervals[kind]
+
+    def _run(self) -> None:
+        due = {kind: self._next_run(kind) for kind, interval in self.intervals.items() if interval > 0}
+        while due:
+            kind = min(due, key=due.get)
+            if self._stopped.wait(max(0.0, due[kind] - time.time())):
+                return
+            try:
+                self.run(kind)
+                due[kind] = time.time() + self.intervals[kind]
+            except Exception:  # pylint: disable=broad-except
+                self.failures += 1
+                logger.exception("Scheduled database %s failed", kind)
+                due[kind] = time.time() + min(self.intervals[kind], RETRY_DELAY)
+
+    def start(self) -> Optional[threading.Thread]:
+        if not any(interval > 0 for interval in self.intervals.values()):
+            return None
+        if self._thread is None or not self._thread.is_alive():
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="db-backup", daemon=True)
+            self._thread.start()
+        return self._thread
+
+    def shutdown(self) -> None:
+        """Stop scheduling; a copy in progress is allowed to finish."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=60)
+            self._thread = None
+
+    def stats(self) -> dict:
+        return {"runs": self.runs, "failures": self.failures, "last": self.last}
+
+
+backup_scheduler = BackupScheduler()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Back up, verify or restore the database.")
+    parser.add_argument("--snapshot", action="store_true", help="VACUUM INTO snapshot instead of an online backup")
+    parser.add_argument("--list", action="store_true", help="list existing copies and exit")
+    parser.add_argument("--verify", metavar="FILE", help="check FILE against its checksum and exit")
+    parser.add_argument("--restore", metavar="FILE", help="replace the database with FILE (stop the app first)")
+    parser.add_argument("--dir", help=f"backup directory (default {BACKUP_DIR_ENV} or {DEFAULT_BACKUP_DIR})")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    directory = Path(args.dir) if args.dir else backup_dir()
+    if args.list:
+        for path in list_backups(directory):
+            print(f"{path.name:<48} {path.stat().st_size / 1e6:10.1f} MB")
+        return
+    if args.verify:
+        ok, message = verify(args.verify)
+        print(f"{args.verify}: {message}")
+        raise SystemExit(0 if ok else 1)
+    if args.restore:
+        try:
+            result = restore(args.restore)
+        except BackupError as exc:
+            raise SystemExit(str(exc)) from exc
+        logger.info("Restored %s in %.2f s; previous database kept as %s", args.restore, result["seconds"], result["previous"])
+        return
+    scheduler = BackupScheduler(directory=directory)
+    scheduler.run("snapshot" if args.snapshot else "backup")
+
+
+if __name__ == "__main__":
+    main()
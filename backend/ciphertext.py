@@ -0,0 +1,151 @@
+"""In-place conversion of stored credential ciphertexts between text and binary form.
+
+    APP_CIPHERTEXT_STORAGE=binary python -m backend.ciphertext --to binary [--vacuum]
+
+Rows are converted in id-ordered batches, one short transaction each, so the
+app can keep running. A row is only rewritten if its ciphertext did not change
+since it was read: rows edited meanwhile keep the edit and are counted as
+skipped (run the command again to convert them). Conversion only changes the
+encoding of each Fernet token, no key is needed. Set APP_CIPHERTEXT_STORAGE to
+the same value for the app so new writes use the target form too; reads accept
+both forms at any time.
+"""
+import argparse
+import logging
+import os
+import time
+from typing import Callable, Optional
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+from .db import engine
+from .security import CIPHERTEXT_STORAGE_ENV, Token, to_fernet_token, to_stored_token
+from .shards import storages
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def _convert(token: Optional[Token], binary: bool) -> Optional[Token]:
+    if not token or isinstance(token, bytes) == binary:
+        return token
+    return to_stored_token(to_fernet_token(token), binary)
+
+
+def convert_ciphertexts(
+    binary: bool,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    pause: float = 0.0,
+    on_progress: Optional[Callable[[dict], None]] = None,
+    bind: Optional[Engine] = None,
+) -> dict:
+    """Rewrite every credential token into binary (or text) form. Safe to re-run or interrupt."""
+    started = time.monotonic()
+    state = {"processed": 0, "converted": 0, "skipped": 0, "last_id": 0}
+    while True:
+        with (bind or engine).begin() as connection:
+            rows = connection.execute(
+                text(
+                    "SELECT id, password_encrypted, notes_encrypted FROM credentials "
+                    "WHERE id > :last_id ORDER BY id LIMIT :limit"
+                ),
+                {"last_id": state["last_id"], "limit": batch_size},
+            ).fetchall()
+            if not rows:
+                break
+
+            updates = []
+            for row_id, password_token, notes_token in rows:
+                new_password = _convert(password_token, binary)
+                new_notes = _convert(notes_token, binary)
+                if new_password is not password_token or new_notes is not notes_token:
+                    updates.append(
+                        {
+                            "id": row_id,
+                            "password": new_password,
+                            "notes": new_notes,
+                            "old_password": password_token,
+                            "old_notes": notes_token,
+                        }
+                    )
+            converted = 0
+            if updates:
+                # The SELECT above runs outside a transaction, so a concurrent edit may have
+                # landed in between; only rewrite rows that still hold what was read.
+                converted = connection.execute(
+                    text(
+                        "UPDATE credentials SET password_encrypted = :password, notes_encrypted = :notes "
+                        "WHERE id = :id AND password_encrypted = :old_password AND notes_encrypted IS :old_notes"
+                    ),
+                    updates,
+                ).rowcount
+
+        state["processed"] += len(rows)
+        state["converted"] += converted
+        state["skipped"] += len(updates) - converted
+        state["last_id"] = rows[-1][0]
+        state["rows_per_second"] = round(state["processed"] / max(time.monotonic() - started, 1e-9), 1)
+        if on_progress:
+            on_progress(dict(state))
+        if pause:
+            time.sleep(pause)
+    return state
+
+
+def storage_summary(bind: Optional[Engine] = None) -> dict:
+    """Count tokens per storage class and the bytes they take."""
+    with (bind or engine).connect() as connection:
+        rows = connection.execute(
+            text(
+                "SELECT typeof(password_encrypted), COUNT(*), "
+                "SUM(length(CAST(password_encrypted AS BLOB)) + COALESCE(length(CAST(notes_encrypted AS BLOB)), 0)) "
+                "FROM credentials GROUP BY typeof(password_encrypted)"
+            )
+        ).fetchall()
+    return {kind: {"rows": count, "bytes": size or 0} for kind, count, size in rows}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Convert stored credential ciphertexts in place.")
+    parser.add_argument("--to", choices=["binary", "text"], required=True)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--pause", type=float, default=0.0, help="seconds to sleep between batches")
+    parser.add_argument("--vacuum", action="store_true", help="VACUUM afterwards to return freed pages to the OS")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    binary = args.to == "binary"
+    if (os.getenv(CIPHERTEXT_STORAGE_ENV) or "text").lower() != args.to:
+        logger.warning("%s is not set to %r: new writes will still use the other form", CIPHERTEXT_STORAGE_ENV, args.to)
+
+    for storage in storages():
+        logger.info("Before (%s): %s", storage.name, storage_summary(storage.engine))
+        state = convert_ciphertexts(
+            binary,
+            batch_size=args.batch_size,
+            pause=args.pause,
+            on_progress=lambda progress: logger.info(
+                "%d rows processed, %d converted, %d skipped, %.1f rows/s",
+                progress["processed"],
+                progress["converted"],
+                progress["skipped"],
+                progress["rows_per_second"],
+            ),
+            bind=storage.engine,
+        )
+        if args.vacuum:
+            with storage.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+                connection.exec_driver_sql("VACUUM")
+        logger.info("After (%s): %s (%d rows converted)", storage.name, storage_summary(storage.engine), state["converted"])
+        if state["skipped"]:
+            logger.warning(
+                "%d rows in %s changed during conversion and were skipped; run again to convert them",
+                state["skipped"],
+                storage.name,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,44 @@
 ﻿from datetime import datetime
-from typing import List, Optional, Tuple, Union
+from typing import List, Optional, Sequence, Tuple, Union
 
+from cryptography.fernet import MultiFernet
+from sqlalchemy import Select, select
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
 
-from .db import SessionLocal
+from .data_keys import DataKeyError, get_user_cipher, get_user_cipher_async
 from .models import Credential
-from .security import decrypt_value, encrypt_value
+from .security import decrypt_many, decrypt_value, encrypt_value, open_handle, sign_handle
+from .shards import for_user
 
+# Secret fields that can be revealed one at a time, mapped to their encrypted columns.
+SECRET_FIELDS = {
+    "password": Credential.password_encrypted,
+    "notes": Credential.notes_encrypted,
+}
 
-def _serialize(credential: Credential, include_sensitive: bool = False) -> dict:
+
+def _read_cipher(user_id: int) -> Optional[MultiFernet]:
+    """The user's data-key cipher for decryption; None falls back to the app keyring."""
+    try:
+        return get_user_cipher(user_id, create=False)
+    except DataKeyError:
+        return None
+
+
+async def _read_cipher_async(user_id: int) -> Optional[MultiFernet]:
+    try:
+        return await get_user_cipher_async(user_id, create=False)
+    except DataKeyError:
+        return None
+
+
+def _serialize(
+    credential: Credential,
+    include_sensitive: bool = False,
+    lazy: bool = False,
+    cipher: Optional[MultiFernet] = None,
+) -> dict:
     data = {
         "id": credential.id,
         "title": credential.title,
@@ -18,40 +48,160 @@ def _serialize(credential: Credential, include_sensitive: bool = False) -> dict:
         "is_archived": credential.is_archived,
     }
     if include_sensitive:
-        data["password"] = decrypt_value(credential.password_encrypted)
-        data["notes"] = decrypt_value(credential.notes_encrypted)
+        data["password"] = decrypt_value(credential.password_encrypted, cipher=cipher)
+        data["notes"] = decrypt_value(credential.notes_encrypted, cipher=cipher)
+    elif lazy:
+        data["handle"] = sign_handle(str(credential.id), bound_to=str(credential.user_id))
+        data["has_notes"] = bool(credential.notes_encrypted)
     return data
 
 
-def list_credentials(user_id: int, include_sensitive: bool = False) -> List[dict]:
-    db = SessionLocal()
+def _serialize_many(
+    credentials: Sequence[Credential],
+    include_sensitive: bool = False,
+    lazy: bool = False,
+    cipher: Optional[MultiFernet] = None,
+) -> List[dict]:
+    items = [_serialize(credential, lazy=lazy and not include_sensitive) for credential in credentials]
+    if include_sensitive:
+        tokens: List[Optional[str]] = []
+        for credential in credentials:
+            tokens.extend((credential.password_encrypted, credential.notes_encrypted))
+        plain = decrypt_many(tokens, cipher=cipher)
+        for item, password, notes in zip(items, plain[0::2], plain[1::2]):
+            item["password"] = password
+            item["notes"] = notes
+    return items
+
+
+def _active_credentials(user_id: int) -> Select:
+    return (
+        select(Credential)
+        .where(Credential.user_id == user_id, Credential.is_archived.is_(False))
+        .order_by(Credential.created_at.desc())
+    )
+
+
+def _one_credential(user_id: int, credential_id: int) -> Select:
+    return select(Credential).where(Credential.user_id == user_id, Credential.id == credential_id)
+
+
+def _title_query(user_id: int, title: str, exclude_id: Optional[int] = None) -> Select:
+    query = select(Credential.id).where(Credential.user_id == user_id, Credential.title == title)
+    return query if exclude_id is None else query.where(Credential.id != exclude_id)
+
+
+def _secret_query(user_id: int, credential_id: Union[int, str], field: str) -> Optional[Select]:
+    """Query for one encrypted field, or None for an unknown field or a handle that does not open."""
+    column = SECRET_FIELDS.get(field)
+    if column is None:
+        return None
+    if isinstance(credential_id, str):
+        opened = open_handle(credential_id, bound_to=str(user_id))
+        if opened is None:
+            return None
+        credential_id = int(opened)
+    return select(column).where(Credential.user_id == user_id, Credential.id == credential_id)
+
+
+def list_credentials(user_id: int, include_sensitive: bool = False, lazy: bool = False) -> List[dict]:
+    """List active credentials.
+
+    With lazy=True secrets are not decrypted; each item carries an opaque "handle"
+    and a "has_notes" flag instead, to be passed to reveal_secret on demand.
+    """
+    db = for_user(user_id).read_session()
     try:
-        records = (
-            db.query(Credential)
-            .filter(Credential.user_id == user_id, Credential.is_archived.is_(False))
-            .order_by(Credential.created_at.desc())
-            .all()
-        )
-        return [_serialize(record, include_sensitive=include_sensitive) for record in records]
+        records = db.execute(_active_credentials(user_id)).scalars().all()
+        cipher = _read_cipher(user_id) if include_sensitive else None
+        return _serialize_many(records, include_sensitive=include_sensitive, lazy=lazy, cipher=cipher)
     finally:
         db.close()
 
 
+async def list_credentials_async(user_id: int, include_sensitive: bool = False, lazy: bool = False) -> List[dict]:
+    async with for_user(user_id).async_read_session() as db:
+        records = (await db.execute(_active_credentials(user_id))).scalars().all()
+    cipher = await _read_cipher_async(user_id) if include_sensitive else None
+    return _serialize_many(records, include_sensitive=include_sensitive, lazy=lazy, cipher=cipher)
+
+
 def get_credential(user_id: int, credential_id: int, include_sensitive: bool = False) -> Optional[dict]:
-    db = SessionLocal()
+    db = for_user(user_id).read_session()
     try:
-        credential = (
-            db.query(Credential)
-            .filter(Credential.user_id == user_id, Credential.id == credential_id)
-            .first()
-        )
+        credential = db.execute(_one_credential(user_id, credential_id)).scalar()
         if not credential:
             return None
-        return _serialize(credential, include_sensitive=include_sensitive)
+        cipher = _read_cipher(user_id) if include_sensitive else None
+        return _serialize(credential, include_sensitive=include_sensitive, cipher=cipher)
     finally:
         db.close()
 
 
+async def get_credential_async(user_id: int, credential_id: int, include_sensitive: bool = False) -> Optional[dict]:
+    async with for_user(user_id).async_read_session() as db:
+        credential = (await db.execute(_one_credential(user_id, credential_id))).scalar()
+    if not credential:
+        return None
+    cipher = await _read_cipher_async(user_id) if include_sensitive else None
+    return _serialize(credential, include_sensitive=include_sensitive, cipher=cipher)
+
+
+def reveal_secret(user_id: int, credential_id: Union[int, str], field: str) -> Optional[str]:
+    """Decrypt a single secret field. credential_id may be the id or a handle from a lazy listing."""
+    query = _secret_query(user_id, credential_id, field)
+    if query is None:
+        return None
+    db = for_user(user_id).read_session()
+    try:
+        token = db.execute(query).scalar()
+        return decrypt_value(token, cipher=_read_cipher(user_id))
+    finally:
+        db.close()
+
+
+async def reveal_secret_async(user_id: int, credential_id: Union[int, str], field: str) -> Optional[str]:
+    query = _secret_query(user_id, credential_id, field)
+    if query is None:
+        return None
+    async with for_user(user_id).async_read_session() as db:
+        token = (await db.execute(query)).scalar()
+    return decrypt_value(token, cipher=await _read_cipher_async(user_id))
+
+
+def _find(db: Session, user_id: int, credential_id: int) -> Optional[Credential]:
+    return db.execute(_one_credential(user_id, credential_id)).scalar()
+
+
+def _new_credential_error(title: str, password: str) -> Optional[str]:
+    if not title:
+        return "Title is required"
+    if not password:
+        return "Password cannot be empty"
+    return None
+
+
+def _new_credential(
+    user_id: int, title: str, password: str, login: Optional[str], notes: Optional[str], cipher: MultiFernet
+) -> Credential:
+    return Credential(
+        user_id=user_id,
+        title=title,
+        login=(login or "").strip() or None,
+        password_encrypted=encrypt_value(password, cipher=cipher),
+        notes_encrypted=encrypt_value(notes or "", cipher=cipher),
+        created_at=datetime.utcnow(),
+    )
+
+
+def _insert_credential(db: Session, credential: Credential) -> Tuple[bool, Union[str, Credential]]:
+    if db.execute(_title_query(credential.user_id, credential.title)).first():
+        return False, "Credential with this title already exists"
+    db.add(credential)
+    db.flush()
+    return True, credential
+
+
 def create_credential(
     user_id: int,
     title: str,
@@ -59,39 +209,88 @@ def create_credential(
     login: Optional[str] = None,
     notes: Optional[str] = None,
 ) -> Tuple[bool, Union[str, dict]]:
-    db = SessionLocal()
+    clean_title = (title or "").strip()
+    error = _new_credential_error(clean_title, password)
+    if error:
+        return False, error
+
     try:
-        clean_title = (title or "").strip()
-        if not clean_title:
-            return False, "Title is required"
-        if not password:
-            return False, "Password cannot be empty"
-
-        exists = (
-            db.query(Credential)
-            .filter(Credential.user_id == user_id, Credential.title == clean_title)
-            .first()
-        )
-        if exists:
-            return False, "Credential with this title already exists"
-
-        credential = Credential(
-            user_id=user_id,
-            title=clean_title,
-            login=(login or "").strip() or None,
-            password_encrypted=encrypt_value(password),
-            notes_encrypted=encrypt_value(notes or ""),
-            created_at=datetime.utcnow(),
-        )
-        db.add(credential)
-        db.commit()
-        db.refresh(credential)
-        return True, _serialize(credential, include_sensitive=True)
+        cipher = get_user_cipher(user_id)
+        credential = _new_credential(user_id, clean_title, password, login, notes, cipher)
+        ok, result = for_user(user_id).writer.run(_insert_credential, credential)
+    except DataKeyError as exc:
+        return False, f"Encryption error: {exc}"
     except SQLAlchemyError as exc:
-        db.rollback()
         return False, f"Database error: {exc}"
-    finally:
-        db.close()
+    if not ok:
+        return False, result
+    return True, _serialize(result, include_sensitive=True, cipher=cipher)
+
+
+async def create_credential_async(
+    user_id: int,
+    title: str,
+    password: str,
+    login: Optional[str] = None,
+    notes: Optional[str] = None,
+) -> Tuple[bool, Union[str, dict]]:
+    clean_title = (title or "").strip()
+    error = _new_credential_error(clean_title, password)
+    if error:
+        return False, error
+
+    try:
+        cipher = await get_user_cipher_async(user_id)
+        credential = _new_credential(user_id, clean_title, password, login, notes, cipher)
+        ok, result = await for_user(user_id).writer.run_async(_insert_credential, credential)
+    except DataKeyError as exc:
+        return False, f"Encryption error: {exc}"
+    except SQLAlchemyError as exc:
+        return False, f"Database error: {exc}"
+    if not ok:
+        return False, result
+    return True, _serialize(result, include_sensitive=True, cipher=cipher)
+
+
+def _plain_changes(title: Optional[str], login: Optional[str]) -> Tuple[Optional[str], dict]:
+    changes = {}
+    if title is not None:
+        changes["title"] = title.strip()
+        if not changes["title"]:
+            return "Title cannot be empty", changes
+    if login is not None:
+        changes["login"] = login.strip() or None
+    return None, changes
+
+
+def _encrypted_changes(password: Optional[str], notes: Optional[str], cipher: MultiFernet) -> dict:
+    # Encrypted by the caller, not on the writer thread, which only runs the queries.
+    changes = {}
+    if password is not None and password != "":
+        changes["password_encrypted"] = encrypt_value(password, cipher=cipher)
+    if notes is not None:
+        changes["notes_encrypted"] = encrypt_value(notes, cipher=cipher)
+    return changes
+
+
+def _update_credential(
+    db: Session, user_id: int, credential_id: int, changes: dict
+) -> Tuple[bool, Union[str, Credential]]:
+    credential = _find(db, user_id, credential_id)
+    if not credential:
+        return False, "Credential not found"
+
+    new_title = changes.pop("title", None)
+    if new_title is not None:
+        if db.execute(_title_query(user_id, new_title, exclude_id=credential_id)).first():
+            return False, "Another credential with this title already exists"
+        credential.title = new_title
+
+    for column, value in changes.items():
+        setattr(credential, column, value)
+    credential.updated_at = datetime.utcnow()
+    db.flush()
+    return True, credential
 
 
 def update_credential(
@@ -103,69 +302,71 @@ def update_credential(
     password: Optional[str] = None,
     notes: Optional[str] = None,
 ) -> Tuple[bool, Union[str, dict]]:
-    db = SessionLocal()
+    error, changes = _plain_changes(title, login)
+    if error:
+        return False, error
+
     try:
-        credential = (
-            db.query(Credential)
-            .filter(Credential.user_id == user_id, Credential.id == credential_id)
-            .first()
-        )
-        if not credential:
-            return False, "Credential not found"
+        cipher = get_user_cipher(user_id)
+        changes.update(_encrypted_changes(password, notes, cipher))
+        ok, result = for_user(user_id).writer.run(_update_credential, user_id, credential_id, changes)
+    except DataKeyError as exc:
+        return False, f"Encryption error: {exc}"
+    except SQLAlchemyError as exc:
+        return False, f"Database error: {exc}"
+    if not ok:
+        return False, result
+    return True, _serialize(result, include_sensitive=True, cipher=cipher)
+
 
-        if title is not None:
-            new_title = title.strip()
-            if not new_title:
-                return False, "Title cannot be empty"
-            duplicate = (
-                db.query(Credential)
-                .filter(
-                    Credential.user_id == user_id,
-                    Credential.title == new_title,
-                    Credential.id != credential_id,
-                )
-                .first()
-            )
-            if duplicate:
-                return False, "Another credential with this title already exists"
-            credential.title = new_title
-
-        if login is not None:
-            credential.login = login.strip() or None
-
-        if password is not None and password != "":
-            credential.password_encrypted = encrypt_value(password)
-
-        if notes is not None:
-            credential.notes_encrypted = encrypt_value(notes)
-
-        credential.updated_at = datetime.utcnow()
-        db.commit()
-        db.refresh(credential)
-        return True, _serialize(credential, include_sensitive=True)
+async def update_credential_async(
+    user_id: int,
+    credential_id: int,
+    *,
+    title: Optional[str] = None,
+    login: Optional[str] = None,
+    password: Optional[str] = None,
+    notes: Optional[str] = None,
+) -> Tuple[bool, Union[str, dict]]:
+    error, changes = _plain_changes(title, login)
+    if error:
+        return False, error
+
+    try:
+        cipher = await get_user_cipher_async(user_id)
+        changes.update(_encrypted_changes(password, notes, cipher))
+        ok, result = await for_user(user_id).writer.run_async(_update_credential, user_id, credential_id, changes)
+    except DataKeyError as exc:
+        return False, f"Encryption error: {exc}"
     except SQLAlchemyError as exc:
-        db.rollback()
         return False, f"Database error: {exc}"
-    finally:
-        db.close()
+    if not ok:
+        return False, result
+    return True, _serialize(result, include_sensitive=True, cipher=cipher)
+
+
+def _delete_credential(db: Session, user_id: int, credential_id: int) -> bool:
+    credential = _find(db, user_id, credential_id)
+    if not credential:
+        return False
+    db.delete(credential)
+    db.flush()
+    return True
 
 
 def delete_credential(user_id: int, credential_id: int) -> Tuple[bool, str]:
-    db = SessionLocal()
     try:
-        credential = (
-            db.query(Credential)
-            .filter(Credential.user_id == user_id, Credential.id == credential_id)
-            .first()
-        )
-        if not credential:
+        if not for_user(user_id).writer.run(_delete_credential, user_id, credential_id):
             return False, "Credential not found"
+    except SQLAlchemyError as exc:
+        return False, f"Database error: {exc}"
+    return True, "Credential removed"
 
-        db.delete(credential)
-        db.commit()
-        return True, "Credential removed"
+
+async def delete_credential_async(user_id: int, credential_id: int) -> Tuple[bool, str]:
+    try:
+        if not await for_user(user_id).writer.run_async(_delete_credential, user_id, credential_id):
+            return False, "Credential not found"
     except SQLAlchemyError as exc:
-        db.rollback()
         return False, f"Database error: {exc}"
-    finally:
-        db.close()
+    return True, "Credential removed"
@@ -0,0 +1,163 @@
+"""Per-user data-encryption keys (envelope encryption).
+
+Each user gets a random Fernet key that encrypts their credentials. The key is
+stored in user_data_keys wrapped by the app keyring from security.py, so rotating
+the app key only rewraps one small row per user. Unwrapped keys are kept in a
+bounded LRU with a TTL to keep the app key decrypt off the hot path.
+"""
+import os
+from datetime import datetime
+from typing import Optional
+
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from sqlalchemy import DateTime, Select, bindparam, select, text
+from sqlalchemy.orm import Session
+
+from .cache import TTLCache
+from .db import AsyncReadSessionLocal, ReadSessionLocal, engine
+from .models import UserDataKey
+from .security import get_cipher, key_id, keyring
+from .writer import writer
+
+DATA_KEY_CACHE_SIZE_ENV = "APP_DATA_KEY_CACHE_SIZE"
+DATA_KEY_CACHE_TTL_ENV = "APP_DATA_KEY_CACHE_TTL"
+DEFAULT_REWRAP_BATCH_SIZE = 500
+
+_unwrapped = TTLCache(
+    maxsize=int(os.getenv(DATA_KEY_CACHE_SIZE_ENV) or 1024),
+    ttl=float(os.getenv(DATA_KEY_CACHE_TTL_ENV) or 300),
+)
+
+
+class DataKeyError(RuntimeError):
+    """Raised when a user's data key exists but cannot be unwrapped with any app key."""
+
+
+def _wrap(data_key: bytes) -> str:
+    return get_cipher().encrypt(data_key).decode("utf-8")
+
+
+def _unwrap(user_id: int, wrapped_key: str) -> MultiFernet:
+    try:
+        data_key = get_cipher().decrypt(wrapped_key.encode("utf-8"))
+    except InvalidToken as exc:
+        raise DataKeyError(f"Data key of user {user_id} cannot be unwrapped with the configured app keys") from exc
+    return MultiFernet([Fernet(data_key)])
+
+
+def _wrapped_key_query(user_id: int) -> Select:
+    return select(UserDataKey.wrapped_key).where(UserDataKey.user_id == user_id)
+
+
+def _insert_data_key(db: Session, user_id: int, wrapped_key: str) -> str:
+    """Store a new data key unless the user already has one; returns the stored wrapped key."""
+    existing = db.query(UserDataKey.wrapped_key).filter(UserDataKey.user_id == user_id).scalar()
+    if existing:
+        return existing
+    db.add(
+        UserDataKey(
+            user_id=user_id,
+            wrapped_key=wrapped_key,
+            wrapped_with=key_id(keyring.primary_key()),
+            created_at=datetime.utcnow(),
+        )
+    )
+    db.flush()
+    return wrapped_key
+
+
+def get_user_cipher(user_id: int, create: bool = True) -> Optional[MultiFernet]:
+    """Return the cipher for a user's data key, creating the key on first use (through the writer).
+
+    With create=False a user without a data key yields None, so read paths never write.
+    """
+    cipher = _unwrapped.get(user_id)
+    if cipher is not None:
+        return cipher
+
+    db = ReadSessionLocal()
+    try:
+        wrapped_key = db.execute(_wrapped_key_query(user_id)).scalar()
+    finally:
+        db.close()
+    if wrapped_key is None:
+        if not create:
+            return None
+        wrapped_key = writer.run(_insert_data_key, user_id, _wrap(Fernet.generate_key()))
+
+    cipher = _unwrap(user_id, wrapped_key)
+    _unwrapped.set(user_id, cipher)
+    return cipher
+
+
+async def get_user_cipher_async(user_id: int, create: bool = True) -> Optional[MultiFernet]:
+    """get_user_cipher for event-loop callers: the lookup goes through aiosqlite, a new key through the writer."""
+    cipher = _unwrapped.get(user_id)
+    if cipher is not None:
+        return cipher
+
+    async with AsyncReadSessionLocal() as db:
+        wrapped_key = (await db.execute(_wrapped_key_query(user_id))).scalar()
+    if wrapped_key is None:
+        if not create:
+            return None
+        wrapped_key = await writer.run_async(_insert_data_key, user_id, _wrap(Fernet.generate_key()))
+
+    cipher = _unwrap(user_id, wrapped_key)
+    _unwrapped.set(user_id, cipher)
+    return cipher
+
+
+def forget_user_cipher(user_id: Optional[int] = None) -> None:
+    """Drop one (or every) unwrapped key from the cache."""
+    if user_id is None:
+        _unwrapped.clear()
+    else:
+        _unwrapped.pop(user_id)
+
+
+def rewrap_data_keys(batch_size: int = DEFAULT_REWRAP_BATCH_SIZE) -> dict:
+    """Re-wrap every data key that is not yet wrapped with the primary app key.
+
+    This is the whole cost of an app key rotation: one row per user, credential rows are untouched.
+    """
+    cipher = get_cipher()
+    target = key_id(keyring.primary_key())
+    last_user_id = 0
+    rewrapped = 0
+    failed = []
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(
+                text(
+                    "SELECT user_id, wrapped_key FROM user_data_keys "
+                    "WHERE user_id > :last_user_id AND wrapped_with != :target ORDER BY user_id LIMIT :limit"
+                ),
+                {"last_user_id": last_user_id, "target": target, "limit": batch_size},
+            ).fetchall()
+            if not rows:
+                break
+
+            updates = []
+            for user_id, wrapped_key in rows:
+                try:
+                    new_wrapped = cipher.rotate(wrapped_key.encode("utf-8")).decode("utf-8")
+                except InvalidToken:
+                    failed.append(user_id)
+                    continue
+                updates.append({"user_id": user_id, "wrapped_key": new_wrapped, "target": target, "now": datetime.utcnow()})
+            if updates:
+                connection.execute(
+                    text(
+                        "UPDATE user_data_keys SET wrapped_key = :wrapped_key, wrapped_with = :target, "
+                        "rotated_at = :now WHERE user_id = :user_id"
+                    ).bindparams(bindparam("now", type_=DateTime())),
+                    updates,
+                )
+            rewrapped += len(updates)
+            last_user_id = rows[-1][0]
+    return {"rewrapped": rewrapped, "failed": len(failed), "failed_user_ids": failed[:100], "key_id": target}
+
+
+def cache_stats() -> dict:
+    return _unwrapped.stats()
@@ -1,19 +1,133 @@
 ﻿import os
 from pathlib import Path
+from typing import Dict, Tuple, Union
 
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import declarative_base, sessionmaker
 
+from .sql_stats import instrument
+
 BASE_DIR = Path(__file__).resolve().parent.parent
 DATA_DIR = BASE_DIR / "data"
-DATABASE_URL = f"sqlite:///{DATA_DIR / 'app.db'}"
+DATABASE_PATH = DATA_DIR / "app.db"
+DATABASE_URL = f"sqlite:///{DATABASE_PATH}"
+
+# Connection PRAGMAs per profile, picked with APP_SQLITE_PROFILE. A single PRAGMA can be
+# overridden with APP_SQLITE_<NAME>, e.g. APP_SQLITE_BUSY_TIMEOUT=10000.
+# WAL lets readers and the writer work concurrently. With synchronous=NORMAL a power
+# loss can drop the last commits but never corrupts the file; OFF can also lose
+# commits on an OS crash.
+SQLITE_PROFILE_ENV = "APP_SQLITE_PROFILE"
+DEFAULT_SQLITE_PROFILE = "balanced"
+SQLITE_PROFILES: Dict[str, Dict[str, Union[int, str]]] = {
+    "durable": {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "busy_timeout": 5000,
+        "cache_size": -16000,
+        "mmap_size": 0,
+        "temp_store": "DEFAULT",
+        "foreign_keys": "ON",
+    },
+    "balanced": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000,
+        "cache_size": -64000,
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": "MEMORY",
+        "foreign_keys": "ON",
+    },
+    "fast": {
+        "journal_mode": "WAL",
+        "synchronous": "OFF",
+        "busy_timeout": 10000,
+        "cache_size": -256000,
+        "mmap_size": 1024 * 1024 * 1024,
+        "temp_store": "MEMORY",
+        "foreign_keys": "ON",
+    },
+}
+
+
+def sqlite_settings() -> Dict[str, Union[int, str]]:
+    """PRAGMAs of the configured profile with APP_SQLITE_<NAME> overrides applied."""
+    profile = (os.getenv(SQLITE_PROFILE_ENV) or DEFAULT_SQLITE_PROFILE).lower()
+    if profile not in SQLITE_PROFILES:
+        raise ValueError(f"{SQLITE_PROFILE_ENV} must be one of {', '.join(SQLITE_PROFILES)}, got {profile!r}")
+    settings = dict(SQLITE_PROFILES[profile])
+    for name in settings:
+        override = os.getenv(f"APP_SQLITE_{name.upper()}")
+        if override:
+            settings[name] = int(override) if override.lstrip("-").isdigit() else override
+    for name, value in settings.items():
+        # Values end up in a PRAGMA statement: only plain integers and keywords are allowed.
+        if not isinstance(value, int) and not str(value).isalpha():
+            raise ValueError(f"Invalid value for PRAGMA {name}: {value!r}")
+    return settings
+
+
+_sqlite_settings = sqlite_settings()
+
+# Reads that need no write go to a separate pool of connections that SQLite refuses to
+# write through, so they never queue behind the writer (see backend/writer.py). The async
+# pool holds the same read-only connections for coroutines: aiosqlite runs each one on its
+# own thread, so awaiting a query never blocks the event loop.
+READ_POOL_SIZE_ENV = "APP_DB_READ_POOL_SIZE"
+
+
+def _pragma_listener(settings: Dict[str, Union[int, str]], read_only: bool = False):
+    def apply(dbapi_connection, _connection_record) -> None:
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in settings.items():
+                cursor.execute(f"PRAGMA {name} = {value}")
+            if read_only:
+                cursor.execute("PRAGMA query_only = ON")
+        finally:
+            cursor.close()
+
+    return apply
+
+
+def create_engines(path: Path, **pragmas: Union[int, str]) -> Tuple[Engine, Engine, AsyncEngine]:
+    """Writer engine, read-only pool and async read-only pool for one SQLite file.
+
+    pragmas override single settings of the configured profile for this file only.
+    """
+    settings = {**_sqlite_settings, **pragmas}
+    pool_size = int(os.getenv(READ_POOL_SIZE_ENV) or 8)
+    write = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False}, echo=False)
+    read = create_engine(
+        f"sqlite:///{path}",
+        connect_args={"check_same_thread": False},
+        pool_size=pool_size,
+        echo=False,
+    )
+    async_read = create_async_engine(f"sqlite+aiosqlite:///{path}", pool_size=pool_size, echo=False)
+    instrument(write, read, async_read.sync_engine)
+    event.listen(write, "connect", _pragma_listener(settings))
+    event.listen(read, "connect", _pragma_listener(settings, read_only=True))
+    event.listen(async_read.sync_engine, "connect", _pragma_listener(settings, read_only=True))
+    return write, read, async_read
+
+
+engine, read_engine, async_read_engine = create_engines(DATABASE_PATH)
+
+
+def describe_sqlite_settings() -> str:
+    """Profile name and the PRAGMA values a fresh connection actually reports, for the startup log."""
+    with engine.connect() as connection:
+        effective = {name: connection.exec_driver_sql(f"PRAGMA {name}").scalar() for name in _sqlite_settings}
+    profile = (os.getenv(SQLITE_PROFILE_ENV) or DEFAULT_SQLITE_PROFILE).lower()
+    return f"SQLite profile {profile}: " + ", ".join(f"{name}={value}" for name, value in effective.items())
+
 
-engine = create_engine(
-    DATABASE_URL,
-    connect_args={"check_same_thread": False},
-    echo=False,
-)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+AsyncReadSessionLocal = async_sessionmaker(async_read_engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
 
@@ -21,46 +135,22 @@ def ensure_database() -> None:
     DATA_DIR.mkdir(parents=True, exist_ok=True)
 
 
-def _get_table_columns(table_name: str) -> set[str]:
-    with engine.connect() as connection:
-        result = connection.execute(text(f"PRAGMA table_info('{table_name}')"))
-        return {row[1] for row in result.fetchall()}
-
-
-def _ensure_column(table_name: str, column_sql: str) -> None:
-    with engine.begin() as connection:
-        connection.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {column_sql}"))
-
-
 def run_migrations() -> None:
-    # Import models so that SQLAlchemy is aware of mapped tables before create_all
-    from . import models  # noqa: F401  pylint: disable=unused-import,import-outside-toplevel
-
-    ensure_database()
-
-    Base.metadata.create_all(bind=engine)
-
-    existing_tables = set()
-    with engine.connect() as connection:
-        rows = connection.execute(text("SELECT name FROM sqlite_master WHERE type='table'"))
-        existing_tables = {row[0] for row in rows.fetchall()}
-
-    if "users" in existing_tables:
-        columns = _get_table_columns("users")
-        if "otp_secret" not in columns:
-            _ensure_column("users", "otp_secret TEXT")
-        if "is_2fa_enabled" not in columns:
-            _ensure_column("users", "is_2fa_enabled BOOLEAN DEFAULT 0")
-        if "last_login_at" not in columns:
-            _ensure_column("users", "last_login_at DATETIME")
+    """Bring the schema up to date; a no-op costing one read of schema_version when it already is."""
+    from .migrations import migrate  # pylint: disable=import-outside-toplevel
 
-    if "credentials" not in existing_tables:
-        Base.metadata.create_all(bind=engine)
+    migrate()
 
 
 __all__ = [
     "engine",
+    "read_engine",
     "SessionLocal",
+    "ReadSessionLocal",
+    "async_read_engine",
+    "AsyncReadSessionLocal",
     "Base",
     "run_migrations",
+    "create_engines",
+    "describe_sqlite_settings",
 ]
@@ -0,0 +1,216 @@
+"""Password hashing, with a bounded process pool for callers on the event loop.
+
+A bcrypt hash takes hundreds of milliseconds of CPU; called inline from a
+NiceGUI/FastAPI handler it stalls every connected client. HashingPool runs it in
+worker processes instead and caps the number of queued jobs: past the cap callers
+get HashingBusyError straight away rather than piling up behind a login burst.
+"""
+import argparse
+import asyncio
+import atexit
+import json
+import multiprocessing
+import os
+import platform
+import statistics
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Optional, Tuple
+
+from passlib.context import CryptContext
+from passlib.hash import bcrypt
+
+HASH_WORKERS_ENV = "APP_HASH_WORKERS"
+HASH_QUEUE_LIMIT_ENV = "APP_HASH_QUEUE_LIMIT"
+BCRYPT_ROUNDS_ENV = "APP_BCRYPT_ROUNDS"
+BCRYPT_TARGET_MS_ENV = "APP_BCRYPT_TARGET_MS"
+BCRYPT_SETTINGS_PATH = Path(__file__).resolve().parent.parent / "data" / "bcrypt.json"
+MIN_BCRYPT_ROUNDS = 10
+MAX_BCRYPT_ROUNDS = 16
+
+
+def configured_rounds() -> Optional[int]:
+    """bcrypt cost from APP_BCRYPT_ROUNDS, else from the calibration file, else None (passlib default)."""
+    env_rounds = os.getenv(BCRYPT_ROUNDS_ENV)
+    if env_rounds:
+        return int(env_rounds)
+    try:
+        return int(json.loads(BCRYPT_SETTINGS_PATH.read_text(encoding="utf-8"))["rounds"])
+    except (FileNotFoundError, ValueError, KeyError):
+        return None
+
+
+def _context_settings(rounds: Optional[int]) -> dict:
+    if rounds is None:
+        return {}
+    # Pinning min and max to the default makes needs_update flag both weaker and stronger hashes.
+    return {"bcrypt__default_rounds": rounds, "bcrypt__min_rounds": rounds, "bcrypt__max_rounds": rounds}
+
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", **_context_settings(configured_rounds()))
+
+
+def _time_rounds(rounds: int, samples: int) -> float:
+    hasher = bcrypt.using(rounds=rounds)
+    timings = []
+    for _ in range(samples):
+        started = time.perf_counter()
+        hasher.hash("calibration-password")
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+
+def calibrate(target_ms: float, samples: int = 3, save: bool = True) -> dict:
+    """Pick the highest bcrypt cost whose hash time stays within target_ms on this host.
+
+    The result is applied to pwd_context and, with save, written to data/bcrypt.json
+    so the next start (and every hashing worker) uses it. Existing hashes are moved
+    to the new cost on their owner's next successful login.
+    """
+    measurements = {}
+    chosen = MIN_BCRYPT_ROUNDS
+    for rounds in range(MIN_BCRYPT_ROUNDS, MAX_BCRYPT_ROUNDS + 1):
+        elapsed_ms = _time_rounds(rounds, samples)
+        measurements[rounds] = round(elapsed_ms, 1)
+        if elapsed_ms > target_ms:
+            break
+        chosen = rounds
+        # Each extra round doubles the cost: stop before a step that clearly overshoots.
+        if elapsed_ms * 2 > target_ms * 1.5:
+            break
+
+    settings = {
+        "rounds": chosen,
+        "target_ms": target_ms,
+        "measured_ms": measurements,
+        "host": platform.node(),
+        "calibrated_at": datetime.utcnow().isoformat(timespec="seconds"),
+    }
+    if save:
+        BCRYPT_SETTINGS_PATH.parent.mkdir(parents=True, exist_ok=True)
+        BCRYPT_SETTINGS_PATH.write_text(json.dumps(settings, indent=2), encoding="utf-8")
+    apply_rounds(chosen)
+    return settings
+
+
+def apply_rounds(rounds: int) -> None:
+    """Switch pwd_context to a new cost and restart hashing workers so they pick it up."""
+    pwd_context.update(**_context_settings(rounds))
+    hashing_pool.shutdown()
+
+
+def ensure_calibrated() -> Optional[dict]:
+    """Startup hook: calibrate once when APP_BCRYPT_TARGET_MS is set and no cost is configured yet."""
+    target_ms = os.getenv(BCRYPT_TARGET_MS_ENV)
+    if not target_ms or configured_rounds() is not None:
+        return None
+    return calibrate(float(target_ms))
+
+
+class HashingBusyError(RuntimeError):
+    """Raised when the hashing queue is full."""
+
+
+def hash_secret(secret: str) -> str:
+    return pwd_context.hash(secret)
+
+
+def verify_secret(secret: str, hashed: str) -> bool:
+    return pwd_context.verify(secret, hashed)
+
+
+def verify_and_update_secret(secret: str, hashed: str) -> Tuple[bool, Optional[str]]:
+    """Verify, and return a replacement hash when the stored one uses another cost."""
+    return pwd_context.verify_and_update(secret, hashed)
+
+
+class HashingPool:
+    """Process pool for bcrypt with a limit on jobs that are queued or running."""
+
+    def __init__(self, workers: Optional[int] = None, queue_limit: Optional[int] = None):
+        self.workers = workers or int(os.getenv(HASH_WORKERS_ENV) or min(4, os.cpu_count() or 1))
+        self.queue_limit = queue_limit or int(os.getenv(HASH_QUEUE_LIMIT_ENV) or self.workers * 8)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._executor
+
+    def _release(self, _future: Future) -> None:
+        with self._lock:
+            self.pending -= 1
+            self.completed += 1
+
+    def submit(self, func: Callable, *args) -> Future:
+        """Queue func(*args) on the pool, or raise HashingBusyError when the queue is full."""
+        with self._lock:
+            if self.pending >= self.queue_limit:
+                self.rejected += 1
+                raise HashingBusyError("Too many password checks in progress")
+            self.pending += 1
+            try:
+                future = self._get_executor().submit(func, *args)
+            except Exception:
+                self.pending -= 1
+                raise
+        future.add_done_callback(self._release)
+        return future
+
+    async def hash(self, secret: str) -> str:
+        return await asyncio.wrap_future(self.submit(hash_secret, secret))
+
+    async def verify(self, secret: str, hashed: str) -> bool:
+        return await asyncio.wrap_future(self.submit(verify_secret, secret, hashed))
+
+    async def verify_and_update(self, secret: str, hashed: str) -> Tuple[bool, Optional[str]]:
+        return await asyncio.wrap_future(self.submit(verify_and_update_secret, secret, hashed))
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "queue_limit": self.queue_limit,
+            "pending": self.pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+
+hashing_pool = HashingPool()
+atexit.register(hashing_pool.shutdown)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Calibrate the bcrypt cost for this host.")
+    parser.add_argument("--calibrate", action="store_true", help="measure and store the bcrypt cost (default action)")
+    parser.add_argument("--target-ms", type=float, default=float(os.getenv(BCRYPT_TARGET_MS_ENV) or 100))
+    parser.add_argument("--samples", type=int, default=3)
+    parser.add_argument("--dry-run", action="store_true", help="measure only, do not save")
+    args = parser.parse_args()
+
+    settings = calibrate(args.target_ms, samples=args.samples, save=not args.dry_run)
+    for rounds, elapsed_ms in settings["measured_ms"].items():
+        print(f"rounds={rounds:<3} {elapsed_ms:8.1f} ms")
+    print(f"chosen cost: {settings['rounds']} (target {args.target_ms:.0f} ms)")
+    if not args.dry_run:
+        print(f"saved to {BCRYPT_SETTINGS_PATH}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+from datetime import datetime
+from typing import List, Optional, Tuple, Union
+
+from sqlalchemy import Select, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from .models import Key
+from .shards import for_user
+
+
+def _user_keys(user_id: int) -> Select:
+    return select(Key).where(Key.user_id == user_id).order_by(Key.created_at.desc())
+
+
+def _one_key(user_id: int, key_id: int) -> Select:
+    return select(Key).where(Key.user_id == user_id, Key.id == key_id)
+
+
+async def list_keys_async(user_id: int) -> List[Key]:
+    async with for_user(user_id).async_read_session() as db:
+        result = await db.execute(_user_keys(user_id))
+        return list(result.scalars().all())
+
+
+def _insert_key(db: Session, key: Key) -> Key:
+    db.add(key)
+    db.flush()
+    return key
+
+
+async def create_key_async(user_id: int, name: str, value: str, description: str = "") -> Tuple[bool, Union[str, Key]]:
+    if not name.strip():
+        return False, "Enter key name"
+    if not value.strip():
+        return False, "Enter key value"
+    key = Key(
+        user_id=user_id,
+        key_name=name.strip(),
+        key_value=value.strip(),
+        description=description.strip() or None,
+        created_at=datetime.utcnow(),
+        is_active=True,
+    )
+    try:
+        return True, await for_user(user_id).writer.run_async(_insert_key, key)
+    except SQLAlchemyError as exc:
+        return False, f"Database error: {exc}"
+
+
+def _find(db: Session, user_id: int, key_id: int) -> Optional[Key]:
+    return db.execute(_one_key(user_id, key_id)).scalar()
+
+
+def _set_key_active(db: Session, user_id: int, key_id: int, value: bool) -> bool:
+    key = _find(db, user_id, key_id)
+    if not key:
+        return False
+    key.is_active = value
+    return True
+
+
+async def set_key_active_async(user_id: int, key_id: int, value: bool) -> bool:
+    return await for_user(user_id).writer.run_async(_set_key_active, user_id, key_id, value)
+
+
+def _remove_key(db: Session, user_id: int, key_id: int) -> bool:
+    key = _find(db, user_id, key_id)
+    if not key:
+        return False
+    db.delete(key)
+    return True
+
+
+async def delete_key_async(user_id: int, key_id: int) -> bool:
+    return await for_user(user_id).writer.run_async(_remove_key, user_id, key_id)
@@ -0,0 +1,120 @@
+"""Write-behind buffer for login bookkeeping.
+
+A successful login only records last_login_at in memory; a background thread
+hands the buffered values to the writer (backend/writer.py) as one executemany
+every FLUSH_INTERVAL seconds, or sooner once MAX_PENDING users are waiting, so
+logins never take the SQLite write lock. The buffer is flushed on shutdown and
+read by the UI, so the profile page shows the fresh time even before it reaches
+the database; a batch stays readable until the writer has committed it.
+"""
+import atexit
+import logging
+import os
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import DateTime, bindparam, text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from .writer import writer
+
+logger = logging.getLogger(__name__)
+
+LOGIN_FLUSH_INTERVAL_ENV = "APP_LOGIN_FLUSH_INTERVAL"
+LOGIN_FLUSH_MAX_PENDING_ENV = "APP_LOGIN_FLUSH_MAX_PENDING"
+DEFAULT_FLUSH_INTERVAL = 5.0
+DEFAULT_MAX_PENDING = 500
+
+
+def _write_logins(db: Session, rows: List[dict]) -> None:
+    db.execute(
+        text(
+            "UPDATE users SET last_login_at = :logged_in_at WHERE id = :user_id "
+            "AND (last_login_at IS NULL OR last_login_at < :logged_in_at)"
+        ).bindparams(bindparam("logged_in_at", type_=DateTime())),
+        rows,
+    )
+
+
+class LoginActivityBuffer:
+    def __init__(self, flush_interval: Optional[float] = None, max_pending: Optional[int] = None):
+        self.flush_interval = flush_interval or float(os.getenv(LOGIN_FLUSH_INTERVAL_ENV) or DEFAULT_FLUSH_INTERVAL)
+        self.max_pending = max_pending or int(os.getenv(LOGIN_FLUSH_MAX_PENDING_ENV) or DEFAULT_MAX_PENDING)
+        self._pending: Dict[int, datetime] = {}
+        # The batch being written: still served by last_login() until it is committed.
+        self._inflight: Dict[int, datetime] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.flushes = 0
+        self.written = 0
+
+    def _ensure_thread(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="login-activity-flush", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def record(self, user_id: int, when: Optional[datetime] = None) -> None:
+        with self._lock:
+            self._pending[user_id] = when or datetime.utcnow()
+            pending = len(self._pending)
+            self._ensure_thread()
+        if pending >= self.max_pending:
+            self._wakeup.set()
+
+    def last_login(self, user_id: int) -> Optional[datetime]:
+        """Buffered login time of a user, or None when nothing is waiting to be written."""
+        with self._lock:
+            return self._pending.get(user_id) or self._inflight.get(user_id)
+
+    def flush(self) -> int:
+        """Write every buffered value in one executemany; returns the number of users written."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+                self._inflight = batch
+            if not batch:
+                return 0
+            rows = [{"user_id": user_id, "logged_in_at": when} for user_id, when in batch.items()]
+            try:
+                writer.run(_write_logins, rows)
+            except SQLAlchemyError:
+                logger.exception("Failed to write %d login timestamps, will retry", len(rows))
+                with self._lock:
+                    # Newer logins recorded meanwhile win over the batch being put back.
+                    self._pending = {**batch, **self._pending}
+                    self._inflight = {}
+                return 0
+            with self._lock:
+                self._inflight = {}
+            self.flushes += 1
+            self.written += len(rows)
+            return len(rows)
+
+    def shutdown(self) -> None:
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        self.flush()
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = len(self._pending) + len(self._inflight)
+        return {"pending": pending, "flushes": self.flushes, "written": self.written}
+
+
+login_activity = LoginActivityBuffer()
+atexit.register(login_activity.shutdown)
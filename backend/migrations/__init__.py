@@ -0,0 +1,241 @@
+"""Versioned schema and data migrations.
+
+Migrations are the vNNNN_<name>.py modules in this package, applied in version
+order and recorded in schema_version. Each lists the tables it touches in
+TABLES. A schema migration defines upgrade(connection, tables) and runs in one BEGIN IMMEDIATE transaction together with
+its schema_version row, so it either applies completely or not at all, and a
+second worker booting at the same time waits and then skips it. Startup on an
+up-to-date database costs a single primary-key read of schema_version.
+
+A data migration (backfill, re-encryption) defines
+migrate_batch(connection, checkpoint, batch_size, tables) instead, returning the next
+checkpoint or None when done. Every batch commits in its own short transaction
+together with the checkpoint, so the write lock is released between batches and
+an interrupted run resumes where it stopped.
+
+    python -m backend.migrations [--status] [--batch-size N] [--pause S]
+
+migrate() and status() work on the app database unless given another engine
+as bind, e.g. a scratch database in tests. A database that holds only some of
+the tables (a shard file, see shards.py) is migrated with tables=...: every
+migration gets the part of its TABLES that lives there, and one touching none of
+them is recorded without running, so versions stay in step across files.
+"""
+import argparse
+import importlib
+import logging
+import pkgutil
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from types import ModuleType
+from typing import Collection, FrozenSet, Iterator, List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import OperationalError
+
+from ..db import engine, ensure_database
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_BATCH_PAUSE = 0.01
+
+_CREATE_VERSION_TABLE = (
+    "CREATE TABLE IF NOT EXISTS schema_version ("
+    "version INTEGER PRIMARY KEY, "
+    "name TEXT NOT NULL, "
+    "applied_at DATETIME, "
+    "checkpoint TEXT)"
+)
+
+
+def available_migrations() -> List[Tuple[int, str, ModuleType]]:
+    """(version, name, module) for every vNNNN_name module, in version order."""
+    migrations = []
+    for module_info in pkgutil.iter_modules(__path__):
+        prefix, _, name = module_info.name.partition("_")
+        if prefix[:1] != "v" or not prefix[1:].isdigit():
+            continue
+        module = importlib.import_module(f"{__name__}.{module_info.name}")
+        migrations.append((int(prefix[1:]), name, module))
+    migrations.sort(key=lambda migration: migration[0])
+    return migrations
+
+
+@contextmanager
+def write_transaction(bind: Optional[Engine] = None) -> Iterator[Connection]:
+    """A connection inside BEGIN IMMEDIATE, so DDL is transactional and concurrent migrators queue up."""
+    with (bind or engine).connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.exec_driver_sql("ROLLBACK")
+            raise
+        connection.exec_driver_sql("COMMIT")
+
+
+def table_columns(connection: Connection, table_name: str) -> set:
+    return {row[1] for row in connection.exec_driver_sql(f"PRAGMA table_info('{table_name}')").fetchall()}
+
+
+def add_column_if_missing(connection: Connection, table_name: str, column_name: str, column_sql: str) -> None:
+    """For the baseline, which also adopts databases created before migrations, when columns were added by hand."""
+    if column_name not in table_columns(connection, table_name):
+        connection.exec_driver_sql(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_sql}")
+
+
+def _latest_applied(connection: Connection) -> Tuple[int, bool]:
+    """(highest recorded version, whether it finished). One primary-key read."""
+    try:
+        row = connection.execute(
+            text("SELECT version, applied_at FROM schema_version ORDER BY version DESC LIMIT 1")
+        ).first()
+    except OperationalError:
+        return 0, True
+    if row is None:
+        return 0, True
+    return row[0], row[1] is not None
+
+
+def _state(connection: Connection, version: int) -> Optional[Tuple[Optional[str], Optional[str]]]:
+    row = connection.execute(
+        text("SELECT applied_at, checkpoint FROM schema_version WHERE version = :version"), {"version": version}
+    ).first()
+    return None if row is None else (row[0], row[1])
+
+
+def _record(connection: Connection, version: int, name: str, applied: bool, checkpoint: Optional[str] = None) -> None:
+    connection.execute(
+        text(
+            "INSERT INTO schema_version (version, name, applied_at, checkpoint) "
+            "VALUES (:version, :name, :applied_at, :checkpoint) "
+            "ON CONFLICT(version) DO UPDATE SET applied_at = excluded.applied_at, checkpoint = excluded.checkpoint"
+        ),
+        {
+            "version": version,
+            "name": name,
+            "applied_at": datetime.utcnow().isoformat(sep=" ") if applied else None,
+            "checkpoint": checkpoint,
+        },
+    )
+
+
+def _apply_schema(version: int, name: str, module: ModuleType, bind: Engine, tables: FrozenSet[str]) -> bool:
+    with write_transaction(bind) as connection:
+        state = _state(connection, version)
+        if state is not None and state[0] is not None:
+            return False
+        if tables:
+            module.upgrade(connection, tables)
+        _record(connection, version, name, applied=True)
+    return True
+
+
+def _apply_data(
+    version: int, name: str, module: ModuleType, batch_size: int, pause: float, bind: Engine, tables: FrozenSet[str]
+) -> bool:
+    batches = 0
+    while True:
+        with write_transaction(bind) as connection:
+            state = _state(connection, version)
+            if state is not None and state[0] is not None:
+                return batches > 0
+            if not tables:
+                _record(connection, version, name, applied=True)
+                return True
+            if state is None and hasattr(module, "upgrade"):
+                module.upgrade(connection, tables)
+            checkpoint = state[1] if state else None
+            next_checkpoint = module.migrate_batch(connection, checkpoint, batch_size, tables)
+            _record(connection, version, name, applied=next_checkpoint is None, checkpoint=next_checkpoint)
+        batches += 1
+        if next_checkpoint is None:
+            return True
+        if batches % 100 == 0:
+            logger.info("Migration %04d %s: %d batches, checkpoint %s", version, name, batches, next_checkpoint)
+        # Let the app's writers in between batches.
+        time.sleep(pause)
+
+
+def migrate(
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    pause: float = DEFAULT_BATCH_PAUSE,
+    bind: Optional[Engine] = None,
+    tables: Optional[Collection[str]] = None,
+) -> List[int]:
+    """Apply every pending migration in order; returns the versions applied by this call.
+
+    tables limits the migrations to the tables this database holds; default: all of them.
+    """
+    if bind is None:
+        ensure_database()
+        bind = engine
+    migrations = available_migrations()
+    target = migrations[-1][0] if migrations else 0
+    with bind.connect() as connection:
+        current, finished = _latest_applied(connection)
+    if current >= target and finished:
+        return []
+
+    with bind.begin() as connection:
+        connection.exec_driver_sql(_CREATE_VERSION_TABLE)
+
+    applied = []
+    for version, name, module in migrations:
+        started = time.monotonic()
+        scope = frozenset(module.TABLES) if tables is None else frozenset(module.TABLES) & frozenset(tables)
+        if hasattr(module, "migrate_batch"):
+            changed = _apply_data(version, name, module, batch_size, pause, bind, scope)
+        else:
+            changed = _apply_schema(version, name, module, bind, scope)
+        if changed:
+            applied.append(version)
+            logger.info("Applied migration %04d %s in %.2f s", version, name, time.monotonic() - started)
+    return applied
+
+
+def status(bind: Optional[Engine] = None) -> List[dict]:
+    if bind is None:
+        ensure_database()
+    with (bind or engine).connect() as connection:
+        try:
+            rows = connection.execute(text("SELECT version, applied_at, checkpoint FROM schema_version")).fetchall()
+        except OperationalError:
+            rows = []
+    recorded = {version: (applied_at, checkpoint) for version, applied_at, checkpoint in rows}
+    result = []
+    for version, name, module in available_migrations():
+        applied_at, checkpoint = recorded.get(version, (None, None))
+        result.append(
+            {
+                "version": version,
+                "name": name,
+                "kind": "data" if hasattr(module, "migrate_batch") else "schema",
+                "applied_at": applied_at,
+                "checkpoint": checkpoint,
+            }
+        )
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Apply pending database migrations.")
+    parser.add_argument("--status", action="store_true", help="list migrations and exit")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="rows per data-migration batch")
+    parser.add_argument("--pause", type=float, default=DEFAULT_BATCH_PAUSE, help="seconds between batches")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    if not args.status:
+        applied = migrate(batch_size=args.batch_size, pause=args.pause)
+        logger.info("%d migration(s) applied", len(applied))
+        from ..shards import storages  # pylint: disable=import-outside-toplevel
+
+        # Opening a shard migrates it.
+        logger.info("Storages up to date: %s", ", ".join(storage.name for storage in storages()))
+    for row in status():
+        state = row["applied_at"] or (f"in progress at {row['checkpoint']}" if row["checkpoint"] else "pending")
+        print(f"{row['version']:04d} {row['name']:<32} {row['kind']:<6} {state}")
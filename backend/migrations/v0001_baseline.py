@@ -0,0 +1,100 @@
+"""Tables as of the switch to versioned migrations, frozen as plain DDL.
+
+Later schema changes get their own migrations; this one never follows the
+models. Databases created before it already have some of the tables, possibly
+without the columns added later, so everything here is IF NOT EXISTS and those
+columns are added when missing. Later migrations can assume exactly this schema.
+"""
+from typing import Dict, FrozenSet, Tuple
+
+from sqlalchemy.engine import Connection
+
+from . import add_column_if_missing
+
+STATEMENTS: Dict[str, Tuple[str, ...]] = {
+    "users": (
+        """CREATE TABLE IF NOT EXISTS users (
+            id INTEGER NOT NULL,
+            username VARCHAR NOT NULL,
+            password_hash VARCHAR NOT NULL,
+            email VARCHAR,
+            created_at DATETIME,
+            master_key VARCHAR,
+            otp_secret VARCHAR,
+            is_2fa_enabled BOOLEAN,
+            last_login_at DATETIME,
+            PRIMARY KEY (id),
+            UNIQUE (email)
+        )""",
+        "CREATE INDEX IF NOT EXISTS ix_users_id ON users (id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_users_username ON users (username)",
+    ),
+    "credentials": (
+        """CREATE TABLE IF NOT EXISTS credentials (
+            id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            title VARCHAR NOT NULL,
+            login VARCHAR,
+            password_encrypted BLOB NOT NULL,
+            notes_encrypted BLOB,
+            created_at DATETIME,
+            updated_at DATETIME,
+            is_archived BOOLEAN,
+            PRIMARY KEY (id),
+            CONSTRAINT uq_credentials_user_title UNIQUE (user_id, title),
+            FOREIGN KEY(user_id) REFERENCES users (id)
+        )""",
+        "CREATE INDEX IF NOT EXISTS ix_credentials_id ON credentials (id)",
+    ),
+    "keys": (
+        """CREATE TABLE IF NOT EXISTS keys (
+            id INTEGER NOT NULL,
+            user_id INTEGER,
+            key_name VARCHAR NOT NULL,
+            key_value VARCHAR NOT NULL,
+            description VARCHAR,
+            created_at DATETIME,
+            is_active BOOLEAN,
+            PRIMARY KEY (id),
+            FOREIGN KEY(user_id) REFERENCES users (id)
+        )""",
+        "CREATE INDEX IF NOT EXISTS ix_keys_id ON keys (id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_keys_key_value ON keys (key_value)",
+    ),
+    "user_data_keys": (
+        """CREATE TABLE IF NOT EXISTS user_data_keys (
+            user_id INTEGER NOT NULL,
+            wrapped_key TEXT NOT NULL,
+            wrapped_with VARCHAR NOT NULL,
+            created_at DATETIME,
+            rotated_at DATETIME,
+            PRIMARY KEY (user_id),
+            FOREIGN KEY(user_id) REFERENCES users (id)
+        )""",
+    ),
+    "user_sessions": (
+        """CREATE TABLE IF NOT EXISTS user_sessions (
+            id VARCHAR NOT NULL,
+            user_id INTEGER NOT NULL,
+            created_at DATETIME,
+            expires_at DATETIME NOT NULL,
+            revoked_at DATETIME,
+            PRIMARY KEY (id),
+            FOREIGN KEY(user_id) REFERENCES users (id)
+        )""",
+        "CREATE INDEX IF NOT EXISTS ix_user_sessions_revoked_at ON user_sessions (revoked_at)",
+        "CREATE INDEX IF NOT EXISTS ix_user_sessions_user_id ON user_sessions (user_id)",
+    ),
+}
+TABLES = tuple(STATEMENTS)
+
+
+def upgrade(connection: Connection, tables: FrozenSet[str]) -> None:
+    for table in TABLES:
+        if table in tables:
+            for statement in STATEMENTS[table]:
+                connection.exec_driver_sql(statement)
+    if "users" in tables:
+        add_column_if_missing(connection, "users", "otp_secret", "TEXT")
+        add_column_if_missing(connection, "users", "is_2fa_enabled", "BOOLEAN DEFAULT 0")
+        add_column_if_missing(connection, "users", "last_login_at", "DATETIME")
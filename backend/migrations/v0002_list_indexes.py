@@ -0,0 +1,24 @@
+"""Composite indexes for the credential and key lists.
+
+Both lists filter by user and sort by created_at; without these SQLite searched
+credentials by user_id alone and scanned keys entirely, then sorted in a temp
+B-tree. Databases migrated while the baseline still ran create_all on the
+current models, and shard files created from the models before shards were
+migrated, already have them, hence IF NOT EXISTS; migrations after this one can
+run unconditionally.
+"""
+from typing import FrozenSet
+
+from sqlalchemy.engine import Connection
+
+TABLES = ("credentials", "keys")
+
+
+def upgrade(connection: Connection, tables: FrozenSet[str]) -> None:
+    if "credentials" in tables:
+        connection.exec_driver_sql(
+            "CREATE INDEX IF NOT EXISTS ix_credentials_user_archived_created "
+            "ON credentials (user_id, is_archived, created_at)"
+        )
+    if "keys" in tables:
+        connection.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_keys_user_created ON keys (user_id, created_at)")
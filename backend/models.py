@@ -5,16 +5,37 @@ from sqlalchemy import (
     Column,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
+    LargeBinary,
     String,
     Text,
     UniqueConstraint,
 )
 from sqlalchemy.orm import relationship
+from sqlalchemy.types import TypeDecorator
 
 from .db import Base
 
 
+class CipherText(TypeDecorator):
+    """Fernet token column holding either base64 text or raw token bytes.
+
+    Values are passed through untouched in both directions: SQLite keeps a str as
+    TEXT and bytes as BLOB whatever the declared type, and security.decrypt_value
+    accepts both, so rows can be converted in place (see backend/ciphertext.py).
+    """
+
+    impl = LargeBinary
+    cache_ok = True
+
+    def bind_processor(self, dialect):
+        return None
+
+    def result_processor(self, dialect, coltype):
+        return None
+
+
 class User(Base):
     __tablename__ = "users"
 
@@ -30,10 +51,41 @@ class User(Base):
 
     keys = relationship("Key", back_populates="user", cascade="all, delete-orphan")
     credentials = relationship("Credential", back_populates="user", cascade="all, delete-orphan")
+    data_key = relationship("UserDataKey", back_populates="user", uselist=False, cascade="all, delete-orphan")
+
+
+class UserDataKey(Base):
+    """Per-user data-encryption key, stored wrapped (Fernet-encrypted) by the app key."""
+
+    __tablename__ = "user_data_keys"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    wrapped_key = Column(Text, nullable=False)
+    wrapped_with = Column(String, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    rotated_at = Column(DateTime, nullable=True)
+
+    user = relationship("User", back_populates="data_key")
+
+
+class UserSession(Base):
+    """Login session; the browser holds a signed token for id (see backend/sessions.py)."""
+
+    __tablename__ = "user_sessions"
+
+    id = Column(String, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False)
+    revoked_at = Column(DateTime, nullable=True, index=True)
 
 
 class Key(Base):
     __tablename__ = "keys"
+    __table_args__ = (
+        # The dashboard lists a user's keys newest first.
+        Index("ix_keys_user_created", "user_id", "created_at"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
@@ -50,14 +102,16 @@ class Credential(Base):
     __tablename__ = "credentials"
     __table_args__ = (
         UniqueConstraint("user_id", "title", name="uq_credentials_user_title"),
+        # list_credentials: a user's non-archived entries, newest first.
+        Index("ix_credentials_user_archived_created", "user_id", "is_archived", "created_at"),
     )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     title = Column(String, nullable=False)
     login = Column(String, nullable=True)
-    password_encrypted = Column(Text, nullable=False)
-    notes_encrypted = Column(Text, nullable=True)
+    password_encrypted = Column(CipherText, nullable=False)
+    notes_encrypted = Column(CipherText, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     is_archived = Column(Boolean, default=False)
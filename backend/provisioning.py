@@ -0,0 +1,314 @@
+"""Bulk user provisioning from CSV or JSONL.
+
+    python -m backend.provisioning team.csv [--errors errors.jsonl]
+    python -m backend.provisioning - --format jsonl < team.jsonl
+
+Each record needs username and password, email is optional; CSV files need a
+header row. Records are processed in batches: validated and checked for
+duplicates (within the input, and against users with one query per batch),
+hashed in parallel, then inserted through the writer (see writer.py) with a
+single executemany per batch. A failing record is reported with its line number
+and the message create_user would give; the rest of the batch still goes in.
+
+The CLI hashes on its own process pool with one worker per core. The API runs
+one job at a time on the app's shared hashing pool (see hashing.py) and keeps at
+most one hash per worker in flight, so logins still find room in its queue.
+"""
+import argparse
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Callable, Iterable, Iterator, List, Optional, TextIO
+
+from sqlalchemy import insert, or_, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from .auth import EMAIL_TAKEN_MESSAGE, USERNAME_TAKEN_MESSAGE, _credentials_error, _integrity_error_message, _normalize
+from .db import read_engine
+from .hashing import HashingBusyError, HashingPool, hash_secret
+from .models import User
+from .user_index import user_index
+from .writer import writer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 500
+FORMATS = ("csv", "jsonl")
+MAX_BODY_BYTES_ENV = "APP_PROVISION_MAX_BYTES"
+DEFAULT_MAX_BODY_BYTES = 10 * 1024 * 1024
+# Wait before retrying a hash the shared pool turned away because its queue was full.
+BUSY_RETRY_DELAY = 0.05
+
+
+def _fields(line: int, record: dict) -> dict:
+    for name in ("username", "password", "email"):
+        value = record.get(name)
+        if value is not None and not isinstance(value, str):
+            username = record.get("username")
+            return {
+                "line": line,
+                "username": username if isinstance(username, str) else None,
+                "error": f"Expected a string for {name}",
+            }
+    return {
+        "line": line,
+        "username": _normalize(record.get("username")),
+        "password": record.get("password") or "",
+        "email": _normalize(record.get("email")),
+    }
+
+
+def read_users(stream: TextIO, fmt: str) -> Iterator[dict]:
+    """Yield {"line", "username", "password", "email"} per record; unparsable records carry "error" instead."""
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield _fields(reader.line_num, record)
+        return
+
+    for line_number, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as exc:
+            yield {"line": line_number, "username": None, "error": f"Invalid JSON: {exc.msg}"}
+            continue
+        if not isinstance(record, dict):
+            yield {"line": line_number, "username": None, "error": "Expected a JSON object"}
+            continue
+        yield _fields(line_number, record)
+
+
+def _batches(rows: Iterable[dict], size: int) -> Iterator[List[dict]]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def max_body_bytes() -> int:
+    return int(os.getenv(MAX_BODY_BYTES_ENV) or DEFAULT_MAX_BODY_BYTES)
+
+
+def _executor_hasher(executor: ProcessPoolExecutor, workers: int) -> Callable[[List[str]], List[str]]:
+    def hash_passwords(passwords: List[str]) -> List[str]:
+        chunksize = max(1, len(passwords) // (workers * 4))
+        return list(executor.map(hash_secret, passwords, chunksize=chunksize))
+
+    return hash_passwords
+
+
+def _submit_when_free(pool: HashingPool, password: str) -> Future:
+    while True:
+        try:
+            return pool.submit(hash_secret, password)
+        except HashingBusyError:
+            time.sleep(BUSY_RETRY_DELAY)
+
+
+def _pool_hasher(pool: HashingPool) -> Callable[[List[str]], List[str]]:
+    def hash_passwords(passwords: List[str]) -> List[str]:
+        # One job per worker in flight: the rest of the pool's queue stays free for logins.
+        futures: List[Future] = []
+        hashes = []
+        for password in passwords:
+            if len(futures) - len(hashes) >= pool.workers:
+                hashes.append(futures[len(hashes)].result())
+            futures.append(_submit_when_free(pool, password))
+        hashes.extend(future.result() for future in futures[len(hashes) :])
+        return hashes
+
+    return hash_passwords
+
+
+def _insert_users(db: Session, values: List[dict]) -> None:
+    db.execute(insert(User), values)
+
+
+class _Provisioner:
+    def __init__(self, hash_passwords: Callable[[List[str]], List[str]]):
+        self.hash_passwords = hash_passwords
+        self.seen_usernames = set()
+        self.seen_emails = set()
+        self.report = {"processed": 0, "created": 0, "failed": 0, "errors": []}
+
+    def _fail(self, row: dict, message: str) -> None:
+        self.report["failed"] += 1
+        self.report["errors"].append({"line": row["line"], "username": row.get("username"), "error": message})
+
+    def _validate(self, batch: List[dict]) -> List[dict]:
+        valid = []
+        for row in batch:
+            error = row.get("error") or _credentials_error(row["username"], row["password"])
+            if not error and row["username"] in self.seen_usernames:
+                error = USERNAME_TAKEN_MESSAGE
+            if not error and row["email"] and row["email"] in self.seen_emails:
+                error = EMAIL_TAKEN_MESSAGE
+            if error:
+                self._fail(row, error)
+                continue
+            self.seen_usernames.add(row["username"])
+            if row["email"]:
+                self.seen_emails.add(row["email"])
+            valid.append(row)
+        return self._drop_existing(valid)
+
+    def _drop_existing(self, rows: List[dict]) -> List[dict]:
+        """One query per batch against users, so taken names fail before they cost a hash."""
+        if not rows:
+            return rows
+        usernames = [row["username"] for row in rows]
+        emails = [row["email"] for row in rows if row["email"]]
+        with read_engine.connect() as connection:
+            existing = connection.execute(
+                select(User.username, User.email).where(or_(User.username.in_(usernames), User.email.in_(emails)))
+            ).fetchall()
+        taken_usernames = {username for username, _ in existing}
+        taken_emails = {email for _, email in existing if email}
+        remaining = []
+        for row in rows:
+            if row["username"] in taken_usernames:
+                self._fail(row, USERNAME_TAKEN_MESSAGE)
+            elif row["email"] and row["email"] in taken_emails:
+                self._fail(row, EMAIL_TAKEN_MESSAGE)
+            else:
+                remaining.append(row)
+        return remaining
+
+    def _hash(self, rows: List[dict]) -> None:
+        if not rows:
+            return
+        for row, password_hash in zip(rows, self.hash_passwords([row["password"] for row in rows])):
+            row["password_hash"] = password_hash
+
+    @staticmethod
+    def _values(row: dict) -> dict:
+        return {"username": row["username"], "email": row["email"] or None, "password_hash": row["password_hash"]}
+
+    def _insert(self, rows: List[dict]) -> None:
+        if not rows:
+            return
+        try:
+            writer.run(_insert_users, [self._values(row) for row in rows])
+        except IntegrityError:
+            # A concurrent signup took one of the names: retry row by row to find out which.
+            for row in rows:
+                self._insert_one(row)
+            return
+        for row in rows:
+            user_index.added(row["username"], row["email"])
+        self.report["created"] += len(rows)
+
+    def _insert_one(self, row: dict) -> None:
+        try:
+            writer.run(_insert_users, [self._values(row)])
+        except IntegrityError as exc:
+            self._fail(row, _integrity_error_message(exc) or str(exc.orig))
+            return
+        user_index.added(row["username"], row["email"])
+        self.report["created"] += 1
+
+    def run_batch(self, batch: List[dict]) -> None:
+        rows = self._validate(batch)
+        self._hash(rows)
+        self._insert(rows)
+        self.report["processed"] += len(batch)
+
+
+def _provision(
+    rows: Iterable[dict],
+    batch_size: int,
+    hash_passwords: Callable[[List[str]], List[str]],
+    on_progress: Optional[Callable[[dict], None]],
+) -> dict:
+    started = time.monotonic()
+    provisioner = _Provisioner(hash_passwords)
+    for batch in _batches(rows, batch_size):
+        provisioner.run_batch(batch)
+        if on_progress:
+            progress = {key: value for key, value in provisioner.report.items() if key != "errors"}
+            progress["rows_per_second"] = round(progress["processed"] / max(time.monotonic() - started, 1e-9), 1)
+            on_progress(progress)
+    report = provisioner.report
+    report["seconds"] = round(time.monotonic() - started, 2)
+    return report
+
+
+def provision_users(
+    rows: Iterable[dict],
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    workers: Optional[int] = None,
+    on_progress: Optional[Callable[[dict], None]] = None,
+    pool: Optional[HashingPool] = None,
+) -> dict:
+    """Create users from read_users() records. Returns counts and per-record errors.
+
+    Hashes on pool when given (the API passes the shared hashing pool), else on a
+    process pool of its own with workers processes, one per core by default.
+    """
+    if pool is not None:
+        return _provision(rows, batch_size, _pool_hasher(pool), on_progress)
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return _provision(rows, batch_size, _executor_hasher(executor, workers), on_progress)
+
+
+def detect_format(path: str, fmt: Optional[str]) -> str:
+    if fmt:
+        return fmt
+    return "jsonl" if path.endswith((".jsonl", ".ndjson")) else "csv"
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Create many users at once from a CSV or JSONL file.")
+    parser.add_argument("path", help="input file, or - for stdin")
+    parser.add_argument("--format", choices=FORMATS, help="default: from the file extension, csv for stdin")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--workers", type=int, help="hashing processes, default: one per core")
+    parser.add_argument("--errors", help="write failed records as JSONL to this path")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    fmt = detect_format(args.path, args.format)
+    stream = sys.stdin if args.path == "-" else open(args.path, encoding="utf-8-sig", newline="")
+    try:
+        report = provision_users(
+            read_users(stream, fmt),
+            batch_size=args.batch_size,
+            workers=args.workers,
+            on_progress=lambda progress: logger.info(
+                "%d processed, %d created, %d failed, %.1f rows/s",
+                progress["processed"],
+                progress["created"],
+                progress["failed"],
+                progress["rows_per_second"],
+            ),
+        )
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+    if args.errors:
+        with open(args.errors, "w", encoding="utf-8") as errors_file:
+            for error in report["errors"]:
+                errors_file.write(json.dumps(error, ensure_ascii=False) + "\n")
+    else:
+        for error in report["errors"][:20]:
+            logger.info("line %s (%s): %s", error["line"], error["username"], error["error"])
+    logger.info("Done: %d created, %d failed in %.1f s", report["created"], report["failed"], report["seconds"])
+    return 1 if report["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
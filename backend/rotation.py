@@ -0,0 +1,296 @@
+"""Online key rotation for stored credentials.
+
+Credentials are encrypted with per-user data keys (see data_keys.py), so an app
+key rotation only rewraps one data key per user. Typical rotation with a key file:
+
+    python -m backend.rotation --new-key
+
+This puts a fresh key first in data/fernet.key (older keys stay there for
+decryption) and rewraps every data key with it. With APP_SECRET_KEY, set the new
+secret and move the old one to APP_PREVIOUS_SECRET_KEYS before running the job.
+
+Rows written before envelope encryption are still encrypted with the app key.
+The same command walks the credentials table once (every shard when sharded,
+see shards.py) and re-encrypts them with the owner's data key; after that walk
+completes, old app keys can be removed.
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+
+from cryptography.fernet import InvalidToken, MultiFernet
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+
+from .data_keys import get_user_cipher, rewrap_data_keys
+from .db import DATA_DIR, engine
+from .security import (
+    APP_FERNET_ENV,
+    FERNET_KEY_PATH,
+    Token,
+    add_primary_key,
+    get_cipher,
+    key_id,
+    keyring,
+    to_fernet_token,
+    to_stored_token,
+)
+from .shards import main_storage, storages
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_PATH = DATA_DIR / "rotation.checkpoint.json"
+DEFAULT_BATCH_SIZE = 500
+# Upper bound on re-encrypted rows per second; keeps the write lock available to live traffic.
+DEFAULT_MAX_ROWS_PER_SECOND = 2000.0
+# Pause between batches even when under the rate limit, so waiting writers get the lock.
+DEFAULT_BATCH_PAUSE = 0.05
+
+
+def checkpoint_path(storage_name: str) -> Path:
+    """One checkpoint per storage when credentials are sharded (see shards.py)."""
+    if storage_name == main_storage.name:
+        return CHECKPOINT_PATH
+    return CHECKPOINT_PATH.with_name(f"rotation.checkpoint.{storage_name}.json")
+
+
+def _read_checkpoint(path: Path) -> Optional[dict]:
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _write_checkpoint(path: Path, checkpoint: dict) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(checkpoint), encoding="utf-8")
+    tmp_path.replace(path)
+
+
+def _to_data_key(app_cipher: MultiFernet, user_cipher: MultiFernet, token: Optional[Token]) -> Optional[Token]:
+    """Re-encrypt an app-key token with the user's data key; tokens already on it are returned as is."""
+    if not token:
+        return token
+    raw = to_fernet_token(token)
+    try:
+        user_cipher.decrypt(raw)
+        return token
+    except InvalidToken:
+        pass
+    return to_stored_token(user_cipher.encrypt(app_cipher.decrypt(raw)))
+
+
+class RotationJob:
+    """Moves app-key encrypted credentials onto per-user data keys in keyset-paginated batches.
+
+    Each batch is committed on its own and followed by a checkpoint write, so a
+    crashed or stopped job resumes after the last committed id. Rows are updated
+    only if their ciphertext did not change since they were read, so concurrent
+    edits by live traffic always win.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        max_rows_per_second: Optional[float] = DEFAULT_MAX_ROWS_PER_SECOND,
+        batch_pause: float = DEFAULT_BATCH_PAUSE,
+        checkpoint_path: Path = CHECKPOINT_PATH,
+        on_progress: Optional[Callable[[dict], None]] = None,
+        bind: Optional[Engine] = None,
+    ):
+        self.engine = bind if bind is not None else engine
+        self.batch_size = batch_size
+        self.max_rows_per_second = max_rows_per_second
+        self.batch_pause = batch_pause
+        self.checkpoint_path = checkpoint_path
+        self.on_progress = on_progress
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.state: dict = {}
+
+    def _initial_state(self, restart: bool) -> dict:
+        checkpoint = None if restart else _read_checkpoint(self.checkpoint_path)
+        if checkpoint:
+            return checkpoint
+        with self.engine.connect() as connection:
+            total = connection.execute(text("SELECT COUNT(*) FROM credentials")).scalar() or 0
+        return {
+            "last_id": 0,
+            "processed": 0,
+            "migrated": 0,
+            "failed": 0,
+            "failed_ids": [],
+            "total": total,
+            "completed": False,
+            "started_at": datetime.utcnow().isoformat(),
+        }
+
+    def _migrate_batch(self, app_cipher: MultiFernet, last_id: int) -> Tuple[List[int], int, List[int]]:
+        """Re-encrypt the next batch.
+
+        Returns the processed ids, the number of rewritten rows and the ids that failed to decrypt.
+        """
+        with self.engine.connect() as connection:
+            rows = connection.execute(
+                text(
+                    "SELECT id, user_id, password_encrypted, notes_encrypted FROM credentials "
+                    "WHERE id > :last_id ORDER BY id LIMIT :limit"
+                ),
+                {"last_id": last_id, "limit": self.batch_size},
+            ).fetchall()
+
+        # Resolve data keys outside the write transaction: creating one commits on its own session.
+        updates = []
+        failed_ids = []
+        for row_id, user_id, password_token, notes_token in rows:
+            user_cipher = get_user_cipher(user_id)
+            try:
+                new_password = _to_data_key(app_cipher, user_cipher, password_token)
+                new_notes = _to_data_key(app_cipher, user_cipher, notes_token)
+            except InvalidToken:
+                # Encrypted with a key that is no longer configured; leave it for inspection.
+                failed_ids.append(row_id)
+                continue
+            if new_password != password_token or new_notes != notes_token:
+                updates.append(
+                    {
+                        "id": row_id,
+                        "password": new_password,
+                        "notes": new_notes,
+                        "old_password": password_token,
+                        "old_notes": notes_token,
+                    }
+                )
+
+        if updates:
+            with self.engine.begin() as connection:
+                connection.execute(
+                    text(
+                        "UPDATE credentials SET password_encrypted = :password, notes_encrypted = :notes "
+                        "WHERE id = :id AND password_encrypted = :old_password AND notes_encrypted IS :old_notes"
+                    ),
+                    updates,
+                )
+        return [row[0] for row in rows], len(updates), failed_ids
+
+    def run(self, restart: bool = False) -> dict:
+        """Run the job in the calling thread until done or stopped. Returns the final state.
+
+        A completed checkpoint makes this a no-op unless restart is set.
+        """
+        keyring.invalidate()
+        cipher = get_cipher()
+        self.state = self._initial_state(restart)
+        if self.state["completed"]:
+            return self.state
+
+        started = time.monotonic()
+        processed = 0
+        while not self._stop.is_set():
+            try:
+                ids, migrated, failed_ids = self._migrate_batch(cipher, self.state["last_id"])
+            except OperationalError as exc:
+                # Usually "database is locked" under live writes: back off and retry the same batch.
+                logger.warning("Data key migration batch after id %d failed, retrying: %s", self.state["last_id"], exc)
+                self._stop.wait(max(self.batch_pause, 1.0))
+                continue
+
+            if ids:
+                self.state["last_id"] = ids[-1]
+                self.state["processed"] += len(ids)
+                self.state["migrated"] += migrated
+                self.state["failed"] += len(failed_ids)
+                self.state["failed_ids"] = (self.state["failed_ids"] + failed_ids)[-100:]
+            else:
+                self.state["completed"] = True
+                self.state["finished_at"] = datetime.utcnow().isoformat()
+            _write_checkpoint(self.checkpoint_path, self.state)
+
+            processed += len(ids)
+            elapsed = max(time.monotonic() - started, 1e-9)
+            self.state["rows_per_second"] = round(processed / elapsed, 1)
+            self._report()
+            if self.state["completed"]:
+                break
+
+            delay = self.batch_pause
+            if self.max_rows_per_second:
+                delay = max(delay, processed / self.max_rows_per_second - elapsed)
+            self._stop.wait(delay)
+        return self.state
+
+    def _report(self) -> None:
+        done = self.state["processed"]
+        total = max(self.state["total"], done)
+        percent = 100.0 * done / total if total else 100.0
+        logger.info(
+            "Data key migration: %d/%d rows (%.1f%%), %d re-encrypted, %d failed, %.1f rows/s",
+            done,
+            total,
+            percent,
+            self.state["migrated"],
+            self.state["failed"],
+            self.state.get("rows_per_second", 0.0),
+        )
+        if self.on_progress:
+            self.on_progress(dict(self.state, percent=round(percent, 1)))
+
+    def start(self, restart: bool = False) -> threading.Thread:
+        """Run the job on a daemon thread."""
+        self._thread = threading.Thread(target=self.run, kwargs={"restart": restart}, name="data-key-migration", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Ask the job to stop after the current batch; progress up to it is kept."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Rotate the app key: rewrap user data keys and migrate legacy rows.")
+    parser.add_argument("--new-key", action="store_true", help="generate a new primary key in the key file first")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--max-rate", type=float, default=DEFAULT_MAX_ROWS_PER_SECOND, help="rows per second, 0 for no limit")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and start from the first row")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    if args.new_key:
+        if os.getenv(APP_FERNET_ENV):
+            parser.error(f"{APP_FERNET_ENV} is set and stays primary; rotate it via APP_PREVIOUS_SECRET_KEYS instead")
+        new_key = add_primary_key()
+        logger.info("Added primary key %s to %s", key_id(new_key), FERNET_KEY_PATH)
+
+    summary = rewrap_data_keys()
+    logger.info("Rewrapped %d user data keys with key %s", summary["rewrapped"], summary["key_id"])
+    if summary["failed"]:
+        logger.warning("%d data keys could not be unwrapped, e.g. users %s", summary["failed"], summary["failed_user_ids"][:10])
+
+    for storage in storages():
+        state = RotationJob(
+            batch_size=args.batch_size,
+            max_rows_per_second=args.max_rate or None,
+            checkpoint_path=checkpoint_path(storage.name),
+            bind=storage.engine,
+        ).run(restart=args.restart)
+        if state["failed"]:
+            logger.warning(
+                "%d rows in %s could not be decrypted with any configured key, e.g. ids %s",
+                state["failed"],
+                storage.name,
+                state["failed_ids"][:10],
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,42 @@
+import atexit
 import base64
 import hashlib
+import hmac
+import multiprocessing
 import os
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
 
-from cryptography.fernet import Fernet, InvalidToken
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
 import pyotp
 
+from .cache import TTLCache
+
 BASE_DIR = Path(__file__).resolve().parent.parent
 SECRET_DIR = BASE_DIR / "data"
 FERNET_KEY_PATH = SECRET_DIR / "fernet.key"
 APP_FERNET_ENV = "APP_SECRET_KEY"
+# Comma-separated secrets that were previously set in APP_SECRET_KEY; kept for decryption only.
+APP_PREVIOUS_FERNET_ENV = "APP_PREVIOUS_SECRET_KEYS"
+# Seconds between checks of the key file mtime; the env vars are checked on every call.
+KEYRING_RELOAD_INTERVAL = 1.0
+
+# Batch crypto settings: backend is one of "auto", "serial", "thread" or "process".
+CRYPTO_BACKEND_ENV = "APP_CRYPTO_BACKEND"
+CRYPTO_WORKERS_ENV = "APP_CRYPTO_WORKERS"
+CRYPTO_CHUNK_SIZE_ENV = "APP_CRYPTO_CHUNK_SIZE"
+DEFAULT_CRYPTO_BACKEND = "auto"
+DEFAULT_CRYPTO_CHUNK_SIZE = 256
+
+# "text" stores base64 Fernet tokens; "binary" stores the raw token bytes, about a quarter smaller.
+CIPHERTEXT_STORAGE_ENV = "APP_CIPHERTEXT_STORAGE"
+_RAW_TOKEN_VERSION = b"\x80"
+
+Token = Union[str, bytes]
 
 
 def _derive_key_from_env(secret: str) -> bytes:
@@ -26,12 +52,21 @@ def _load_env_key() -> Optional[bytes]:
     return None
 
 
-def _load_key_from_file() -> Optional[bytes]:
+def _load_previous_env_keys() -> List[bytes]:
+    secrets = os.getenv(APP_PREVIOUS_FERNET_ENV) or ""
+    return [_derive_key_from_env(secret.strip()) for secret in secrets.split(",") if secret.strip()]
+
+
+def _load_keys_from_file() -> List[bytes]:
+    """Read every key from the key file, one per line; the first one is primary."""
     if FERNET_KEY_PATH.exists():
-        key = FERNET_KEY_PATH.read_bytes().strip()
-        if key:
-            return key
-    return None
+        return [line.strip() for line in FERNET_KEY_PATH.read_bytes().splitlines() if line.strip()]
+    return []
+
+
+def _load_key_from_file() -> Optional[bytes]:
+    keys = _load_keys_from_file()
+    return keys[0] if keys else None
 
 
 def _persist_key_to_file(key: bytes) -> None:
@@ -54,29 +89,298 @@ def load_fernet_key() -> bytes:
     return new_key
 
 
-def get_cipher() -> Fernet:
-    return Fernet(load_fernet_key())
+def load_fernet_keys() -> List[bytes]:
+    """Return all active keys, primary first. Older keys are only used to decrypt."""
+    keys = [load_fernet_key()]
+    for key in _load_previous_env_keys() + _load_keys_from_file():
+        if key not in keys:
+            keys.append(key)
+    return keys
+
+
+def add_primary_key() -> bytes:
+    """Generate a new key and put it first in the key file, keeping the old ones for decryption.
+
+    Has no effect on encryption while APP_SECRET_KEY is set, since the env key stays primary.
+    """
+    new_key = Fernet.generate_key()
+    _persist_key_to_file(b"\n".join([new_key] + _load_keys_from_file()) + b"\n")
+    keyring.invalidate()
+    return new_key
+
+
+def key_id(key: bytes) -> str:
+    """Short, non-secret identifier of a key, safe to log or store."""
+    return hashlib.sha256(b"key-id:" + key).hexdigest()[:16]
+
+
+def _key_file_mtime() -> Optional[int]:
+    try:
+        return FERNET_KEY_PATH.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+_EnvState = Tuple[Optional[str], Optional[str]]
+
 
+class CipherKeyring:
+    """Process-wide MultiFernet, rebuilt only when the env secrets or the key file change."""
 
-def encrypt_value(value: Optional[str]) -> Optional[str]:
-    """Encrypt a plain string with Fernet. Returns None for falsy inputs."""
+    def __init__(self, reload_interval: float = KEYRING_RELOAD_INTERVAL):
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._cipher: Optional[MultiFernet] = None
+        self._primary_key: Optional[bytes] = None
+        self._fingerprint: Optional[Tuple[_EnvState, Optional[int]]] = None
+        self._checked_at = 0.0
+
+    def _is_fresh(self, env_state: _EnvState, now: float) -> bool:
+        if self._cipher is None or self._fingerprint is None:
+            return False
+        if self._fingerprint[0] != env_state:
+            return False
+        if now - self._checked_at < self.reload_interval:
+            return True
+        if self._fingerprint[1] != _key_file_mtime():
+            return False
+        self._checked_at = now
+        return True
+
+    def _rebuild(self, env_state: _EnvState, now: float) -> None:
+        keys = load_fernet_keys()
+        self._cipher = MultiFernet([Fernet(key) for key in keys])
+        self._primary_key = keys[0]
+        # Read the mtime after loading: load_fernet_keys may have just created the file.
+        self._fingerprint = (env_state, _key_file_mtime())
+        self._checked_at = now
+
+    def get(self) -> MultiFernet:
+        env_state = (os.getenv(APP_FERNET_ENV), os.getenv(APP_PREVIOUS_FERNET_ENV))
+        now = time.monotonic()
+        cipher = self._cipher
+        if cipher is not None and self._is_fresh(env_state, now):
+            return cipher
+        with self._lock:
+            if not self._is_fresh(env_state, now):
+                self._rebuild(env_state, now)
+            return self._cipher
+
+    def primary_key(self) -> bytes:
+        self.get()
+        return self._primary_key
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._cipher = None
+            self._primary_key = None
+            self._fingerprint = None
+
+
+keyring = CipherKeyring()
+
+
+def get_cipher() -> MultiFernet:
+    return keyring.get()
+
+
+def binary_storage() -> bool:
+    return (os.getenv(CIPHERTEXT_STORAGE_ENV) or "text").lower() == "binary"
+
+
+def to_fernet_token(token: Token) -> bytes:
+    """Turn a stored token, base64 text or raw bytes, into the base64 form Fernet expects."""
+    if isinstance(token, str):
+        return token.encode("ascii")
+    if token[:1] == _RAW_TOKEN_VERSION:
+        return base64.urlsafe_b64encode(token)
+    return token
+
+
+def to_stored_token(token: bytes, binary: Optional[bool] = None) -> Token:
+    """Turn a Fernet token into the configured storage form."""
+    if binary is None:
+        binary = binary_storage()
+    return base64.urlsafe_b64decode(token) if binary else token.decode("ascii")
+
+
+def _encrypt_with(cipher: MultiFernet, value: Optional[str], binary: bool = False) -> Optional[Token]:
     if not value:
         return value
-    cipher = get_cipher()
-    return cipher.encrypt(value.encode("utf-8")).decode("utf-8")
+    return to_stored_token(cipher.encrypt(value.encode("utf-8")), binary)
 
 
-def decrypt_value(token: Optional[str]) -> Optional[str]:
-    """Decrypt a Fernet token, returning None if invalid or empty."""
+def _decrypt_with(
+    cipher: MultiFernet,
+    token: Optional[Token],
+    fallback: Optional[MultiFernet] = None,
+) -> Optional[str]:
     if not token:
-        return token
-    cipher = get_cipher()
+        return None if token is None else ""
+    raw = to_fernet_token(token)
+    try:
+        return cipher.decrypt(raw).decode("utf-8")
+    except InvalidToken:
+        if fallback is None:
+            return None
     try:
-        return cipher.decrypt(token.encode("utf-8")).decode("utf-8")
+        return fallback.decrypt(raw).decode("utf-8")
     except InvalidToken:
         return None
 
 
+def encrypt_value(value: Optional[str], cipher: Optional[MultiFernet] = None) -> Optional[Token]:
+    """Encrypt a plain string with Fernet. Returns None for falsy inputs.
+
+    cipher overrides the app keyring, e.g. with a per-user data key. The token is
+    raw bytes when APP_CIPHERTEXT_STORAGE=binary and base64 text otherwise.
+    """
+    return _encrypt_with(cipher or get_cipher(), value, binary_storage())
+
+
+def decrypt_value(token: Optional[Token], cipher: Optional[MultiFernet] = None) -> Optional[str]:
+    """Decrypt a Fernet token (text or raw bytes), returning None if invalid or empty.
+
+    With a cipher override, tokens that predate it are still tried against the app keyring.
+    """
+    if cipher is None:
+        return _decrypt_with(get_cipher(), token)
+    return _decrypt_with(cipher, token, fallback=get_cipher())
+
+
+# Batch helpers -------------------------------------------------------------
+
+_executors: Dict[str, Executor] = {}
+_executors_lock = threading.Lock()
+
+
+def _encrypt_chunk(values: Sequence[Optional[str]], cipher: Optional[MultiFernet] = None) -> List[Optional[Token]]:
+    cipher = cipher or get_cipher()
+    binary = binary_storage()
+    return [_encrypt_with(cipher, value, binary) for value in values]
+
+
+def _decrypt_chunk(tokens: Sequence[Optional[Token]], cipher: Optional[MultiFernet] = None) -> List[Optional[str]]:
+    if cipher is None:
+        app_cipher = get_cipher()
+        return [_decrypt_with(app_cipher, token) for token in tokens]
+    fallback = get_cipher()
+    return [_decrypt_with(cipher, token, fallback=fallback) for token in tokens]
+
+
+def _crypto_workers() -> int:
+    configured = os.getenv(CRYPTO_WORKERS_ENV)
+    if configured:
+        return max(1, int(configured))
+    return os.cpu_count() or 1
+
+
+def _get_executor(backend: str) -> Executor:
+    with _executors_lock:
+        executor = _executors.get(backend)
+        if executor is None:
+            if backend == "process":
+                # Spawned workers rebuild their own keyring from the same env and key file.
+                executor = ProcessPoolExecutor(
+                    max_workers=_crypto_workers(),
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            else:
+                executor = ThreadPoolExecutor(max_workers=_crypto_workers(), thread_name_prefix="crypto")
+            _executors[backend] = executor
+        return executor
+
+
+@atexit.register
+def shutdown_crypto_pools() -> None:
+    with _executors_lock:
+        for executor in _executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+        _executors.clear()
+
+
+def _resolve_backend(backend: Optional[str], size: int, chunk_size: int) -> str:
+    backend = (backend or os.getenv(CRYPTO_BACKEND_ENV) or DEFAULT_CRYPTO_BACKEND).lower()
+    if backend not in {"auto", "serial", "thread", "process"}:
+        raise ValueError(f"Unknown crypto backend: {backend}")
+    if size <= chunk_size:
+        return "serial"
+    if backend == "auto":
+        # A pool only pays off when there is more than one core and more than one chunk per worker.
+        workers = _crypto_workers()
+        return "process" if workers > 1 and size > chunk_size * workers else "serial"
+    return backend
+
+
+def _run_batch(
+    func: Callable[..., list],
+    values: Sequence[Optional[Token]],
+    cipher: Optional[MultiFernet],
+    backend: Optional[str],
+    chunk_size: Optional[int],
+) -> list:
+    values = list(values)
+    chunk_size = max(1, chunk_size or int(os.getenv(CRYPTO_CHUNK_SIZE_ENV) or DEFAULT_CRYPTO_CHUNK_SIZE))
+    backend = _resolve_backend(backend, len(values), chunk_size)
+    if backend == "serial":
+        return func(values, cipher=cipher)
+
+    chunks = [values[start:start + chunk_size] for start in range(0, len(values), chunk_size)]
+    results: list = []
+    for part in _get_executor(backend).map(partial(func, cipher=cipher), chunks):
+        results.extend(part)
+    return results
+
+
+def encrypt_many(
+    values: Sequence[Optional[str]],
+    *,
+    cipher: Optional[MultiFernet] = None,
+    backend: Optional[str] = None,
+    chunk_size: Optional[int] = None,
+) -> List[Optional[Token]]:
+    """Encrypt a batch of strings, keeping order. Falsy inputs are returned unchanged."""
+    return _run_batch(_encrypt_chunk, values, cipher, backend, chunk_size)
+
+
+def decrypt_many(
+    tokens: Sequence[Optional[Token]],
+    *,
+    cipher: Optional[MultiFernet] = None,
+    backend: Optional[str] = None,
+    chunk_size: Optional[int] = None,
+) -> List[Optional[str]]:
+    """Decrypt a batch of tokens, keeping order. Invalid tokens decrypt to None."""
+    return _run_batch(_decrypt_chunk, tokens, cipher, backend, chunk_size)
+
+
+# Opaque handles ------------------------------------------------------------
+
+HANDLE_SIGNATURE_BYTES = 12
+
+
+def _handle_signature(payload: str, secret: Optional[bytes] = None) -> str:
+    signing_key = hashlib.sha256(b"handle:" + (secret or keyring.primary_key())).digest()
+    digest = hmac.new(signing_key, payload.encode("utf-8"), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:HANDLE_SIGNATURE_BYTES]).decode("ascii")
+
+
+def sign_handle(public_part: str, bound_to: str = "", secret: Optional[bytes] = None) -> str:
+    """Build an opaque handle for public_part, valid only together with bound_to.
+
+    Signed with the primary app key unless secret is given; such handles stop opening once the key rotates.
+    """
+    return f"{public_part}.{_handle_signature(f'{bound_to}:{public_part}', secret)}"
+
+
+def open_handle(handle: str, bound_to: str = "", secret: Optional[bytes] = None) -> Optional[str]:
+    """Return the public part of a handle made by sign_handle, or None if it was tampered with."""
+    public_part, _, signature = (handle or "").rpartition(".")
+    if not public_part or not hmac.compare_digest(signature, _handle_signature(f"{bound_to}:{public_part}", secret)):
+        return None
+    return public_part
+
+
 # 2FA helpers ---------------------------------------------------------------
 
 DEFAULT_ISSUER = "Key Manager"
@@ -91,8 +395,83 @@ def build_totp_uri(secret: str, username: str, issuer: str = DEFAULT_ISSUER) ->
     return totp.provisioning_uri(name=username, issuer_name=issuer)
 
 
-def verify_totp(secret: str, code: str) -> bool:
+TOTP_VALID_WINDOW = 1
+TOTP_CACHE_SIZE_ENV = "APP_TOTP_CACHE_SIZE"
+# Must outlive the acceptance window ((2 * TOTP_VALID_WINDOW + 1) * 30 s), or an evicted
+# user could replay a code that is still valid.
+TOTP_CACHE_TTL = 600.0
+
+
+class _TotpEntry:
+    __slots__ = ("secret", "totp", "last_step", "lock", "window_step", "window_codes")
+
+    def __init__(self, secret: str):
+        self.secret = secret
+        self.totp = pyotp.TOTP(secret)
+        self.last_step = -1
+        self.lock = threading.Lock()
+        self.window_step = None
+        self.window_codes: List[Tuple[int, str]] = []
+
+    def codes_around(self, current_step: int) -> List[Tuple[int, str]]:
+        """(step, code) pairs for the acceptance window, regenerated only when the step moves."""
+        if self.window_step != current_step:
+            steps = range(current_step - TOTP_VALID_WINDOW, current_step + TOTP_VALID_WINDOW + 1)
+            self.window_codes = [(step, self.totp.generate_otp(step)) for step in steps]
+            self.window_step = current_step
+        return self.window_codes
+
+
+class TotpVerifierCache:
+    """Prepared TOTP objects per user, plus the last accepted time step to stop code replay.
+
+    A code is accepted at most once: after it matches time step N, only codes for
+    steps after N are accepted for that user.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = TOTP_CACHE_TTL):
+        self._entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def _entry(self, user_id: int, secret: str) -> _TotpEntry:
+        entry = self._entries.get(user_id)
+        if entry is not None and entry.secret == secret:
+            return entry
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry.secret != secret:
+                entry = _TotpEntry(secret)
+            # Re-setting refreshes the TTL, so active users keep their replay state.
+            self._entries.set(user_id, entry)
+            return entry
+
+    def verify(self, user_id: int, secret: str, code: str, for_time: Optional[float] = None) -> bool:
+        code = str(code).strip()
+        entry = self._entry(user_id, secret)
+        now = time.time() if for_time is None else for_time
+        current_step = int(now // entry.totp.interval)
+        with entry.lock:
+            for step, expected in entry.codes_around(current_step):
+                if step > entry.last_step and hmac.compare_digest(code, expected):
+                    entry.last_step = step
+                    return True
+        return False
+
+    def forget(self, user_id: int) -> None:
+        self._entries.pop(user_id)
+
+    def stats(self) -> dict:
+        return self._entries.stats()
+
+
+totp_verifiers = TotpVerifierCache(maxsize=int(os.getenv(TOTP_CACHE_SIZE_ENV) or 10000))
+
+
+def verify_totp(secret: str, code: str, user_id: Optional[int] = None) -> bool:
+    """Check a one-time code. With user_id, a code that was already accepted is rejected."""
     if not (secret and code):
         return False
+    if user_id is not None:
+        return totp_verifiers.verify(user_id, secret, code)
     totp = pyotp.TOTP(secret)
-    return totp.verify(code, valid_window=1)
+    return totp.verify(code, valid_window=TOTP_VALID_WINDOW)
@@ -0,0 +1,352 @@
+"""Server-side login sessions.
+
+Login creates a row in user_sessions and hands the browser a token
+"<session id>.<signature>" signed with the session key, so forged tokens are
+rejected without a query. The session key (APP_STORAGE_SECRET, or else
+data/session.key, created on first use) also derives NiceGUI's storage secret.
+It is separate from the app keyring in security.py, so rotating the app key
+logs nobody out and keeps every browser's storage. Each worker keeps resolved sessions (user id,
+username, 2FA flag) in a bounded LRU with a short TTL, so rendering a page does
+not touch SQLite. Revoking a session stamps revoked_at; every worker polls for
+newly revoked ids at most once per REVOCATION_POLL_INTERVAL and drops them from
+its cache, so a logout is honoured everywhere within about a second.
+
+A session can also be unlocked with the master key: the unlock lives in this
+worker's memory with an absolute TTL and an idle timeout, so sensitive actions
+check it in O(1) instead of running bcrypt each time.
+"""
+import hashlib
+import os
+import secrets
+import threading
+import time
+from datetime import datetime, timedelta
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Optional, Sequence, Tuple
+
+from sqlalchemy import DateTime, Row, Select, String, Update, bindparam, select, text, update
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from .cache import TTLCache
+from .db import DATA_DIR, AsyncReadSessionLocal, ReadSessionLocal, async_read_engine, read_engine
+from .models import User, UserSession
+from .security import open_handle, sign_handle
+from .writer import writer
+
+SESSION_LIFETIME_ENV = "APP_SESSION_LIFETIME"
+SESSION_CACHE_SIZE_ENV = "APP_SESSION_CACHE_SIZE"
+SESSION_CACHE_TTL_ENV = "APP_SESSION_CACHE_TTL"
+STORAGE_SECRET_ENV = "APP_STORAGE_SECRET"
+UNLOCK_TTL_ENV = "APP_UNLOCK_TTL"
+UNLOCK_IDLE_TIMEOUT_ENV = "APP_UNLOCK_IDLE_TIMEOUT"
+DEFAULT_SESSION_LIFETIME = 12 * 3600
+REVOCATION_POLL_INTERVAL = 1.0
+
+SESSION_KEY_PATH = DATA_DIR / "session.key"
+
+_HANDLE_SCOPE = "session"
+
+_sessions = TTLCache(
+    maxsize=int(os.getenv(SESSION_CACHE_SIZE_ENV) or 4096),
+    ttl=float(os.getenv(SESSION_CACHE_TTL_ENV) or 60),
+)
+_unlocks = TTLCache(maxsize=int(os.getenv(SESSION_CACHE_SIZE_ENV) or 4096), ttl=float(os.getenv(UNLOCK_TTL_ENV) or 900))
+_unlock_idle_timeout = float(os.getenv(UNLOCK_IDLE_TIMEOUT_ENV) or 300)
+# Bumped when a user's master key changes; unlocks taken under an older epoch no longer count.
+_master_key_epochs: Dict[int, int] = {}
+_revocation_lock = threading.Lock()
+_revocation_state = {"checked_at": 0.0, "since": datetime.utcnow()}
+
+
+@lru_cache(maxsize=None)
+def _file_session_key(path: Path) -> bytes:
+    """The key stored at path, created on first use. Workers starting together all get the first one written."""
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        staged = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        staged.write_bytes(secrets.token_urlsafe(32).encode("ascii"))
+        try:
+            # link() fails if the file exists, so a second worker cannot replace the first key.
+            os.link(staged, path)
+        except FileExistsError:
+            pass
+        finally:
+            staged.unlink()
+    return path.read_bytes().strip()
+
+
+def session_key() -> bytes:
+    """Signs session tokens; unlike the app key it never rotates."""
+    secret = os.getenv(STORAGE_SECRET_ENV)
+    if secret:
+        return hashlib.sha256(b"session:" + secret.encode("utf-8")).digest()
+    return _file_session_key(SESSION_KEY_PATH)
+
+
+def storage_secret() -> str:
+    """Secret for NiceGUI's per-browser storage, which holds the session token."""
+    return os.getenv(STORAGE_SECRET_ENV) or hashlib.sha256(b"storage:" + session_key()).hexdigest()
+
+
+def _session_lifetime() -> timedelta:
+    return timedelta(seconds=int(os.getenv(SESSION_LIFETIME_ENV) or DEFAULT_SESSION_LIFETIME))
+
+
+def _add_session(db: Session, session_id: str, user_id: int, now: datetime, expires_at: datetime) -> Optional[User]:
+    user = db.query(User).filter(User.id == user_id).first()
+    if not user:
+        return None
+    db.add(UserSession(id=session_id, user_id=user_id, created_at=now, expires_at=expires_at))
+    return user
+
+
+def _started(session_id: str, user: Optional[User], expires_at: datetime) -> Optional[str]:
+    if user is None:
+        return None
+    _cache_session(session_id, user, expires_at)
+    return sign_handle(session_id, bound_to=_HANDLE_SCOPE, secret=session_key())
+
+
+def create_session(user_id: int) -> Optional[str]:
+    """Start a session for user_id and return its signed token, or None if the user does not exist."""
+    session_id = secrets.token_urlsafe(24)
+    now = datetime.utcnow()
+    expires_at = now + _session_lifetime()
+    return _started(session_id, writer.run(_add_session, session_id, user_id, now, expires_at), expires_at)
+
+
+async def create_session_async(user_id: int) -> Optional[str]:
+    session_id = secrets.token_urlsafe(24)
+    now = datetime.utcnow()
+    expires_at = now + _session_lifetime()
+    return _started(session_id, await writer.run_async(_add_session, session_id, user_id, now, expires_at), expires_at)
+
+
+def _cache_session(session_id: str, user: User, expires_at: datetime) -> dict:
+    session = {
+        "session_id": session_id,
+        "user_id": user.id,
+        "username": user.username,
+        "is_2fa_enabled": bool(user.is_2fa_enabled),
+        "has_master_key": bool(user.master_key),
+        "expires_at": expires_at,
+    }
+    remaining = (expires_at - datetime.utcnow()).total_seconds()
+    _sessions.set(session_id, session, ttl=min(_sessions.ttl, max(remaining, 0)))
+    return session
+
+
+_REVOCATIONS_QUERY = (
+    text("SELECT id, revoked_at FROM user_sessions WHERE revoked_at >= :since")
+    .bindparams(bindparam("since", type_=DateTime()))
+    .columns(id=String(), revoked_at=DateTime())
+)
+
+
+def _claim_revocation_poll(force: bool) -> Optional[datetime]:
+    """The revoked_at to poll from when a poll is due, else None. At most one caller gets it per interval."""
+    if not force and time.monotonic() - _revocation_state["checked_at"] < REVOCATION_POLL_INTERVAL:
+        return None
+    with _revocation_lock:
+        now = time.monotonic()
+        if not force and now - _revocation_state["checked_at"] < REVOCATION_POLL_INTERVAL:
+            return None
+        _revocation_state["checked_at"] = now
+        return _revocation_state["since"]
+
+
+def _apply_revocations(rows: Sequence[Row]) -> None:
+    for session_id, _revoked_at in rows:
+        _sessions.pop(session_id)
+        _unlocks.pop(session_id)
+    if rows:
+        with _revocation_lock:
+            # >= re-reads rows stamped in the same instant on the next poll; popping twice is harmless.
+            newest = max(revoked_at for _session_id, revoked_at in rows)
+            _revocation_state["since"] = max(_revocation_state["since"], newest)
+
+
+def _sync_revocations(force: bool = False) -> None:
+    """Drop sessions revoked by any worker since the last poll from the local cache."""
+    since = _claim_revocation_poll(force)
+    if since is None:
+        return
+    with read_engine.connect() as connection:
+        rows = connection.execute(_REVOCATIONS_QUERY, {"since": since}).fetchall()
+    _apply_revocations(rows)
+
+
+async def _sync_revocations_async() -> None:
+    since = _claim_revocation_poll(force=False)
+    if since is None:
+        return
+    async with async_read_engine.connect() as connection:
+        rows = (await connection.execute(_REVOCATIONS_QUERY, {"since": since})).fetchall()
+    _apply_revocations(rows)
+
+
+def _from_cache(session_id: str) -> Tuple[bool, Optional[dict]]:
+    """(found, session): a cached session that has since expired is found, and resolves to None."""
+    session = _sessions.get(session_id)
+    if session is None:
+        return False, None
+    if session["expires_at"] > datetime.utcnow():
+        return True, session
+    _sessions.pop(session_id)
+    return True, None
+
+
+def _session_query(session_id: str) -> Select:
+    return (
+        select(UserSession.expires_at, User)
+        .join(User, User.id == UserSession.user_id)
+        .where(
+            UserSession.id == session_id,
+            UserSession.revoked_at.is_(None),
+            UserSession.expires_at > datetime.utcnow(),
+        )
+    )
+
+
+def _cache_row(session_id: str, row: Optional[Row]) -> Optional[dict]:
+    if row is None:
+        return None
+    expires_at, user = row
+    return _cache_session(session_id, user, expires_at)
+
+
+def resolve_session(token: Optional[str]) -> Optional[dict]:
+    """Return the cached identity for a session token, or None when it is invalid, expired or revoked."""
+    session_id = open_handle(token or "", bound_to=_HANDLE_SCOPE, secret=session_key())
+    if not session_id:
+        return None
+
+    _sync_revocations()
+    found, session = _from_cache(session_id)
+    if found:
+        return session
+
+    db = ReadSessionLocal()
+    try:
+        return _cache_row(session_id, db.execute(_session_query(session_id)).first())
+    finally:
+        db.close()
+
+
+async def resolve_session_async(token: Optional[str]) -> Optional[dict]:
+    """resolve_session for event-loop callers: the revocation poll and a cache miss go through aiosqlite."""
+    session_id = open_handle(token or "", bound_to=_HANDLE_SCOPE, secret=session_key())
+    if not session_id:
+        return None
+
+    await _sync_revocations_async()
+    found, session = _from_cache(session_id)
+    if found:
+        return session
+
+    async with AsyncReadSessionLocal() as db:
+        row = (await db.execute(_session_query(session_id))).first()
+    return _cache_row(session_id, row)
+
+
+def _revoke_statement(*criteria) -> Update:
+    return (
+        update(UserSession)
+        .where(*criteria, UserSession.revoked_at.is_(None))
+        .values(revoked_at=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+
+
+def _revoke(db: Session, *criteria) -> int:
+    return db.execute(_revoke_statement(*criteria)).rowcount
+
+
+def _revoked(session_id: str, updated: int) -> bool:
+    _sessions.pop(session_id)
+    _unlocks.pop(session_id)
+    return bool(updated)
+
+
+def revoke_session(token: Optional[str]) -> bool:
+    """Revoke one session (logout). Other workers drop it on their next revocation poll."""
+    session_id = open_handle(token or "", bound_to=_HANDLE_SCOPE, secret=session_key())
+    if not session_id:
+        return False
+    try:
+        return _revoked(session_id, writer.run(_revoke, UserSession.id == session_id))
+    except SQLAlchemyError:
+        return False
+
+
+async def revoke_session_async(token: Optional[str]) -> bool:
+    session_id = open_handle(token or "", bound_to=_HANDLE_SCOPE, secret=session_key())
+    if not session_id:
+        return False
+    try:
+        return _revoked(session_id, await writer.run_async(_revoke, UserSession.id == session_id))
+    except SQLAlchemyError:
+        return False
+
+
+def revoke_user_sessions(user_id: int) -> int:
+    """Revoke every active session of a user, e.g. after a credential change."""
+    updated = writer.run(_revoke, UserSession.user_id == user_id)
+    _sync_revocations(force=True)
+    lock_master_key(user_id)
+    return updated
+
+
+def forget_user_sessions(user_id: int) -> None:
+    """Drop a user's sessions from this worker's cache so changed flags are re-read."""
+    _sessions.discard_where(lambda session: session["user_id"] == user_id)
+
+
+def _delete_expired(db: Session, now: datetime, cutoff: datetime) -> int:
+    return (
+        db.query(UserSession)
+        .filter((UserSession.expires_at < now) | (UserSession.revoked_at < cutoff))
+        .delete(synchronize_session=False)
+    )
+
+
+def purge_expired_sessions() -> int:
+    """Delete sessions that expired or were revoked more than a session lifetime ago."""
+    now = datetime.utcnow()
+    return writer.run(_delete_expired, now, now - _session_lifetime())
+
+
+def mark_unlocked(session_id: str, user_id: int) -> None:
+    """Mark a session unlocked after its master key was verified."""
+    _unlocks.set(
+        session_id,
+        {"user_id": user_id, "epoch": _master_key_epochs.get(user_id, 0), "last_used": time.monotonic()},
+    )
+
+
+def is_unlocked(session_id: str) -> bool:
+    """True while the session's unlock is within its TTL and idle timeout; each check counts as activity."""
+    entry = _unlocks.get(session_id)
+    if entry is None:
+        return False
+    now = time.monotonic()
+    if entry["epoch"] != _master_key_epochs.get(entry["user_id"], 0) or now - entry["last_used"] > _unlock_idle_timeout:
+        _unlocks.pop(session_id)
+        return False
+    entry["last_used"] = now
+    return True
+
+
+def lock_session(session_id: str) -> None:
+    _unlocks.pop(session_id)
+
+
+def lock_master_key(user_id: int) -> None:
+    """Drop every unlock of a user, e.g. because the master key changed."""
+    _master_key_epochs[user_id] = _master_key_epochs.get(user_id, 0) + 1
+
+
+def cache_stats() -> dict:
+    return {"sessions": _sessions.stats(), "unlocks": _unlocks.stats()}
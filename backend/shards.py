@@ -0,0 +1,288 @@
+"""Optional hash-sharded storage for credentials and keys.
+
+With APP_DB_SHARDS=N (N > 1) the credentials and keys tables live in N SQLite
+files in APP_DB_SHARD_DIR (data/shards by default). Each user's rows go to the
+file picked by a jump consistent hash of the user id. Every shard has its own
+engines, read pools and writer thread, so writes of users on different shards
+commit in parallel instead of queueing for the one app.db write lock. Users,
+sessions and data keys stay in app.db. Shard files are brought up to date on
+first use by the same versioned migrations as app.db (see migrations/), limited
+to the sharded tables, and keep their own schema_version. They enforce no
+foreign keys, since the users table lives in app.db.
+
+Some guarantees hold per file only: credential and key ids, and the unique
+key_value of keys, are unique within one storage file, not across shards. All
+lookups go by user and a user's rows share one file, so that is enough for the
+app, but nothing may assume a key_value is unique app-wide. The ORM cascade from
+User cannot reach other files either: deleting a user goes through
+delete_user_rows() (see auth.delete_user).
+
+Service code takes a user's storage from for_user(). With sharding off that is
+app.db's own engines and writer, so call sites look the same in both modes.
+
+Changing N, or turning sharding on or off for a database that already has rows,
+needs a rebalance with the app stopped. Thanks to the jump hash, going from N
+to N+1 shards moves only about 1/(N+1) of the users:
+
+    python -m backend.shards                # rows per storage
+    python -m backend.shards --rebalance [--dry-run]
+"""
+import argparse
+import atexit
+import hashlib
+import logging
+import os
+import threading
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Union
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+
+from .db import DATA_DIR, DATABASE_PATH, async_read_engine, create_engines, engine, read_engine
+from .migrations import migrate
+from .models import Credential, Key
+from .writer import WriteQueue, writer
+
+logger = logging.getLogger(__name__)
+
+SHARDS_ENV = "APP_DB_SHARDS"
+SHARD_DIR_ENV = "APP_DB_SHARD_DIR"
+DEFAULT_SHARD_DIR = DATA_DIR / "shards"
+DEFAULT_REBALANCE_BATCH = 100
+SHARDED_TABLES = (Credential.__table__, Key.__table__)
+# What identifies a row of a user apart from its id; unique in every storage.
+NATURAL_KEYS = {"credentials": ("user_id", "title"), "keys": ("user_id", "key_value")}
+# Stays well below SQLite's limit on bound parameters per statement.
+_ID_CHUNK = 500
+
+
+class Storage:
+    """A SQLite file holding the credentials and keys of some users, with its engines and writer."""
+
+    def __init__(
+        self,
+        name: str,
+        path: Path,
+        write_engine: Engine,
+        read_only_engine: Engine,
+        async_read_only_engine: AsyncEngine,
+        write_queue: WriteQueue,
+    ):
+        self.name = name
+        self.path = path
+        self.engine = write_engine
+        self.writer = write_queue
+        self.read_session = sessionmaker(autocommit=False, autoflush=False, bind=read_only_engine)
+        self.async_read_session = async_sessionmaker(async_read_only_engine, autoflush=False, expire_on_commit=False)
+
+    def __repr__(self) -> str:
+        return f"Storage({self.name!r})"
+
+
+main_storage = Storage("app", DATABASE_PATH, engine, read_engine, async_read_engine, writer)
+
+
+def shard_count() -> int:
+    return max(int(os.getenv(SHARDS_ENV) or 1), 1)
+
+
+def shard_dir() -> Path:
+    return Path(os.getenv(SHARD_DIR_ENV) or DEFAULT_SHARD_DIR)
+
+
+def shard_path(index: int, directory: Optional[Path] = None) -> Path:
+    return (directory or shard_dir()) / f"shard-{index:03d}.db"
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    """Jump consistent hash (Lamping and Veach): growing buckets by one moves only 1/buckets of the keys."""
+    key &= 0xFFFFFFFFFFFFFFFF
+    bucket, candidate = -1, 0
+    while candidate < buckets:
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def shard_index(user_id: int, count: int) -> int:
+    # User ids are sequential; mix them first so neighbours spread over the shards.
+    key = int.from_bytes(hashlib.blake2b(str(user_id).encode(), digest_size=8).digest(), "big")
+    return jump_hash(key, count)
+
+
+def open_storage(path: Path, name: Optional[str] = None, **pragmas: Union[int, str]) -> Storage:
+    """Engines and a writer for one shard file; creates the file and migrates its tables if needed."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    write, read, async_read = create_engines(path, **{"foreign_keys": "OFF", **pragmas})
+    migrate(bind=write, tables=[table.name for table in SHARDED_TABLES])
+    name = name or path.stem
+    storage = Storage(name, path, write, read, async_read, WriteQueue(bind=write, name=f"db-writer-{name}"))
+    atexit.register(storage.writer.shutdown)
+    return storage
+
+
+_SHARD_COUNT = shard_count()
+_shards: Dict[int, Storage] = {}
+_shards_lock = threading.Lock()
+
+
+def shard(index: int) -> Storage:
+    storage = _shards.get(index)
+    if storage is None:
+        with _shards_lock:
+            storage = _shards.get(index)
+            if storage is None:
+                storage = _shards[index] = open_storage(shard_path(index))
+    return storage
+
+
+def for_user(user_id: int) -> Storage:
+    """Where the user's credentials and keys are read and written."""
+    if _SHARD_COUNT <= 1:
+        return main_storage
+    return shard(shard_index(user_id, _SHARD_COUNT))
+
+
+def storages() -> List[Storage]:
+    """Every storage of the configured layout, e.g. for maintenance jobs that walk all credentials."""
+    if _SHARD_COUNT <= 1:
+        return [main_storage]
+    return [shard(index) for index in range(_SHARD_COUNT)]
+
+
+def _locations() -> List[Storage]:
+    """app.db and every shard file on disk, including ones a smaller shard count no longer uses."""
+    found = [main_storage]
+    for path in sorted(shard_dir().glob("shard-*.db")):
+        index = path.stem.partition("-")[2]
+        if index.isdigit():
+            found.append(shard(int(index)))
+    return found
+
+
+def counts() -> Dict[str, Dict[str, int]]:
+    """Rows per table in every location."""
+    result = {}
+    for storage in _locations():
+        with storage.engine.connect() as connection:
+            result[storage.name] = {
+                table.name: connection.execute(select(func.count()).select_from(table)).scalar() or 0
+                for table in SHARDED_TABLES
+            }
+    return result
+
+
+def _delete_rows(db: Session, user_id: int) -> Dict[str, int]:
+    return {table.name: db.execute(delete(table).where(table.c.user_id == user_id)).rowcount for table in SHARDED_TABLES}
+
+
+def delete_user_rows(user_id: int, locations: Optional[Sequence[Storage]] = None) -> Dict[str, int]:
+    """Delete a user's credentials and keys from every storage file, not just the one for_user() picks.
+
+    Rows left in an old location by an interrupted rebalance go too. Returns rows deleted per table.
+    """
+    deleted: Dict[str, int] = defaultdict(int)
+    for storage in locations or _locations():
+        for table, rows in storage.writer.run(_delete_rows, user_id).items():
+            deleted[table] += rows
+    return dict(deleted)
+
+
+def _chunks(items: Sequence, size: int) -> Iterator[Sequence]:
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+def _move(source: Storage, target: Storage, user_ids: List[int]) -> Dict[str, int]:
+    """Copy the users' rows to target, then delete exactly the copied rows from source.
+
+    Ids are kept so links and handles stay valid; a row whose id is taken in target by
+    another user's row gets a new one. Rows target already has (same user and title or
+    key value, left by an interrupted run) are not copied again, so a rebalance can
+    simply be rerun. Any other conflict rolls the batch back and nothing is deleted.
+    """
+    moved = {"renumbered": 0}
+    with source.engine.connect() as connection:
+        rows = {
+            table.name: [dict(row) for row in connection.execute(select(table).where(table.c.user_id.in_(user_ids))).mappings()]
+            for table in SHARDED_TABLES
+        }
+
+    with target.engine.begin() as connection:
+        for table in SHARDED_TABLES:
+            natural_key = [table.c[name] for name in NATURAL_KEYS[table.name]]
+            present = set(connection.execute(select(*natural_key).where(table.c.user_id.in_(user_ids))).all())
+            pending = [row for row in rows[table.name] if tuple(row[name] for name in NATURAL_KEYS[table.name]) not in present]
+            taken = set()
+            for ids in _chunks([row["id"] for row in pending], _ID_CHUNK):
+                taken.update(connection.execute(select(table.c.id).where(table.c.id.in_(ids))).scalars())
+            keep_id = [row for row in pending if row["id"] not in taken]
+            new_id = [{name: value for name, value in row.items() if name != "id"} for row in pending if row["id"] in taken]
+            try:
+                if keep_id:
+                    connection.execute(insert(table), keep_id)
+                if new_id:
+                    connection.execute(insert(table), new_id)
+            except IntegrityError as exc:
+                raise RuntimeError(f"Cannot move {table.name} of users {user_ids[0]}..{user_ids[-1]} to {target.name}: {exc.orig}") from exc
+            if new_id:
+                logger.warning("%d %s rows got new ids in %s: their ids were taken", len(new_id), table.name, target.name)
+            moved[table.name] = len(rows[table.name])
+            moved["renumbered"] += len(new_id)
+
+    with source.engine.begin() as connection:
+        for table in SHARDED_TABLES:
+            for ids in _chunks([row["id"] for row in rows[table.name]], _ID_CHUNK):
+                connection.execute(delete(table).where(table.c.id.in_(ids)))
+    return moved
+
+
+def rebalance(batch_users: int = DEFAULT_REBALANCE_BATCH, dry_run: bool = False) -> Dict[str, int]:
+    """Move every user's rows to the storage for_user() picks under the current configuration."""
+    totals: Dict[str, int] = defaultdict(int)
+    for source in _locations():
+        with source.engine.connect() as connection:
+            user_ids = sorted(
+                {user_id for table in SHARDED_TABLES for (user_id,) in connection.execute(select(table.c.user_id).distinct())}
+            )
+        by_target: Dict[str, List[int]] = defaultdict(list)
+        targets = {}
+        for user_id in user_ids:
+            target = for_user(user_id)
+            if target is not source:
+                by_target[target.name].append(user_id)
+                targets[target.name] = target
+        for name, misplaced in by_target.items():
+            logger.info("%s -> %s: %d users", source.name, name, len(misplaced))
+            totals["users"] += len(misplaced)
+            if dry_run:
+                continue
+            for batch in _chunks(misplaced, batch_users):
+                for key, value in _move(source, targets[name], list(batch)).items():
+                    totals[key] += value
+    return dict(totals)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Show or rebalance sharded credential storage.")
+    parser.add_argument("--rebalance", action="store_true", help=f"move rows to the shards {SHARDS_ENV} asks for")
+    parser.add_argument("--dry-run", action="store_true", help="only report how many users would move")
+    parser.add_argument("--batch-users", type=int, default=DEFAULT_REBALANCE_BATCH, help="users moved per transaction")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    logger.info("%s=%d, shard directory %s", SHARDS_ENV, _SHARD_COUNT, shard_dir())
+    if args.rebalance or args.dry_run:
+        logger.info("Rebalance%s: %s", " (dry run)" if args.dry_run else "", rebalance(args.batch_users, args.dry_run))
+    for name, tables in counts().items():
+        print(f"{name:<12} " + "  ".join(f"{table} {rows:>9}" for table, rows in tables.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+"""Runtime SQL statistics for the SQLAlchemy engines.
+
+Every statement is timed between before_cursor_execute and after_cursor_execute
+and recorded under its normalized text (literals and IN-lists collapsed) in a
+latency histogram. Statements slower than APP_SQL_SLOW_MS are logged and kept in
+a short ring buffer. Code wrapped in query_scope() (each HTTP request, a
+dashboard render) also gets its queries counted; a scope that runs the same
+statement APP_SQL_N_PLUS_ONE times or more is reported as a likely N+1.
+
+Parameters are never recorded: they hold password hashes and ciphertext.
+
+    from backend import sql_stats
+    sql_stats.snapshot()            # statements, slow queries, scopes, N+1 reports
+    sql_stats.dump("sql-stats.json")
+
+With APP_SQL_STATS_FILE set the snapshot is also written there on exit;
+APP_SQL_STATS=0 turns the hooks off.
+"""
+import atexit
+import bisect
+import contextvars
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Iterator, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+SQL_STATS_ENV = "APP_SQL_STATS"
+SQL_STATS_FILE_ENV = "APP_SQL_STATS_FILE"
+SQL_SLOW_MS_ENV = "APP_SQL_SLOW_MS"
+SQL_N_PLUS_ONE_ENV = "APP_SQL_N_PLUS_ONE"
+DEFAULT_SLOW_MS = 100.0
+DEFAULT_N_PLUS_ONE = 5
+SLOW_LOG_SIZE = 200
+N_PLUS_ONE_LOG_SIZE = 200
+
+# Histogram bucket upper bounds in milliseconds; the last bucket is everything above.
+BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_IN_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACES = re.compile(r"\s+")
+_STARTED = "_sql_stats_started"
+# Every writer operation runs in its own savepoint; repeating those is not an N+1.
+_TRANSACTION_CONTROL = ("SAVEPOINT", "RELEASE", "ROLLBACK", "BEGIN", "COMMIT")
+
+
+def normalize(statement: str) -> str:
+    """One key per statement shape: literals become ?, IN (?, ?, ...) becomes IN (?...)."""
+    statement = _LITERALS.sub("?", statement)
+    statement = _IN_LISTS.sub("(?...)", statement)
+    return _SPACES.sub(" ", statement).strip()
+
+
+class Histogram:
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+
+    def add(self, elapsed_ms: float) -> None:
+        self.count += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        self.buckets[bisect.bisect_left(BUCKETS_MS, elapsed_ms)] += 1
+
+    def percentile(self, fraction: float) -> float:
+        """Upper bound of the bucket holding the given fraction of samples (the max for the last one)."""
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for index, hits in enumerate(self.buckets):
+            seen += hits
+            if seen >= rank:
+                return BUCKETS_MS[index] if index < len(BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+    def as_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "total_ms": round(self.total_ms, 3),
+            "mean_ms": round(self.total_ms / self.count, 3) if self.count else 0.0,
+            "p50_ms": self.percentile(0.5),
+            "p95_ms": self.percentile(0.95),
+            "p99_ms": self.percentile(0.99),
+            "max_ms": round(self.max_ms, 3),
+            "buckets": dict(zip([*map(str, BUCKETS_MS), "inf"], self.buckets)),
+        }
+
+
+class QueryScope:
+    """Queries run inside one query_scope() block."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.queries = 0
+        self.statements: Counter = Counter()
+
+
+_scope: contextvars.ContextVar[Optional[QueryScope]] = contextvars.ContextVar("sql_stats_scope", default=None)
+
+
+class SqlStats:
+    def __init__(self, slow_ms: Optional[float] = None, n_plus_one: Optional[int] = None):
+        self.slow_ms = slow_ms or float(os.getenv(SQL_SLOW_MS_ENV) or DEFAULT_SLOW_MS)
+        self.n_plus_one = n_plus_one or int(os.getenv(SQL_N_PLUS_ONE_ENV) or DEFAULT_N_PLUS_ONE)
+        self._lock = threading.Lock()
+        self._statements: Dict[str, Histogram] = {}
+        self._scopes: Dict[str, dict] = {}
+        self._slow: deque = deque(maxlen=SLOW_LOG_SIZE)
+        self._n_plus_one: deque = deque(maxlen=N_PLUS_ONE_LOG_SIZE)
+        self.started_at = datetime.utcnow()
+
+    def record(self, statement: str, elapsed_ms: float, executemany: bool = False) -> None:
+        key = normalize(statement)
+        with self._lock:
+            histogram = self._statements.get(key)
+            if histogram is None:
+                histogram = self._statements[key] = Histogram()
+            histogram.add(elapsed_ms)
+        scope = _scope.get()
+        if scope is not None:
+            scope.queries += 1
+            scope.statements[key] += 1
+        if elapsed_ms >= self.slow_ms:
+            entry = {
+                "at": datetime.utcnow().isoformat(sep=" ", timespec="milliseconds"),
+                "ms": round(elapsed_ms, 3),
+                "statement": key,
+                "executemany": executemany,
+                "scope": scope.name if scope else None,
+            }
+            self._slow.append(entry)
+            logger.warning("Slow SQL (%.1f ms%s): %s", elapsed_ms, f", {scope.name}" if scope else "", key)
+
+    def close_scope(self, scope: QueryScope) -> None:
+        with self._lock:
+            totals = self._scopes.get(scope.name)
+            if totals is None:
+                totals = self._scopes[scope.name] = {"count": 0, "queries": 0, "max_queries": 0}
+            totals["count"] += 1
+            totals["queries"] += scope.queries
+            totals["max_queries"] = max(totals["max_queries"], scope.queries)
+        repeated = {
+            statement: hits
+            for statement, hits in scope.statements.items()
+            if hits >= self.n_plus_one and not statement.upper().startswith(_TRANSACTION_CONTROL)
+        }
+        for statement, hits in repeated.items():
+            self._n_plus_one.append(
+                {
+                    "at": datetime.utcnow().isoformat(sep=" ", timespec="milliseconds"),
+                    "scope": scope.name,
+                    "statement": statement,
+                    "executions": hits,
+                    "scope_queries": scope.queries,
+                }
+            )
+            logger.warning("Likely N+1 in %s: %d executions of %s", scope.name, hits, statement)
+
+    def snapshot(self, limit: Optional[int] = None) -> dict:
+        """Everything recorded so far; statements sorted by total time, optionally only the top `limit`."""
+        with self._lock:
+            statements = sorted(self._statements.items(), key=lambda item: item[1].total_ms, reverse=True)
+            statements = [{"statement": key, **histogram.as_dict()} for key, histogram in statements[:limit]]
+            scopes = {
+                name: {**totals, "mean_queries": round(totals["queries"] / totals["count"], 2)}
+                for name, totals in self._scopes.items()
+            }
+        return {
+            "since": self.started_at.isoformat(sep=" ", timespec="seconds"),
+            "slow_ms": self.slow_ms,
+            "statements": statements,
+            "slow_queries": list(self._slow),
+            "scopes": scopes,
+            "n_plus_one": list(self._n_plus_one),
+        }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._statements.clear()
+            self._scopes.clear()
+            self._slow.clear()
+            self._n_plus_one.clear()
+            self.started_at = datetime.utcnow()
+
+
+sql_stats = SqlStats()
+
+
+def _before_cursor_execute(_conn, _cursor, _statement, _parameters, context, _executemany) -> None:
+    setattr(context, _STARTED, time.perf_counter())
+
+
+def _after_cursor_execute(_conn, _cursor, statement, _parameters, context, executemany) -> None:
+    started = getattr(context, _STARTED, None)
+    if started is not None:
+        sql_stats.record(statement, (time.perf_counter() - started) * 1000, executemany)
+
+
+def enabled() -> bool:
+    return (os.getenv(SQL_STATS_ENV) or "1").lower() not in ("0", "false", "off", "no")
+
+
+def instrument(*engines: Engine) -> None:
+    """Attach the timing hooks to sync engines (for an AsyncEngine pass its sync_engine)."""
+    if not enabled():
+        return
+    for engine in engines:
+        if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+            event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+            event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+@contextmanager
+def query_scope(name: str) -> Iterator[QueryScope]:
+    """Count the queries of one unit of work. Nested scopes count towards the innermost one only."""
+    scope = QueryScope(name)
+    token = _scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _scope.reset(token)
+        sql_stats.close_scope(scope)
+
+
+def snapshot(limit: Optional[int] = None) -> dict:
+    return sql_stats.snapshot(limit)
+
+
+def reset() -> None:
+    sql_stats.reset()
+
+
+def dump(path: str, limit: Optional[int] = None) -> str:
+    """Write snapshot() as JSON to path; returns the path."""
+    with open(path, "w", encoding="utf-8") as stats_file:
+        json.dump(snapshot(limit), stats_file, ensure_ascii=False, indent=2)
+    return path
+
+
+def _dump_on_exit() -> None:
+    path = os.getenv(SQL_STATS_FILE_ENV)
+    if path and sql_stats.snapshot(limit=1)["statements"]:
+        dump(path)
+
+
+atexit.register(_dump_on_exit)
@@ -0,0 +1,119 @@
+"""Login throttling ahead of the password hash.
+
+Every login attempt is counted in two sliding windows, one per username and one
+per client IP. An attempt over either limit is rejected before bcrypt runs, so
+a credential-stuffing burst costs a dict lookup instead of a hash. Windows live
+in TTLCaches: idle keys expire after one window and the number of tracked keys
+is capped, so memory stays bounded whatever the attacker sends.
+"""
+import math
+import os
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, Hashable, Optional
+
+from .cache import TTLCache
+
+LOGIN_LIMIT_PER_USER_ENV = "APP_LOGIN_LIMIT_PER_USER"
+LOGIN_LIMIT_PER_IP_ENV = "APP_LOGIN_LIMIT_PER_IP"
+LOGIN_LIMIT_WINDOW_ENV = "APP_LOGIN_LIMIT_WINDOW"
+DEFAULT_LIMIT_PER_USER = 10
+DEFAULT_LIMIT_PER_IP = 50
+DEFAULT_WINDOW = 300.0
+MAX_TRACKED_KEYS = 100_000
+
+
+class SlidingWindowLimiter:
+    """Allow at most limit hits per key within any window-second span."""
+
+    def __init__(
+        self,
+        limit: int,
+        window: float,
+        maxsize: int = MAX_TRACKED_KEYS,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.limit = limit
+        self.window = window
+        self._clock = clock
+        self._hits = TTLCache(maxsize=maxsize, ttl=window, clock=clock)
+        self._lock = threading.Lock()
+
+    def _recent(self, key: Hashable, now: float) -> deque:
+        hits = self._hits.get(key)
+        if hits is None:
+            return deque()
+        while hits and hits[0] <= now - self.window:
+            hits.popleft()
+        return hits
+
+    def retry_after(self, key: Hashable) -> float:
+        """Seconds until key may hit again; 0 when it may hit now. Records nothing."""
+        now = self._clock()
+        with self._lock:
+            hits = self._recent(key, now)
+            if len(hits) < self.limit:
+                return 0.0
+            return hits[0] + self.window - now
+
+    def hit(self, key: Hashable) -> None:
+        now = self._clock()
+        with self._lock:
+            hits = self._recent(key, now)
+            hits.append(now)
+            # Re-setting restarts the TTL: the entry lives exactly as long as its newest hit matters.
+            self._hits.set(key, hits)
+
+    def reset(self, key: Hashable) -> None:
+        self._hits.pop(key)
+
+    def stats(self) -> dict:
+        return {"limit": self.limit, "window": self.window, **self._hits.stats()}
+
+
+class LoginThrottle:
+    """Per-username and per-IP login limits, checked together."""
+
+    def __init__(self, per_user: Optional[int] = None, per_ip: Optional[int] = None, window: Optional[float] = None):
+        window = window or float(os.getenv(LOGIN_LIMIT_WINDOW_ENV) or DEFAULT_WINDOW)
+        self.users = SlidingWindowLimiter(per_user or int(os.getenv(LOGIN_LIMIT_PER_USER_ENV) or DEFAULT_LIMIT_PER_USER), window)
+        self.ips = SlidingWindowLimiter(per_ip or int(os.getenv(LOGIN_LIMIT_PER_IP_ENV) or DEFAULT_LIMIT_PER_IP), window)
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.rejected_user = 0
+        self.rejected_ip = 0
+
+    def acquire(self, username: str, client_ip: Optional[str] = None) -> int:
+        """Count one attempt. Returns 0 if it may proceed, else whole seconds to wait (nothing is counted)."""
+        user_key = username.casefold()
+        with self._lock:
+            user_wait = self.users.retry_after(user_key)
+            ip_wait = self.ips.retry_after(client_ip) if client_ip else 0.0
+            if user_wait or ip_wait:
+                if user_wait:
+                    self.rejected_user += 1
+                else:
+                    self.rejected_ip += 1
+                return max(1, math.ceil(max(user_wait, ip_wait)))
+            self.users.hit(user_key)
+            if client_ip:
+                self.ips.hit(client_ip)
+            self.allowed += 1
+            return 0
+
+    def succeeded(self, username: str) -> None:
+        """A complete login (password plus TOTP code if enabled) clears the user's own failures."""
+        self.users.reset(username.casefold())
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "allowed": self.allowed,
+            "rejected_user": self.rejected_user,
+            "rejected_ip": self.rejected_ip,
+            "users": self.users.stats(),
+            "ips": self.ips.stats(),
+        }
+
+
+login_throttle = LoginThrottle()
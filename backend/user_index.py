@@ -0,0 +1,179 @@
+"""In-process existence filter for usernames and emails.
+
+A Bloom filter over every username and email lets signup and login skip SQLite
+for names that definitely do not exist; a small negative cache covers the Bloom
+false positives that the DB has already confirmed missing. start() loads the
+filter from users in id order; a background thread then keeps it current by
+reading only rows with a higher id every SYNC_INTERVAL, so accounts created by
+another worker show up within about a second. Lookups never touch SQLite, so
+async login and signup can call them on the event loop. An index that was never
+loaded, or has not synced for STALE_AFTER seconds, answers "ask the DB".
+Usernames never change; a changed email only leaves a stale bit behind, which
+costs a false positive, never a wrong answer.
+"""
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+from typing import Iterable, Optional
+
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+
+from .cache import TTLCache
+from .db import engine
+
+logger = logging.getLogger(__name__)
+
+USER_INDEX_FALSE_POSITIVE_RATE = 0.01
+USER_INDEX_MIN_CAPACITY = 10_000
+NEGATIVE_CACHE_SIZE_ENV = "APP_NEGATIVE_CACHE_SIZE"
+NEGATIVE_CACHE_TTL = 60.0
+SYNC_INTERVAL = 1.0
+STALE_AFTER = 5 * SYNC_INTERVAL
+SYNC_BATCH_SIZE = 5000
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter using double hashing over one blake2b digest."""
+
+    def __init__(self, capacity: int, error_rate: float = USER_INDEX_FALSE_POSITIVE_RATE):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value: str) -> Iterable[int]:
+        digest = hashlib.blake2b(value.encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return ((first + i * second) % self.size for i in range(self.hash_count))
+
+    def add(self, value: str) -> None:
+        for position in self._positions(value):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+
+class UserIndex:
+    """Answers "might this username/email exist?" without a query when the answer is no."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._missing = TTLCache(maxsize=int(os.getenv(NEGATIVE_CACHE_SIZE_ENV) or 10_000), ttl=NEGATIVE_CACHE_TTL)
+        self._usernames = BloomFilter(USER_INDEX_MIN_CAPACITY)
+        self._emails = BloomFilter(USER_INDEX_MIN_CAPACITY)
+        self._last_id = 0
+        self._synced_at = 0.0
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        # Bumped on every add, so a DB miss observed before a concurrent insert is not cached.
+        self.generation = 0
+        self.skipped_queries = 0
+
+    def _add(self, username: Optional[str], email: Optional[str], usernames=None, emails=None) -> None:
+        self.generation += 1
+        if username:
+            (usernames or self._usernames).add(username)
+            self._missing.pop(("username", username))
+        if email:
+            (emails or self._emails).add(email)
+            self._missing.pop(("email", email))
+
+    def sync(self, force: bool = False) -> None:
+        """Load users created since the last sync; the first call loads them all."""
+        if not force and time.monotonic() - self._synced_at < SYNC_INTERVAL:
+            return
+        with self._lock:
+            if not force and time.monotonic() - self._synced_at < SYNC_INTERVAL:
+                return
+            with engine.connect() as connection:
+                if self._last_id == 0:
+                    # Full (re)load into fresh filters, swapped in only once complete.
+                    total = connection.execute(text("SELECT COUNT(*) FROM users")).scalar() or 0
+                    capacity = max(USER_INDEX_MIN_CAPACITY, total * 2)
+                    usernames, emails = BloomFilter(capacity), BloomFilter(capacity)
+                else:
+                    usernames, emails = self._usernames, self._emails
+                last_id = self._last_id
+                while True:
+                    rows = connection.execute(
+                        text("SELECT id, username, email FROM users WHERE id > :last_id ORDER BY id LIMIT :limit"),
+                        {"last_id": last_id, "limit": SYNC_BATCH_SIZE},
+                    ).fetchall()
+                    for _user_id, username, email in rows:
+                        self._add(username, email, usernames, emails)
+                    if rows:
+                        last_id = rows[-1][0]
+                    if len(rows) < SYNC_BATCH_SIZE:
+                        break
+            self._usernames, self._emails, self._last_id = usernames, emails, last_id
+            self._synced_at = time.monotonic()
+            if usernames.count > usernames.capacity:
+                # Past capacity the false-positive rate climbs: the next sync rebuilds at double size.
+                self._last_id = 0
+
+    def start(self) -> None:
+        """Load the index now and keep it current from a background thread."""
+        self.sync(force=True)
+        if self._thread is None or not self._thread.is_alive():
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="user-index-sync", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(SYNC_INTERVAL):
+            try:
+                self.sync(force=True)
+            except SQLAlchemyError:
+                # Lookups fall back to the DB once the index is STALE_AFTER old; keep retrying.
+                logger.exception("User index sync failed")
+
+    def shutdown(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def added(self, username: Optional[str] = None, email: Optional[str] = None) -> None:
+        """Record a user (or a new email) written by this worker."""
+        with self._lock:
+            self._add(username, email)
+
+    def definitely_missing(self, kind: str, value: str) -> bool:
+        """True when no user has this username/email; False means "ask the DB". Memory only."""
+        if not value:
+            return True
+        if not self._synced_at or time.monotonic() - self._synced_at > STALE_AFTER:
+            return False
+        bloom = self._usernames if kind == "username" else self._emails
+        if value not in bloom or (kind, value) in self._missing:
+            self.skipped_queries += 1
+            return True
+        return False
+
+    def confirmed_missing(self, kind: str, value: str, generation: int) -> None:
+        """The DB found nothing for a Bloom hit: remember it so repeats skip the DB.
+
+        generation is the value read before the query; if users were added since, nothing is cached.
+        """
+        with self._lock:
+            if value and generation == self.generation:
+                self._missing.set((kind, value), True)
+
+    def stats(self) -> dict:
+        return {
+            "users": self._usernames.count,
+            "capacity": self._usernames.capacity,
+            "skipped_queries": self.skipped_queries,
+            "negative_cache": self._missing.stats(),
+        }
+
+
+user_index = UserIndex()
@@ -0,0 +1,166 @@
+"""Single writer thread with group commit.
+
+SQLite allows one writer at a time, so instead of every request opening its own
+session and fighting over the file lock, write operations are queued to one
+thread. It takes everything waiting in the queue (up to APP_WRITE_GROUP_SIZE),
+runs each operation in its own SAVEPOINT inside one BEGIN IMMEDIATE transaction
+and commits the group once: many small writes per commit, and one failing
+operation only rolls back itself. Callers get the operation's result, or its
+exception, through a Future that resolves after the group has committed, so a
+result seen by the caller is always durable and visible to later reads.
+
+An operation is a function taking a Session as its first argument. It runs on
+the writer thread, so it must only touch the database: encryption, hashing and
+anything else slow belongs in the caller before submit. It must not submit to
+the writer itself.
+"""
+import asyncio
+import atexit
+import contextvars
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, List, Optional, Tuple, TypeVar
+
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from .db import engine
+
+logger = logging.getLogger(__name__)
+
+WRITE_GROUP_SIZE_ENV = "APP_WRITE_GROUP_SIZE"
+DEFAULT_GROUP_SIZE = 64
+
+T = TypeVar("T")
+
+_Item = Tuple[Future, contextvars.Context, Callable[..., Any], tuple, dict]
+
+
+class WriteQueue:
+    def __init__(self, max_group: Optional[int] = None, bind: Optional[Engine] = None, name: str = "db-writer"):
+        self.max_group = max_group or int(os.getenv(WRITE_GROUP_SIZE_ENV) or DEFAULT_GROUP_SIZE)
+        self.bind = bind if bind is not None else engine
+        self.name = name
+        self._queue: "queue.SimpleQueue[Optional[_Item]]" = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.operations = 0
+        self.commits = 0
+        self.failed_commits = 0
+
+    def _ensure_thread(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                    self._thread.start()
+
+    def submit(self, operation: Callable[..., T], *args, **kwargs) -> "Future[T]":
+        """Queue operation(session, *args, **kwargs); the Future resolves once its group has committed."""
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("A write operation cannot submit to the writer it runs on")
+        future: "Future[T]" = Future()
+        self._ensure_thread()
+        # The caller's context goes along, so e.g. sql_stats.query_scope() also counts the writes.
+        self._queue.put((future, contextvars.copy_context(), operation, args, kwargs))
+        return future
+
+    def run(self, operation: Callable[..., T], *args, **kwargs) -> T:
+        """submit and wait for the result."""
+        return self.submit(operation, *args, **kwargs).result()
+
+    async def run_async(self, operation: Callable[..., T], *args, **kwargs) -> T:
+        return await asyncio.wrap_future(self.submit(operation, *args, **kwargs))
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            group = [item]
+            stop = False
+            while len(group) < self.max_group:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                group.append(item)
+            self._commit_group(group)
+            if stop:
+                return
+
+    def _commit_group(self, group: List[_Item]) -> None:
+        outcomes = []
+        try:
+            with self.bind.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+                connection.exec_driver_sql("BEGIN IMMEDIATE")
+                try:
+                    for future, context, operation, args, kwargs in group:
+                        if not future.set_running_or_notify_cancel():
+                            continue
+                        outcomes.append((future, *context.run(self._apply, connection, operation, args, kwargs)))
+                except BaseException:
+                    connection.exec_driver_sql("ROLLBACK")
+                    raise
+                connection.exec_driver_sql("COMMIT")
+        except Exception as exc:  # pylint: disable=broad-except
+            # BEGIN or COMMIT failed (e.g. another process held the lock past busy_timeout): nothing was written.
+            self.failed_commits += 1
+            logger.exception("Write group of %d operations failed", len(group))
+            for future, *_ in group:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+
+        self.commits += 1
+        self.operations += len(outcomes)
+        for future, ok, value in outcomes:
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    @staticmethod
+    def _apply(connection, operation: Callable[..., Any], args: tuple, kwargs: dict) -> Tuple[bool, Any]:
+        session = Session(
+            bind=connection,
+            autoflush=False,
+            expire_on_commit=False,
+            join_transaction_mode="create_savepoint",
+        )
+        try:
+            result = operation(session, *args, **kwargs)
+            session.commit()
+            return True, result
+        except Exception as exc:  # pylint: disable=broad-except
+            session.rollback()
+            return False, exc
+        finally:
+            session.close()
+
+    def shutdown(self) -> None:
+        """Finish everything already queued and stop the thread."""
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            self._queue.put(None)
+            thread.join(timeout=10)
+        self._thread = None
+
+    def stats(self) -> dict:
+        return {
+            "operations": self.operations,
+            "commits": self.commits,
+            "failed_commits": self.failed_commits,
+            "queued": self._queue.qsize(),
+            "operations_per_commit": round(self.operations / self.commits, 2) if self.commits else 0.0,
+        }
+
+
+writer = WriteQueue()
+atexit.register(writer.shutdown)
@@ -0,0 +1,154 @@
+"""Online backup, VACUUM INTO snapshot and restore of a seeded database.
+
+Seeds a throwaway WAL database with --rows credentials, then takes an online
+backup and a snapshot while a second connection keeps committing single-row
+inserts, and reports copy/verify times and the writer's commit latency before
+and during each copy. Both copies are verified and restored into fresh files,
+and the restored row counts are checked. Run from the project root:
+
+    python -m benchmarks.backup_restore [--rows 1000000] [--step-pages 256] [--pause 0.005]
+"""
+import argparse
+import os
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import List
+
+from sqlalchemy import create_engine
+
+from backend import backup
+from backend.db import Base
+from backend.models import Credential, User
+
+
+def _seed(path: Path, rows: int, users: int = 1000) -> None:
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    engine.dispose()
+    now = datetime.utcnow().isoformat(sep=" ")
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.executemany(
+        f"INSERT INTO {User.__tablename__} (id, username, password_hash, created_at) VALUES (?, ?, ?, ?)",
+        [(user_id, f"user{user_id}", "x", now) for user_id in range(1, users + 1)],
+    )
+    batch = 50000
+    for start in range(0, rows, batch):
+        connection.executemany(
+            f"INSERT INTO {Credential.__tablename__} "
+            "(user_id, title, login, password_encrypted, notes_encrypted, created_at, updated_at, is_archived) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, 0)",
+            [
+                (index % users + 1, f"entry-{index}", f"login{index}", os.urandom(100), os.urandom(120), now, now)
+                for index in range(start, min(start + batch, rows))
+            ],
+        )
+        connection.commit()
+    connection.close()
+
+
+class _Writer:
+    """Commits one insert at a time on its own connection and records each commit's latency."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.latencies: List[float] = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        connection = sqlite3.connect(self.path, isolation_level=None)
+        connection.execute("PRAGMA busy_timeout = 5000")
+        index = 0
+        while not self._stop.is_set():
+            index += 1
+            started = time.perf_counter()
+            connection.execute(
+                "INSERT INTO credentials (user_id, title, password_encrypted, is_archived) VALUES (1, ?, x'00', 0)",
+                (f"live-{time.time_ns()}-{index}",),
+            )
+            self.latencies.append((time.perf_counter() - started) * 1000)
+            time.sleep(0.002)
+        connection.close()
+
+    def start(self) -> "_Writer":
+        self._thread.start()
+        return self
+
+    def stop(self) -> List[float]:
+        self._stop.set()
+        self._thread.join()
+        return self.latencies
+
+
+def _latency(latencies: List[float]) -> str:
+    if not latencies:
+        return "no commits"
+    ordered = sorted(latencies)
+    p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+    return (
+        f"{len(ordered)} commits, p50 {statistics.median(ordered):.2f} ms, "
+        f"p99 {p99:.2f} ms, max {ordered[-1]:.2f} ms"
+    )
+
+
+def _count(path: Path) -> int:
+    connection = sqlite3.connect(f"{path.as_uri()}?mode=ro", uri=True)
+    try:
+        return connection.execute("SELECT COUNT(*) FROM credentials").fetchone()[0]
+    finally:
+        connection.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--step-pages", type=int, default=backup.DEFAULT_STEP_PAGES)
+    parser.add_argument("--pause", type=float, default=backup.DEFAULT_STEP_PAUSE)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source = Path(tmp) / "app.db"
+        directory = Path(tmp) / "backups"
+        started = time.perf_counter()
+        _seed(source, args.rows)
+        print(f"seeded {args.rows} rows in {time.perf_counter() - started:.1f} s, {source.stat().st_size / 1e6:.1f} MB")
+
+        idle = _Writer(source).start()
+        time.sleep(1.0)
+        print(f"writer, no copy running: {_latency(idle.stop())}")
+
+        copies = {}
+        for kind in backup.KINDS:
+            writer = _Writer(source).start()
+            if kind == "backup":
+                metrics = backup.online_backup(source, directory, step_pages=args.step_pages, pause=args.pause)
+            else:
+                metrics = backup.snapshot(source, directory)
+            latencies = writer.stop()
+            copies[kind] = Path(metrics["path"])
+            extra = f", {metrics['steps']} steps, {metrics['restarts']} restarts" if kind == "backup" else ""
+            print(
+                f"{kind:<8} {metrics['bytes'] / 1e6:8.1f} MB  copy {metrics['copy_seconds']:6.2f} s  "
+                f"verify {metrics['verify_seconds']:5.2f} s  {metrics['mb_per_second']:6.1f} MB/s{extra}"
+            )
+            print(f"         writer during {kind}: {_latency(latencies)}")
+
+        for kind, path in copies.items():
+            started = time.perf_counter()
+            ok, message = backup.verify(path)
+            verified = time.perf_counter() - started
+            target = Path(tmp) / f"restored-{kind}.db"
+            result = backup.restore(path, target)
+            rows = _count(target)
+            assert ok and rows == _count(path) and rows >= args.rows, (kind, message, rows)
+            print(f"restore {kind:<8} verify {verified:5.2f} s  restore {result['seconds']:6.2f} s  {rows} rows")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+"""Decrypt throughput of decrypt_many for each backend.
+
+Run from the project root:
+
+    python -m benchmarks.batch_decrypt [--count 20000] [--chunk-size 256]
+"""
+import argparse
+import time
+
+from backend import security
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=20000)
+    parser.add_argument("--chunk-size", type=int, default=security.DEFAULT_CRYPTO_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    tokens = security.encrypt_many([f"secret-{index:08d}" for index in range(args.count)], backend="serial")
+    print(f"{args.count} tokens, chunk size {args.chunk_size}, {security._crypto_workers()} workers")
+
+    baseline = None
+    for backend in ("serial", "thread", "process"):
+        # Warm the pool so worker start-up is not counted.
+        security.decrypt_many(tokens[: args.chunk_size * 2], backend=backend, chunk_size=args.chunk_size)
+        started = time.perf_counter()
+        security.decrypt_many(tokens, backend=backend, chunk_size=args.chunk_size)
+        elapsed = time.perf_counter() - started
+        baseline = baseline or elapsed
+        print(f"{backend:<8} {args.count / elapsed:12.0f} tokens/s  {baseline / elapsed:5.2f}x")
+
+
+if __name__ == "__main__":
+    main()
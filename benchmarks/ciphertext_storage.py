@@ -0,0 +1,106 @@
+"""Database size and list latency with text versus binary ciphertext storage.
+
+Seeds two throwaway SQLite files with the same credentials, one per storage
+form, and lists them the way credentials.list_credentials(include_sensitive=True)
+does. Run from the project root:
+
+    python -m benchmarks.ciphertext_storage [--rows 100000] [--repeat 5]
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from cryptography.fernet import Fernet, MultiFernet
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from backend import security
+from backend.db import Base
+from backend.models import Credential
+
+
+def _seed(path: Path, rows: int, cipher: MultiFernet, binary: bool) -> None:
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    os.environ[security.CIPHERTEXT_STORAGE_ENV] = "binary" if binary else "text"
+    now = datetime.utcnow()
+    batch = 10000
+    with engine.begin() as connection:
+        for start in range(0, rows, batch):
+            count = min(batch, rows - start)
+            passwords = security.encrypt_many([f"password-{start + i:08d}" for i in range(count)], cipher=cipher)
+            notes = security.encrypt_many([f"note for entry {start + i}" for i in range(count)], cipher=cipher)
+            connection.execute(
+                Credential.__table__.insert(),
+                [
+                    {
+                        "user_id": 1,
+                        "title": f"entry-{start + i:08d}",
+                        "login": f"user{start + i}@example.com",
+                        "password_encrypted": passwords[i],
+                        "notes_encrypted": notes[i],
+                        "created_at": now,
+                        "updated_at": now,
+                        "is_archived": False,
+                    }
+                    for i in range(count)
+                ],
+            )
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.exec_driver_sql("VACUUM")
+    engine.dispose()
+
+
+def _list_latency(path: Path, cipher: MultiFernet, repeat: int) -> float:
+    engine = create_engine(f"sqlite:///{path}")
+    session_factory = sessionmaker(bind=engine)
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        db = session_factory()
+        try:
+            records = (
+                db.query(Credential)
+                .filter(Credential.user_id == 1, Credential.is_archived.is_(False))
+                .order_by(Credential.created_at.desc())
+                .all()
+            )
+            tokens = []
+            for record in records:
+                tokens.extend((record.password_encrypted, record.notes_encrypted))
+            security.decrypt_many(tokens, cipher=cipher, backend="serial")
+        finally:
+            db.close()
+        timings.append(time.perf_counter() - started)
+    engine.dispose()
+    return statistics.median(timings)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    cipher = MultiFernet([Fernet(Fernet.generate_key())])
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for form in ("text", "binary"):
+            path = Path(tmp) / f"{form}.db"
+            _seed(path, args.rows, cipher, binary=form == "binary")
+            results[form] = (path.stat().st_size, _list_latency(path, cipher, args.repeat))
+
+    print(f"{args.rows} rows, median of {args.repeat} list runs")
+    for form, (size, latency) in results.items():
+        print(f"{form:<7} {size / 1024 / 1024:8.2f} MiB  {latency * 1000:9.1f} ms/list")
+    text_size, text_latency = results["text"]
+    binary_size, binary_latency = results["binary"]
+    print(f"size: {100 * (1 - binary_size / text_size):.1f}% smaller, list: {text_latency / binary_latency:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
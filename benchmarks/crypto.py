@@ -0,0 +1,108 @@
+"""Crypto and hashing microbenchmark suite with a JSON regression gate.
+
+Covers encrypt_value/decrypt_value at several payload sizes, verify_totp and
+auth.pwd_context.hash/verify at the configured bcrypt cost. Runs offline with a
+fixed in-memory key, so data/fernet.key is never read or created.
+
+    python -m benchmarks.crypto --output bench/today.json
+    python -m benchmarks.crypto --baseline bench/today.json --output bench/new.json
+
+With --baseline the run is compared case by case and the exit status is 1 when
+any case regressed beyond --tolerance.
+"""
+import argparse
+import os
+import sys
+from pathlib import Path
+from typing import Dict
+
+import pyotp
+
+from benchmarks.harness import (
+    DEFAULT_TOLERANCE,
+    compare,
+    load_results,
+    measure,
+    print_comparison,
+    print_results,
+    save_results,
+)
+
+PAYLOAD_SIZES = (16, 256, 4096, 65536)
+
+
+def _configure_key() -> None:
+    # Fixed env key: reproducible runs that never touch the key file.
+    from backend import security
+
+    os.environ[security.APP_FERNET_ENV] = "benchmark-suite"
+    os.environ.pop(security.APP_PREVIOUS_FERNET_ENV, None)
+    security.keyring.invalidate()
+
+
+def run_suite(scale: float = 1.0) -> Dict[str, dict]:
+    _configure_key()
+    from backend import security
+    from backend.auth import pwd_context
+
+    def iterations(base: int) -> int:
+        return max(5, int(base * scale))
+
+    results: Dict[str, dict] = {}
+    for size in PAYLOAD_SIZES:
+        value = "x" * size
+        token = security.encrypt_value(value)
+        count = iterations(20000 if size <= 4096 else 2000)
+        results[f"encrypt_value[{size}B]"] = measure(lambda: security.encrypt_value(value), count, warmup=100)
+        results[f"decrypt_value[{size}B]"] = measure(lambda: security.decrypt_value(token), count, warmup=100)
+
+    secret = pyotp.random_base32()
+    code = pyotp.TOTP(secret).now()
+    results["verify_totp"] = measure(lambda: security.verify_totp(secret, code), iterations(20000), warmup=100)
+    # A replayed code is rejected from the cached window: the common case for repeated attempts.
+    security.verify_totp(secret, code, user_id=-1)
+    results["verify_totp[cached,replay]"] = measure(
+        lambda: security.verify_totp(secret, code, user_id=-1), iterations(20000), warmup=100
+    )
+
+    password = "correct horse battery staple"
+    hashed = pwd_context.hash(password)
+    results["pwd_context.hash"] = measure(lambda: pwd_context.hash(password), iterations(20), alloc_iterations=3)
+    results["pwd_context.verify"] = measure(
+        lambda: pwd_context.verify(password, hashed), iterations(20), alloc_iterations=3
+    )
+    return results
+
+
+def _bcrypt_rounds() -> int:
+    from backend.auth import pwd_context
+
+    return int(pwd_context.hash("probe").split("$")[2])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--output", type=Path, help="write results as JSON to this path")
+    parser.add_argument("--baseline", type=Path, help="compare against a previous JSON result")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply iteration counts, e.g. 0.1 for a smoke run")
+    args = parser.parse_args()
+
+    results = run_suite(scale=args.scale)
+    print_results(results)
+    if args.output:
+        save_results(args.output, results, metadata={"suite": "crypto", "bcrypt_rounds": _bcrypt_rounds()})
+        print(f"saved to {args.output}")
+
+    if args.baseline:
+        rows = compare(load_results(args.baseline), results, tolerance=args.tolerance)
+        print()
+        print_comparison(rows)
+        if any(row["regressed"] for row in rows):
+            print(f"regression beyond {args.tolerance:.0%} against {args.baseline}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+"""Small timing harness shared by the benchmark suites.
+
+Each case is timed call by call for latency percentiles, then run again under
+tracemalloc to count allocations, so tracing overhead never skews the timings.
+Results are plain dicts that round-trip through JSON for run-to-run comparison.
+"""
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+# A case regresses when ops/sec drops, or p99 grows, by more than this fraction.
+DEFAULT_TOLERANCE = 0.15
+
+
+def _percentile(sorted_values: List[float], fraction: float) -> float:
+    index = min(len(sorted_values) - 1, max(0, round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def measure(func: Callable[[], object], iterations: int, warmup: int = 0, alloc_iterations: int = 0) -> dict:
+    """Time func iterations times and report throughput, latency percentiles and allocations per call."""
+    for _ in range(warmup):
+        func()
+
+    timings = []
+    clock = time.perf_counter_ns
+    for _ in range(iterations):
+        started = clock()
+        func()
+        timings.append(clock() - started)
+    timings.sort()
+    total_ns = sum(timings)
+
+    alloc_iterations = alloc_iterations or min(iterations, 1000)
+    tracemalloc.start()
+    try:
+        before_blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+        tracemalloc.reset_peak()
+        for _ in range(alloc_iterations):
+            func()
+        _, peak = tracemalloc.get_traced_memory()
+        after_blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "iterations": iterations,
+        "ops_per_sec": round(iterations / (total_ns / 1e9), 1),
+        "mean_us": round(statistics.fmean(timings) / 1000, 2),
+        "p50_us": round(_percentile(timings, 0.50) / 1000, 2),
+        "p99_us": round(_percentile(timings, 0.99) / 1000, 2),
+        "retained_blocks_per_op": round(max(0, after_blocks - before_blocks) / alloc_iterations, 3),
+        "peak_alloc_bytes": peak,
+    }
+
+
+def environment() -> dict:
+    return {
+        "timestamp": datetime.utcnow().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def save_results(path: Path, results: Dict[str, dict], metadata: Optional[dict] = None) -> None:
+    payload = {"environment": environment(), "metadata": metadata or {}, "results": results}
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(payload, indent=2, sort_keys=True), encoding="utf-8")
+
+
+def load_results(path: Path) -> Dict[str, dict]:
+    return json.loads(path.read_text(encoding="utf-8"))["results"]
+
+
+def compare(baseline: Dict[str, dict], current: Dict[str, dict], tolerance: float = DEFAULT_TOLERANCE) -> List[dict]:
+    """Return one row per case present in both runs, flagging regressions beyond tolerance."""
+    rows = []
+    for name in sorted(baseline.keys() & current.keys()):
+        old, new = baseline[name], current[name]
+        throughput = new["ops_per_sec"] / old["ops_per_sec"] if old["ops_per_sec"] else 1.0
+        tail = new["p99_us"] / old["p99_us"] if old["p99_us"] else 1.0
+        rows.append(
+            {
+                "name": name,
+                "throughput_ratio": round(throughput, 3),
+                "p99_ratio": round(tail, 3),
+                "regressed": throughput < 1 - tolerance or tail > 1 + tolerance,
+            }
+        )
+    return rows
+
+
+def print_results(results: Dict[str, dict]) -> None:
+    print(f"{'case':<34} {'ops/s':>12} {'p50 us':>10} {'p99 us':>10} {'blocks/op':>10} {'peak B':>9}")
+    for name, row in results.items():
+        print(
+            f"{name:<34} {row['ops_per_sec']:>12.1f} {row['p50_us']:>10.2f} {row['p99_us']:>10.2f} "
+            f"{row['retained_blocks_per_op']:>10.3f} {row['peak_alloc_bytes']:>9}"
+        )
+
+
+def print_comparison(rows: List[dict]) -> None:
+    print(f"{'case':<34} {'throughput':>11} {'p99':>8}")
+    for row in rows:
+        flag = "  REGRESSION" if row["regressed"] else ""
+        print(f"{row['name']:<34} {row['throughput_ratio']:>10.3f}x {row['p99_ratio']:>7.3f}x{flag}")
@@ -0,0 +1,45 @@
+"""Per-call overhead of the cached keyring versus building a Fernet on every call.
+
+Run from the project root:
+
+    python -m benchmarks.keyring [--iterations 20000]
+"""
+import argparse
+import timeit
+
+from cryptography.fernet import Fernet
+
+from backend import security
+
+
+def _legacy_decrypt(token: security.Token) -> str:
+    # The pre-keyring hot path: read the key and build a new Fernet for every value.
+    return Fernet(security.load_fernet_key()).decrypt(security.to_fernet_token(token)).decode("utf-8")
+
+
+def _report(label: str, seconds: float, iterations: int) -> float:
+    per_call_us = seconds / iterations * 1_000_000
+    print(f"{label:<28} {per_call_us:9.2f} us/call  {iterations / seconds:12.0f} ops/s")
+    return per_call_us
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    token = security.encrypt_value("correct horse battery staple")
+    n = args.iterations
+
+    print(f"{n} iterations, key source: {'env' if security._load_env_key() else security.FERNET_KEY_PATH}")
+    before_cipher = _report("get_cipher (uncached)", timeit.timeit(lambda: Fernet(security.load_fernet_key()), number=n), n)
+    after_cipher = _report("get_cipher (keyring)", timeit.timeit(security.get_cipher, number=n), n)
+    before_decrypt = _report("decrypt (uncached)", timeit.timeit(lambda: _legacy_decrypt(token), number=n), n)
+    after_decrypt = _report("decrypt_value (keyring)", timeit.timeit(lambda: security.decrypt_value(token), number=n), n)
+
+    print(f"cipher lookup speedup: {before_cipher / after_cipher:.1f}x")
+    print(f"decrypt speedup:       {before_decrypt / after_decrypt:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""Credential write throughput against the number of shards.
+
+For each client count and shard count, opens that many throwaway shard files
+(see backend/shards.py) and lets that many threads insert credentials for random
+users through the shard's writer, the way credentials.create_credential does;
+ciphertexts are fixed bytes so only the database side is measured. Every run
+reports writes per commit next to writes per second.
+
+Sharding competes with group commit: one writer already folds the writes queued
+during a commit into the next one, so with many clients a single file commits
+rarely and more files only mean more, smaller commits. Shards can only win when
+a commit waits on the disk rather than on the CPU and too few writes queue up to
+amortize it. --commit-latency emulates slower storage by sleeping (without the
+GIL, like an fsync) after every COMMIT; run it without on the disk the app uses.
+Run from the project root:
+
+    python -m benchmarks.shard_writes [--shards 1 2 4 8] [--clients 4 32] [--seconds 5]
+        [--synchronous FULL] [--commit-latency MS]
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from backend.credentials import _insert_credential
+from backend.models import Credential
+from backend.shards import open_storage, shard_index
+
+
+def _slow_commits(engine: Engine, latency: float) -> None:
+    def after_execute(_conn, _cursor, statement, _parameters, _context, _executemany) -> None:
+        if statement == "COMMIT":
+            time.sleep(latency)
+
+    event.listen(engine, "after_cursor_execute", after_execute)
+
+
+def _run(directory: Path, shard_count: int, clients: int, seconds: float, synchronous: str, commit_latency: float) -> dict:
+    storages = [
+        open_storage(directory / f"shard-{index:03d}.db", synchronous=synchronous) for index in range(shard_count)
+    ]
+    if commit_latency:
+        for storage in storages:
+            _slow_commits(storage.engine, commit_latency)
+    payload = os.urandom(120)
+    done = [0] * clients
+    stop = threading.Event()
+
+    def client(number: int) -> None:
+        rng = random.Random(number)
+        sequence = 0
+        while not stop.is_set():
+            user_id = rng.randrange(1, 1_000_000)
+            sequence += 1
+            credential = Credential(
+                user_id=user_id,
+                title=f"bench-{number}-{sequence}",
+                password_encrypted=payload,
+                notes_encrypted=payload,
+                created_at=datetime.utcnow(),
+            )
+            ok, _result = storages[shard_index(user_id, shard_count)].writer.run(_insert_credential, credential)
+            done[number] += ok
+
+    threads = [threading.Thread(target=client, args=(number,), daemon=True) for number in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    commits = sum(storage.writer.commits for storage in storages)
+    for storage in storages:
+        storage.writer.shutdown()
+    return {"writes": sum(done), "per_second": sum(done) / elapsed, "commits": commits}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--clients", type=int, nargs="+", default=[4, 32])
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--synchronous", choices=["OFF", "NORMAL", "FULL"], default="FULL")
+    parser.add_argument("--commit-latency", type=float, default=0.0, help="ms to wait after every commit, emulating slower storage")
+    parser.add_argument("--directory", help="where to put the shard files (default: a temporary directory)")
+    args = parser.parse_args()
+
+    print(
+        f"{args.seconds:.0f} s per run, synchronous={args.synchronous}, "
+        f"commit latency +{args.commit_latency:g} ms, {os.cpu_count()} CPUs"
+    )
+    for clients in args.clients:
+        baseline = None
+        for shard_count in args.shards:
+            with tempfile.TemporaryDirectory(dir=args.directory) as tmp:
+                result = _run(Path(tmp), shard_count, clients, args.seconds, args.synchronous, args.commit_latency / 1000)
+            baseline = baseline or result["per_second"]
+            print(
+                f"{clients:>3} clients {shard_count:>3} shards {result['per_second']:10.0f} writes/s  "
+                f"{result['per_second'] / baseline:5.2f}x  {result['writes'] / max(result['commits'], 1):5.1f} writes/commit"
+            )
+
+
+if __name__ == "__main__":
+    main()
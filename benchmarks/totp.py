@@ -0,0 +1,59 @@
+"""TOTP verifications per second: a new pyotp.TOTP per call versus the verifier cache.
+
+Run from the project root:
+
+    python -m benchmarks.totp [--iterations 20000] [--users 1000]
+"""
+import argparse
+import time
+
+import pyotp
+
+from backend import security
+
+
+def _rate(label: str, func, iterations: int) -> float:
+    started = time.perf_counter()
+    for index in range(iterations):
+        func(index)
+    elapsed = time.perf_counter() - started
+    print(f"{label:<34} {iterations / elapsed:12.0f} verifications/s")
+    return elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--users", type=int, default=1000)
+    args = parser.parse_args()
+
+    secrets = [pyotp.random_base32() for _ in range(args.users)]
+    wrong_code = "000000"
+    cache = security.TotpVerifierCache(maxsize=args.users)
+
+    print(f"{args.iterations} iterations over {args.users} users")
+    # Rejected codes walk the whole window, the worst case for both paths.
+    before = _rate(
+        "uncached, rejected code",
+        lambda i: security.verify_totp(secrets[i % args.users], wrong_code),
+        args.iterations,
+    )
+    after = _rate(
+        "cached, rejected code",
+        lambda i: cache.verify(i % args.users, secrets[i % args.users], wrong_code),
+        args.iterations,
+    )
+    print(f"speedup: {before / after:.2f}x")
+
+    # Accepted codes: every user logs in once per time step, so no replay rejections.
+    codes = [pyotp.TOTP(secret).now() for secret in secrets]
+    accepted = min(args.iterations, args.users)
+    _rate(
+        "cached, accepted code",
+        lambda i: cache.verify(args.users + i, secrets[i], codes[i]),
+        accepted,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,12 @@
-﻿from typing import Optional
-from urllib.parse import unquote
+﻿from urllib.parse import unquote
 
 from nicegui import Client, ui
 
 
-def _subscriptions_url(user_id: Optional[str]) -> str:
-    if user_id:
-        return f"/subscriptions?user_id={user_id}"
-    return "/subscriptions"
-
-
-def _dashboard_url(user_id: Optional[str]) -> str:
-    if user_id:
-        return f"/dashboard?user_id={user_id}"
-    return "/dashboard"
-
-
 @ui.page("/checkout")
 def checkout_page(client: Client):
     params = client.request.query_params if client and client.request else {}
     plan = params.get("plan", "")
-    user_id = params.get("user_id")
     plan_title = unquote(plan) if plan else "Выбранная подписка"
 
     with ui.element("div").classes("bg-gray-100 min-h-screen w-full"):
@@ -54,12 +40,12 @@ def checkout_page(client: Client):
                         ui.notify("Заполните все поля", color="warning")
                         return
                     ui.notify("Оплата успешна", color="positive")
-                    ui.navigate.to(_dashboard_url(user_id))
+                    ui.navigate.to("/dashboard")
 
                 ui.button("Оплатить", on_click=submit_payment).classes(
                     "bg-blue-500 hover:bg-blue-600 text-white w-full h-12 text-lg"
                 )
             ui.button(
                 "Вернуться к подпискам",
-                on_click=lambda: ui.navigate.to(_subscriptions_url(user_id)),
+                on_click=lambda: ui.navigate.to("/subscriptions"),
             ).props("outline").classes("mx-auto text-blue-600 border-blue-500")
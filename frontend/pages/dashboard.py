@@ -1,106 +1,43 @@
 ﻿import json
-from datetime import datetime
 from typing import Dict, List, Optional
 
-from nicegui import Client, ui
-from sqlalchemy.exc import SQLAlchemyError
+from nicegui import ui
+from sqlalchemy import select
+from sqlalchemy.orm import Session
 
 from backend import credentials as credential_service
+from backend import keys as key_service
 from backend.auth import (
-    confirm_two_factor,
-    disable_two_factor,
-    initiate_two_factor_setup,
-    set_master_key,
-    verify_master_key,
+    confirm_two_factor_async,
+    disable_two_factor_async,
+    initiate_two_factor_setup_async,
+    set_master_key_async,
+    verify_master_key_async,
 )
-from backend.db import SessionLocal
+from backend.db import AsyncReadSessionLocal
+from backend.hashing import HashingBusyError
+from backend.login_activity import login_activity
 from backend.models import Key, User
+from backend.sql_stats import query_scope
+from backend.user_index import user_index
+from backend.writer import writer
+from frontend.session import current_session, is_unlocked, signed_out_card, unlocked
 
 
-def _load_user(user_id: int) -> Optional[User]:
-    db = SessionLocal()
-    try:
-        return db.query(User).filter(User.id == user_id).first()
-    finally:
-        db.close()
-
-
-def _update_email(user_id: int, email: str) -> bool:
-    db = SessionLocal()
-    try:
-        user = db.query(User).filter(User.id == user_id).first()
-        if not user:
-            return False
-        user.email = email or None
-        db.commit()
-        return True
-    finally:
-        db.close()
-
-
-def _list_keys(user_id: int) -> List[Key]:
-    db = SessionLocal()
-    try:
-        return (
-            db.query(Key)
-            .filter(Key.user_id == user_id)
-            .order_by(Key.created_at.desc())
-            .all()
-        )
-    finally:
-        db.close()
-
-
-def _create_key(user_id: int, name: str, value: str, description: str = ""):
-    db = SessionLocal()
-    try:
-        if not name.strip():
-            return False, "Enter key name"
-        if not value.strip():
-            return False, "Enter key value"
-        key = Key(
-            user_id=user_id,
-            key_name=name.strip(),
-            key_value=value.strip(),
-            description=description.strip() or None,
-            created_at=datetime.utcnow(),
-            is_active=True,
-        )
-        db.add(key)
-        db.commit()
-        db.refresh(key)
-        return True, key
-    except SQLAlchemyError as exc:
-        db.rollback()
-        return False, f"Database error: {exc}"
-    finally:
-        db.close()
-
-
-def _toggle_key_active(key_id: int, value: bool) -> bool:
-    db = SessionLocal()
-    try:
-        key = db.query(Key).filter(Key.id == key_id).first()
-        if not key:
-            return False
-        key.is_active = value
-        db.commit()
-        return True
-    finally:
-        db.close()
-
-
-def _delete_key(key_id: int) -> bool:
-    db = SessionLocal()
-    try:
-        key = db.query(Key).filter(Key.id == key_id).first()
-        if not key:
-            return False
-        db.delete(key)
-        db.commit()
-        return True
-    finally:
-        db.close()
+async def _load_user(user_id: int) -> Optional[User]:
+    async with AsyncReadSessionLocal() as db:
+        return (await db.execute(select(User).where(User.id == user_id))).scalar()
+
+
+def _write_email(db: Session, user_id: int, email: str) -> bool:
+    return bool(db.query(User).filter(User.id == user_id).update({"email": email or None}))
+
+
+async def _update_email(user_id: int, email: str) -> bool:
+    if not await writer.run_async(_write_email, user_id, email):
+        return False
+    user_index.added(email=email or None)
+    return True
 
 
 def _stat_card(title: str, value, description: str):
@@ -118,9 +55,10 @@ def _activity_item(icon: str, title: str, subtitle: str):
             ui.label(subtitle).classes("text-xs text-gray-600")
 
 
-def _render_overview(content_area: ui.element, user: User):
-    credential_count = len(credential_service.list_credentials(user.id))
-    key_count = len(_list_keys(user.id))
+async def _render_overview(content_area: ui.element, session: dict):
+    user_id = session["user_id"]
+    credential_count = len(await credential_service.list_credentials_async(user_id))
+    key_count = len(await key_service.list_keys_async(user_id))
 
     with content_area:
         with ui.column().classes("w-full gap-6"):
@@ -130,7 +68,7 @@ def _render_overview(content_area: ui.element, user: User):
                 with ui.row().classes("w-full gap-4 flex-wrap"):
                     _stat_card("Stored credentials", credential_count, "Passwords and secrets")
                     _stat_card("Active keys", key_count, "API access tokens")
-                    status = "Enabled" if user.is_2fa_enabled else "Disabled"
+                    status = "Enabled" if session["is_2fa_enabled"] else "Disabled"
                     _stat_card("2FA", status, "Two-factor authentication")
                 with ui.row().classes("w-full gap-2 flex-wrap"):
                     ui.button(
@@ -146,7 +84,7 @@ def _render_overview(content_area: ui.element, user: User):
                     ui.button(
                         "Купить подписку",
                         icon="shopping_cart",
-                        on_click=lambda: ui.navigate.to(f"/subscriptions?user_id={user.id}"),
+                        on_click=lambda: ui.navigate.to("/subscriptions"),
                     ).classes("bg-blue-500 text-white")
                     ui.button(
                         "Open profile",
@@ -176,7 +114,14 @@ def _render_overview(content_area: ui.element, user: User):
                     )
 
 
-def _render_profile(content_area: ui.element, user: User, refresh_cb):
+async def _render_profile(content_area: ui.element, session: dict, refresh_cb):
+    # Email and dates are not part of the cached session identity; this view reads the row.
+    user = await _load_user(session["user_id"])
+    if not user:
+        with content_area:
+            ui.label("User session is no longer valid").classes("text-lg text-red-500")
+        return
+    stats = await credential_service.list_credentials_async(user.id)
     with content_area:
         with ui.column().classes("w-full gap-6"):
             with ui.card().classes("w-full p-6 bg-white shadow-sm flex flex-col gap-4"):
@@ -187,8 +132,9 @@ def _render_profile(content_area: ui.element, user: User, refresh_cb):
                         ui.label(user.username).classes("text-xl font-semibold")
                         ui.label(user.email or "Email not set").classes("text-sm text-gray-600")
                         ui.label(f"Joined: {user.created_at:%d.%m.%Y}").classes("text-xs text-gray-500")
-                        if user.last_login_at:
-                            ui.label(f"Last login: {user.last_login_at:%d.%m.%Y %H:%M}").classes(
+                        last_login_at = login_activity.last_login(user.id) or user.last_login_at
+                        if last_login_at:
+                            ui.label(f"Last login: {last_login_at:%d.%m.%Y %H:%M}").classes(
                                 "text-xs text-gray-500"
                             )
 
@@ -199,11 +145,11 @@ def _render_profile(content_area: ui.element, user: User, refresh_cb):
                 )
                 email_input = ui.input("Email", value=user.email or "").props("outlined").classes("w-full")
 
-                def save_email():
+                async def save_email():
                     new_email = (email_input.value or "").strip()
-                    if _update_email(user.id, new_email):
+                    if await _update_email(user.id, new_email):
                         ui.notify("Email updated", color="positive")
-                        refresh_cb()
+                        await refresh_cb()
                     else:
                         ui.notify("Unable to update email", color="negative")
 
@@ -211,7 +157,6 @@ def _render_profile(content_area: ui.element, user: User, refresh_cb):
 
             with ui.card().classes("w-full p-6 bg-white shadow-sm flex flex-col gap-3"):
                 ui.label("Quick stats").classes("text-xl font-semibold")
-                stats = credential_service.list_credentials(user.id)
                 with ui.row().classes("w-full gap-4 flex-wrap"):
                     _stat_card("Credentials", len(stats), "Saved passwords and notes")
                     status = "Enabled" if user.is_2fa_enabled else "Disabled"
@@ -219,8 +164,9 @@ def _render_profile(content_area: ui.element, user: User, refresh_cb):
                     _stat_card("Master key", "Yes" if user.master_key else "No", "Sensitive actions")
 
 
-def _render_keys(content_area: ui.element, user: User):
-    state: Dict[str, List[Key]] = {"records": _list_keys(user.id)}
+async def _render_keys(content_area: ui.element, session: dict):
+    user_id = session["user_id"]
+    state: Dict[str, List[Key]] = {"records": await key_service.list_keys_async(user_id)}
 
     with content_area:
         with ui.column().classes("w-full gap-6"):
@@ -232,9 +178,9 @@ def _render_keys(content_area: ui.element, user: User):
                 key_value = ui.input("Key value", password=True, password_toggle_button=True).props("outlined").classes("w-full")
                 key_description = ui.textarea("Description (optional)").props("outlined").classes("w-full")
 
-                def add_key():
-                    ok, result = _create_key(
-                        user.id,
+                async def add_key():
+                    ok, result = await key_service.create_key_async(
+                        user_id,
                         key_name.value or "",
                         key_value.value or "",
                         description=key_description.value or "",
@@ -244,7 +190,7 @@ def _render_keys(content_area: ui.element, user: User):
                         key_name.value = ""
                         key_value.value = ""
                         key_description.value = ""
-                        state["records"] = _list_keys(user.id)
+                        state["records"] = await key_service.list_keys_async(user_id)
                         render_list()
                     else:
                         ui.notify(str(result), color="negative")
@@ -280,10 +226,10 @@ def _render_keys(content_area: ui.element, user: User):
 
                                     ui.button(icon="content_copy", on_click=copy_value).props("flat")
 
-                                    def toggle_key(active: bool, key_id: int = key.id):
-                                        if _toggle_key_active(key_id, active):
+                                    async def toggle_key(active: bool, key_id: int = key.id):
+                                        if await key_service.set_key_active_async(user_id, key_id, active):
                                             ui.notify("Status updated", color="positive")
-                                            state["records"] = _list_keys(user.id)
+                                            state["records"] = await key_service.list_keys_async(user_id)
                                             render_list()
                                         else:
                                             ui.notify("Unable to update status", color="negative")
@@ -294,10 +240,10 @@ def _render_keys(content_area: ui.element, user: User):
                                         on_change=lambda e, key_id=key.id: toggle_key(e.value, key_id),
                                     )
 
-                                    def remove(key_id: int = key.id):
-                                        if _delete_key(key_id):
+                                    async def remove(key_id: int = key.id):
+                                        if await key_service.delete_key_async(user_id, key_id):
                                             ui.notify("Key removed", color="positive")
-                                            state["records"] = _list_keys(user.id)
+                                            state["records"] = await key_service.list_keys_async(user_id)
                                             render_list()
                                         else:
                                             ui.notify("Unable to remove key", color="negative")
@@ -307,9 +253,10 @@ def _render_keys(content_area: ui.element, user: User):
             render_list()
 
 
-def _render_passwords(content_area: ui.element, user: User):
+async def _render_passwords(content_area: ui.element, session: dict):
+    user_id = session["user_id"]
     state: Dict[str, List[dict]] = {
-        "records": credential_service.list_credentials(user.id, include_sensitive=True)
+        "records": await credential_service.list_credentials_async(user_id, lazy=True)
     }
 
     with content_area:
@@ -323,9 +270,9 @@ def _render_passwords(content_area: ui.element, user: User):
                 password_input = ui.input("Password", password=True, password_toggle_button=True).props("outlined").classes("w-full")
                 notes_input = ui.textarea("Notes (optional)").props("outlined").classes("w-full")
 
-                def add_record():
-                    ok, result = credential_service.create_credential(
-                        user.id,
+                async def add_record():
+                    ok, result = await credential_service.create_credential_async(
+                        user_id,
                         title_input.value or "",
                         password_input.value or "",
                         login=login_input.value or None,
@@ -337,7 +284,7 @@ def _render_passwords(content_area: ui.element, user: User):
                         login_input.value = ""
                         password_input.value = ""
                         notes_input.value = ""
-                        state["records"] = credential_service.list_credentials(user.id, include_sensitive=True)
+                        state["records"] = await credential_service.list_credentials_async(user_id, lazy=True)
                         render_list()
                     else:
                         ui.notify(str(result), color="negative")
@@ -364,22 +311,33 @@ def _render_passwords(content_area: ui.element, user: User):
                                     ui.label(record["title"]).classes("text-lg font-semibold")
                                     if record.get("login"):
                                         ui.label(f"Login: {record['login']}").classes("text-sm text-gray-600")
-                                    if record.get("notes"):
-                                        ui.label(record["notes"]).classes("text-sm text-gray-500")
+                                    notes_label = ui.label("").classes("text-sm text-gray-500 hidden")
                                     ui.label(f"Created: {record['created_at']:%d.%m.%Y %H:%M}").classes("text-xs text-gray-500")
                                 with ui.row().classes("items-center gap-2"):
-                                    def copy_password(value: str = record["password"]):
+                                    if record.get("has_notes"):
+                                        async def show_notes(handle: str = record["handle"], label: ui.label = notes_label):
+                                            notes = await credential_service.reveal_secret_async(user_id, handle, "notes")
+                                            label.set_text(notes or "")
+                                            label.classes(remove="hidden")
+
+                                        ui.button(icon="notes", on_click=unlocked(show_notes)).props("flat")
+
+                                    async def copy_password(handle: str = record["handle"]):
+                                        value = await credential_service.reveal_secret_async(user_id, handle, "password")
+                                        if value is None:
+                                            ui.notify("Unable to decrypt password", color="negative")
+                                            return
                                         ui.run_javascript(f"navigator.clipboard.writeText({json.dumps(value)})")
                                         ui.notify("Password copied", color="info")
 
-                                    ui.button(icon="content_copy", on_click=copy_password).props("flat")
+                                    ui.button(icon="content_copy", on_click=unlocked(copy_password)).props("flat")
 
-                                    def delete_record(rec_id: int = record["id"]):
-                                        ok, message = credential_service.delete_credential(user.id, rec_id)
+                                    async def delete_record(rec_id: int = record["id"]):
+                                        ok, message = await credential_service.delete_credential_async(user_id, rec_id)
                                         if ok:
                                             ui.notify("Credential removed", color="positive")
-                                            state["records"] = credential_service.list_credentials(
-                                                user.id, include_sensitive=True
+                                            state["records"] = await credential_service.list_credentials_async(
+                                                user_id, lazy=True
                                             )
                                             render_list()
                                         else:
@@ -390,7 +348,8 @@ def _render_passwords(content_area: ui.element, user: User):
             render_list()
 
 
-def _render_settings(content_area: ui.element, user: User, refresh_cb):
+def _render_settings(content_area: ui.element, session: dict, refresh_cb):
+    user_id = session["user_id"]
     with content_area:
         with ui.column().classes("w-full gap-6"):
             with ui.card().classes("w-full p-6 bg-white shadow-sm flex flex-col gap-4"):
@@ -399,13 +358,13 @@ def _render_settings(content_area: ui.element, user: User, refresh_cb):
 
                 secret_container = ui.column().classes("w-full gap-3")
 
-                if user.is_2fa_enabled:
+                if session["is_2fa_enabled"]:
 
-                    def disable():
-                        ok, message = disable_two_factor(user.id)
+                    async def disable():
+                        ok, message = await disable_two_factor_async(user_id)
                         if ok:
                             ui.notify(message, color="positive")
-                            refresh_cb()
+                            await refresh_cb()
                         else:
                             ui.notify(message, color="negative")
 
@@ -415,8 +374,8 @@ def _render_settings(content_area: ui.element, user: User, refresh_cb):
                     )
                 else:
 
-                    def start_setup():
-                        ok, payload = initiate_two_factor_setup(user.id)
+                    async def start_setup():
+                        ok, payload = await initiate_two_factor_setup_async(user_id)
                         if not ok:
                             ui.notify(str(payload), color="negative")
                             return
@@ -432,11 +391,11 @@ def _render_settings(content_area: ui.element, user: User, refresh_cb):
                                 "w-full max-w-sm"
                             )
 
-                            def confirm():
-                                ok_confirm, message = confirm_two_factor(user.id, code_input.value or "")
+                            async def confirm():
+                                ok_confirm, message = await confirm_two_factor_async(user_id, code_input.value or "")
                                 if ok_confirm:
                                     ui.notify(message, color="positive")
-                                    refresh_cb()
+                                    await refresh_cb()
                                 else:
                                     ui.notify(message, color="negative")
 
@@ -458,7 +417,8 @@ def _render_settings(content_area: ui.element, user: User, refresh_cb):
                 current_input = ui.input(
                     "Current master key", password=True, password_toggle_button=True
                 ).props("outlined").classes("w-full max-w-sm")
-                if not user.master_key:
+                # An unlocked session has just proven the current key.
+                if is_unlocked(session):
                     current_input.classes("hidden")
 
                 new_input = ui.input(
@@ -468,19 +428,26 @@ def _render_settings(content_area: ui.element, user: User, refresh_cb):
                     "Confirm master key", password=True, password_toggle_button=True
                 ).props("outlined").classes("w-full max-w-sm")
 
-                def save_master_key():
+                async def save_master_key():
                     new_value = new_input.value or ""
                     confirm_value = confirm_input.value or ""
                     if new_value != confirm_value:
                         ui.notify("Values do not match", color="warning")
                         return
-                    if user.master_key and not verify_master_key(user.id, current_input.value or ""):
-                        ui.notify("Current master key is incorrect", color="negative")
+                    try:
+                        if (
+                            not is_unlocked(session)
+                            and not await verify_master_key_async(user_id, current_input.value or "")
+                        ):
+                            ui.notify("Current master key is incorrect", color="negative")
+                            return
+                    except HashingBusyError:
+                        ui.notify("Server is busy, try again in a moment", color="warning")
                         return
-                    ok, message = set_master_key(user.id, new_value)
+                    ok, message = await set_master_key_async(user_id, new_value)
                     if ok:
                         ui.notify(message, color="positive")
-                        refresh_cb()
+                        await refresh_cb()
                     else:
                         ui.notify(message, color="negative")
 
@@ -490,28 +457,20 @@ def _render_settings(content_area: ui.element, user: User, refresh_cb):
 
 
 @ui.page("/dashboard")
-def dashboard_page(client: Client):
-    params = client.request.query_params if client and client.request else {}
-    try:
-        user_id = int(params.get("user_id", "0"))
-    except (TypeError, ValueError):
-        user_id = 0
-
-    user = _load_user(user_id)
-    if not user:
-        with ui.card().classes("max-w-md mx-auto mt-20 p-6"):
-            ui.label("User not found").classes("text-xl font-semibold mb-2")
-            ui.button("Back to login", on_click=lambda: ui.navigate.to("/")).classes("w-full")
+async def dashboard_page():
+    session = await current_session()
+    if not session:
+        signed_out_card()
         return
 
     active_view = {"value": "dashboard"}
     nav_buttons: Dict[str, ui.button] = {}
     content_area_holder: Dict[str, Optional[ui.element]] = {"element": None}
 
-    def set_active(view: str):
+    async def set_active(view: str):
         active_view["value"] = view
         update_nav()
-        render_content()
+        await render_content()
 
     def update_nav():
         base = "w-full justify-start text-left no-wrap"
@@ -521,12 +480,16 @@ def dashboard_page(client: Client):
             else:
                 button.classes(replace=f"{base} text-gray-700 hover:bg-gray-100")
 
-    def render_content():
+    async def render_content():
+        with query_scope(f"dashboard.render_content:{active_view['value']}"):
+            await _render_content()
+
+    async def _render_content():
         content_area = content_area_holder["element"]
         if content_area is None:
             return
-        current_user = _load_user(user_id)
-        if not current_user:
+        current = await current_session()
+        if not current:
             content_area.clear()
             with content_area:
                 ui.label("User session is no longer valid").classes("text-lg text-red-500")
@@ -534,17 +497,17 @@ def dashboard_page(client: Client):
         content_area.clear()
         refresh_cb = render_content
         if active_view["value"] == "dashboard":
-            _render_overview(content_area, current_user)
+            await _render_overview(content_area, current)
         elif active_view["value"] == "profile":
-            _render_profile(content_area, current_user, refresh_cb)
+            await _render_profile(content_area, current, refresh_cb)
         elif active_view["value"] == "keys":
-            _render_keys(content_area, current_user)
+            await _render_keys(content_area, current)
         elif active_view["value"] == "passwords":
-            _render_passwords(content_area, current_user)
+            await _render_passwords(content_area, current)
         else:
-            _render_settings(content_area, current_user, refresh_cb)
+            _render_settings(content_area, current, refresh_cb)
 
-    def handle_navigation(event):
+    async def handle_navigation(event):
         mapping = {
             "navigate:profile": "profile",
             "navigate:keys": "keys",
@@ -552,7 +515,7 @@ def dashboard_page(client: Client):
         }
         target = mapping.get(event.sender)
         if target:
-            set_active(target)
+            await set_active(target)
 
     ui.on("navigate:profile", handle_navigation)
     ui.on("navigate:keys", handle_navigation)
@@ -562,10 +525,10 @@ def dashboard_page(client: Client):
         with ui.row().classes("w-full bg-gray-200 px-8 py-4 items-center justify-between shadow-sm"):
             ui.label("Key Manager").classes("text-xl font-semibold text-gray-800")
             with ui.row().classes("items-center gap-3"):
-                ui.label(user.username).classes("text-sm text-gray-700")
+                ui.label(session["username"]).classes("text-sm text-gray-700")
                 avatar = ui.avatar(icon="person").props("size=40 clickable")
                 avatar.classes("bg-purple-100 text-purple-600 cursor-pointer")
-                avatar.on("click", lambda: ui.navigate.to(f"/profile?user_id={user_id}"))
+                avatar.on("click", lambda: ui.navigate.to("/profile"))
 
         with ui.row().classes("flex-1 w-full"):
             with ui.column().classes("w-64 bg-white border-r border-gray-200 py-6 px-4 gap-3"):
@@ -587,6 +550,6 @@ def dashboard_page(client: Client):
 
             content_area_holder["element"] = ui.column().classes("flex-1 h-full overflow-auto p-8 gap-6")
 
-    render_content()
+    await render_content()
 
 
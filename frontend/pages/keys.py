@@ -1,34 +1,19 @@
-﻿from typing import Optional
+﻿import json
 
 from nicegui import Client, ui
 
 from backend import credentials as credential_service
-from backend.db import SessionLocal
-from backend.models import User
-
-
-def _load_user(user_id: int) -> Optional[User]:
-    db = SessionLocal()
-    try:
-        return db.query(User).filter(User.id == user_id).first()
-    finally:
-        db.close()
+from frontend.session import current_session, signed_out_card, unlocked
 
 
 @ui.page("/keys")
-def keys_page(client: Client):
+async def keys_page(client: Client):
     params = client.request.query_params if client and client.request else {}
-    try:
-        user_id = int(params.get("user_id", "0"))
-    except (TypeError, ValueError):
-        user_id = 0
-
-    user = _load_user(user_id)
-    if not user:
-        with ui.card().classes("max-w-md mx-auto mt-20 p-6"):
-            ui.label("User not found").classes("text-xl font-semibold mb-2")
-            ui.button("Back to login", on_click=lambda: ui.navigate.to("/")).classes("w-full")
+    session = await current_session()
+    if not session:
+        signed_out_card()
         return
+    user_id = session["user_id"]
 
     state = {"records": []}
     focus_id = params.get("focus_id")
@@ -41,8 +26,8 @@ def keys_page(client: Client):
         )
         with ui.row().classes("gap-2"):
             add_button = ui.button("Add credential").classes("bg-green-500 text-white")
-            ui.button("Back to dashboard", on_click=lambda: ui.navigate.to(f"/dashboard?user_id={user_id}"))
-            ui.button("Profile", on_click=lambda: ui.navigate.to(f"/profile?user_id={user_id}"))
+            ui.button("Back to dashboard", on_click=lambda: ui.navigate.to("/dashboard"))
+            ui.button("Profile", on_click=lambda: ui.navigate.to("/profile"))
 
     table_container = ui.column().classes("max-w-4xl mx-auto mt-4 gap-3")
 
@@ -54,8 +39,8 @@ def keys_page(client: Client):
         create_password = ui.input("Password", password=True, password_toggle_button=True).classes("w-full")
         create_notes = ui.textarea("Notes (optional)").classes("w-full")
 
-        def submit_create():
-            ok, res = credential_service.create_credential(
+        async def submit_create():
+            ok, res = await credential_service.create_credential_async(
                 user_id,
                 create_title.value or "",
                 create_password.value or "",
@@ -65,7 +50,7 @@ def keys_page(client: Client):
             if ok:
                 ui.notify("Credential created", color="positive")
                 create_dialog.close()
-                refresh(force=True)
+                await refresh(force=True)
             else:
                 ui.notify(str(res), color="negative")
 
@@ -81,10 +66,10 @@ def keys_page(client: Client):
         edit_notes = ui.textarea("Notes").classes("w-full")
         current_edit = {"id": None}
 
-        def submit_edit():
+        async def submit_edit():
             if current_edit["id"] is None:
                 return
-            ok, res = credential_service.update_credential(
+            ok, res = await credential_service.update_credential_async(
                 user_id,
                 current_edit["id"],
                 title=edit_title.value,
@@ -95,7 +80,7 @@ def keys_page(client: Client):
             if ok:
                 ui.notify("Credential updated", color="positive")
                 edit_dialog.close()
-                refresh(force=True)
+                await refresh(force=True)
             else:
                 ui.notify(str(res), color="negative")
 
@@ -118,41 +103,56 @@ def keys_page(client: Client):
                     ui.label(record["title"]).classes("text-lg font-semibold")
                     if record.get("login"):
                         ui.label(f"Login: {record['login']}").classes("text-sm text-gray-600")
-                    if record.get("notes"):
-                        ui.label(record["notes"]).classes("text-sm text-gray-500")
+                    notes_label = ui.label("").classes("text-sm text-gray-500 hidden")
 
                     with ui.row().classes("gap-2"):
-                        def copy_password(value: str):
-                            ui.run_javascript(f"navigator.clipboard.writeText('{value}')")
+                        async def copy_password(handle: str = record["handle"]):
+                            value = await credential_service.reveal_secret_async(user_id, handle, "password")
+                            if value is None:
+                                ui.notify("Unable to decrypt password", color="negative")
+                                return
+                            ui.run_javascript(f"navigator.clipboard.writeText({json.dumps(value)})")
                             ui.notify("Password copied", color="info")
 
-                        ui.button("Copy", on_click=lambda v=record["password"]: copy_password(v)).props("outline")
+                        ui.button("Copy", on_click=unlocked(copy_password)).props("outline")
+
+                        if record.get("has_notes"):
+                            async def show_notes(handle: str = record["handle"], label: ui.label = notes_label):
+                                notes = await credential_service.reveal_secret_async(user_id, handle, "notes")
+                                label.set_text(notes or "")
+                                label.classes(remove="hidden")
+
+                            ui.button("Show notes", on_click=unlocked(show_notes)).props("outline")
 
-                        def open_edit():
+                        async def open_edit(record: dict = record):
                             current_edit["id"] = record["id"]
                             edit_title.value = record["title"]
                             edit_login.value = record.get("login") or ""
-                            edit_notes.value = record.get("notes") or ""
+                            edit_notes.value = (
+                                await credential_service.reveal_secret_async(user_id, record["handle"], "notes") or ""
+                                if record.get("has_notes")
+                                else ""
+                            )
                             edit_password.value = ""
                             edit_dialog.open()
 
-                        ui.button("Edit", on_click=open_edit).props("outline")
+                        ui.button("Edit", on_click=unlocked(open_edit)).props("outline")
 
-                        def delete_record():
-                            ok, message = credential_service.delete_credential(user_id, record["id"])
+                        async def delete_record(rec_id: int = record["id"]):
+                            ok, message = await credential_service.delete_credential_async(user_id, rec_id)
                             if ok:
                                 ui.notify(message, color="positive")
-                                refresh(force=True)
+                                await refresh(force=True)
                             else:
                                 ui.notify(message, color="negative")
 
                         ui.button("Delete", on_click=delete_record, color="red").props("outline")
 
-    def refresh(force: bool = False):
+    async def refresh(force: bool = False):
         if force or not state["records"]:
-            state["records"] = credential_service.list_credentials(user_id, include_sensitive=True)
+            state["records"] = await credential_service.list_credentials_async(user_id, lazy=True)
         render_records()
 
     add_button.on_click(create_dialog.open)
 
-    refresh(force=True)
+    await refresh(force=True)
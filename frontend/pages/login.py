@@ -1,11 +1,12 @@
-﻿from nicegui import ui
+﻿from nicegui import Client, ui
 
-from backend.auth import verify_user
+from backend.auth import complete_two_factor_login_async, verify_user_async
+from frontend.session import sign_in
 
 
 @ui.page("/")
-def login_page():
-    pending_credentials = {"username": None, "password": None}
+def login_page(client: Client):
+    pending_login = {"ticket": None}
 
     with ui.card().classes("w-96 mx-auto mt-20 p-6 shadow-lg flex flex-col gap-3"):
         ui.label("Sign in").classes("text-2xl font-semibold text-center mb-2")
@@ -18,36 +19,34 @@ def login_page():
             ui.label("Two-factor authentication").classes("text-lg font-semibold")
             otp_input = ui.input("One-time code").classes("w-full")
 
-            def submit_otp():
+            async def submit_otp():
                 code = (otp_input.value or "").strip()
                 if not code:
                     ui.notify("Enter the 2FA code", color="warning")
                     return
 
-                ok, res = verify_user(
-                    pending_credentials["username"],
-                    pending_credentials["password"],
-                    otp_code=code,
-                )
+                client_ip = client.request.client.host if client.request and client.request.client else None
+                ok, res = await complete_two_factor_login_async(pending_login["ticket"], code, client_ip=client_ip)
                 if ok:
+                    pending_login["ticket"] = None
                     otp_dialog.close()
+                    await sign_in(res["user_id"])
                     ui.notify("Login successful", color="positive")
-                    ui.navigate.to(f"/profile?user_id={res['user_id']}")
+                    ui.navigate.to("/profile")
+                elif isinstance(res, dict) and res.get("code") == "throttled":
+                    ui.notify(res["message"], color="warning")
                 else:
-                    if isinstance(res, dict) and res.get("code") == "2fa_required":
-                        ui.notify("Please enter the verification code", color="warning")
-                    else:
-                        ui.notify(str(res), color="negative")
+                    ui.notify(str(res), color="negative")
 
             ui.button("Verify", on_click=submit_otp).classes("w-full bg-blue-500 text-white")
             ui.button("Cancel", on_click=otp_dialog.close).props("flat")
 
-        def open_two_factor(user_id: int):
-            pending_credentials["user_id"] = user_id
+        def open_two_factor(ticket: str):
+            pending_login["ticket"] = ticket
             otp_input.value = ""
             otp_dialog.open()
 
-        def handle_login():
+        async def handle_login():
             username = (username_input.value or "").strip()
             password = password_input.value or ""
 
@@ -55,16 +54,19 @@ def login_page():
                 ui.notify("Username and password are required", color="warning")
                 return
 
-            ok, res = verify_user(username, password)
+            client_ip = client.request.client.host if client.request and client.request.client else None
+            ok, res = await verify_user_async(username, password, client_ip=client_ip)
             if ok:
+                await sign_in(res["user_id"])
                 ui.notify("Login successful", color="positive")
-                ui.navigate.to(f"/profile?user_id={res['user_id']}")
+                ui.navigate.to("/profile")
                 return
 
             if isinstance(res, dict) and res.get("code") == "2fa_required":
-                pending_credentials["username"] = username
-                pending_credentials["password"] = password
-                open_two_factor(res["user_id"])
+                open_two_factor(res["ticket"])
+                return
+            if isinstance(res, dict) and res.get("code") == "throttled":
+                ui.notify(res["message"], color="warning")
                 return
 
             ui.notify(str(res), color="negative")
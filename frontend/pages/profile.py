@@ -1,73 +1,77 @@
 ﻿from typing import Optional
 
-from nicegui import Client, ui
+from nicegui import ui
+from sqlalchemy import Row, select
+from sqlalchemy.orm import Session
 
-from backend.auth import confirm_two_factor, disable_two_factor, initiate_two_factor_setup
-from backend.db import SessionLocal
+from backend.auth import confirm_two_factor_async, disable_two_factor_async, initiate_two_factor_setup_async
+from backend.db import AsyncReadSessionLocal
+from backend.login_activity import login_activity
 from backend.models import User
+from backend.user_index import user_index
+from backend.writer import writer
+from frontend.session import current_session, sign_out, signed_out_card
 
 
-def _load_user(user_id: int) -> Optional[User]:
-    db = SessionLocal()
-    try:
-        return db.query(User).filter(User.id == user_id).first()
-    finally:
-        db.close()
+async def _load_details(user_id: int) -> Optional[Row]:
+    """Account fields the cached session identity does not hold."""
+    async with AsyncReadSessionLocal() as db:
+        result = await db.execute(
+            select(User.email, User.created_at, User.last_login_at).where(User.id == user_id)
+        )
+        return result.first()
 
 
-def _update_email(user_id: int, email: str) -> bool:
-    db = SessionLocal()
-    try:
-        user = db.query(User).filter(User.id == user_id).first()
-        if not user:
-            return False
-        user.email = email or None
-        db.commit()
-        return True
-    finally:
-        db.close()
+def _write_email(db: Session, user_id: int, email: str) -> bool:
+    return bool(db.query(User).filter(User.id == user_id).update({"email": email or None}))
+
+
+async def _update_email(user_id: int, email: str) -> bool:
+    if not await writer.run_async(_write_email, user_id, email):
+        return False
+    user_index.added(email=email or None)
+    return True
 
 
 @ui.page("/profile")
-async def profile_page(client: Client):
+async def profile_page():
     import asyncio
 
     await asyncio.sleep(0.1)
 
-    params = client.request.query_params if client and client.request else {}
-    try:
-        user_id = int(params.get("user_id", "0"))
-    except (TypeError, ValueError):
-        user_id = 0
-
-    user = _load_user(user_id)
-    if not user:
-        with ui.card().classes("max-w-md mx-auto mt-20 p-6"):
-            ui.label("User not found").classes("text-xl font-semibold mb-2")
-            ui.button("Back to login", on_click=lambda: ui.navigate.to("/")).classes("w-full")
+    session = await current_session()
+    if not session:
+        signed_out_card()
+        return
+    user_id = session["user_id"]
+
+    details = await _load_details(user_id)
+    if not details:
+        signed_out_card()
         return
 
     with ui.card().classes("max-w-3xl mx-auto mt-10 p-6 shadow-lg flex flex-col gap-4"):
         ui.label("Profile").classes("text-3xl font-bold text-center")
 
         with ui.row().classes("justify-between w-full"):
-            ui.label(f"Username: {user.username}").classes("text-lg")
-            ui.label(f"Joined: {user.created_at:%d.%m.%Y}").classes("text-lg text-gray-600")
+            ui.label(f"Username: {session['username']}").classes("text-lg")
+            ui.label(f"Joined: {details.created_at:%d.%m.%Y}").classes("text-lg text-gray-600")
 
+        last_login_at = login_activity.last_login(user_id) or details.last_login_at
         with ui.row().classes("justify-between w-full"):
-            ui.label(f"Email: {user.email or 'not set'}").classes("text-lg")
+            ui.label(f"Email: {details.email or 'not set'}").classes("text-lg")
             ui.label(
-                "Last login: " + (user.last_login_at.strftime("%d.%m.%Y %H:%M") if user.last_login_at else "never")
+                "Last login: " + (last_login_at.strftime("%d.%m.%Y %H:%M") if last_login_at else "never")
             ).classes("text-lg text-gray-600")
 
         ui.separator()
 
         with ui.expansion("Edit email", icon="mail_outline").classes("w-full"):
-            email_input = ui.input("Email", value=user.email or "").classes("w-full")
+            email_input = ui.input("Email", value=details.email or "").classes("w-full")
 
-            def save_email():
+            async def save_email():
                 new_email = (email_input.value or "").strip()
-                if _update_email(user_id, new_email):
+                if await _update_email(user_id, new_email):
                     ui.notify("Email updated", color="positive")
                     ui.navigate.reload()
                 else:
@@ -86,13 +90,13 @@ async def profile_page(client: Client):
                     status_label.set_text("Status: disabled")
                     status_label.classes(replace="text-lg mb-2 text-gray-600")
 
-            update_status(user.is_2fa_enabled)
+            update_status(session["is_2fa_enabled"])
             secret_container = ui.column().classes("gap-2")
 
-            if user.is_2fa_enabled:
+            if session["is_2fa_enabled"]:
 
-                def disable() -> None:
-                    ok, message = disable_two_factor(user_id)
+                async def disable() -> None:
+                    ok, message = await disable_two_factor_async(user_id)
                     if ok:
                         ui.notify(message, color="positive")
                         update_status(False)
@@ -103,8 +107,8 @@ async def profile_page(client: Client):
                 ui.button("Disable 2FA", on_click=disable).classes("bg-red-500 text-white")
             else:
 
-                def start_setup() -> None:
-                    ok, payload = initiate_two_factor_setup(user_id)
+                async def start_setup() -> None:
+                    ok, payload = await initiate_two_factor_setup_async(user_id)
                     if not ok:
                         ui.notify(str(payload), color="negative")
                         return
@@ -118,8 +122,8 @@ async def profile_page(client: Client):
                         ui.code(uri, language="text").classes("self-center bg-gray-900 text-white max-w-xs")
                         code_input = ui.input("Enter verification code").classes("w-full")
 
-                        def confirm() -> None:
-                            ok_confirm, message = confirm_two_factor(user_id, code_input.value or "")
+                        async def confirm() -> None:
+                            ok_confirm, message = await confirm_two_factor_async(user_id, code_input.value or "")
                             if ok_confirm:
                                 ui.notify(message, color="positive")
                                 update_status(True)
@@ -134,7 +138,7 @@ async def profile_page(client: Client):
             secret_container
 
         with ui.row().classes("w-full justify-between mt-4"):
-            ui.button("Go to dashboard", on_click=lambda: ui.navigate.to(f"/dashboard?user_id={user_id}"))
-            ui.button("Manage credentials", on_click=lambda: ui.navigate.to(f"/keys?user_id={user_id}"))
-            ui.button("Sign out", on_click=lambda: ui.navigate.to("/")).classes("bg-red-500 text-white")
+            ui.button("Go to dashboard", on_click=lambda: ui.navigate.to("/dashboard"))
+            ui.button("Manage credentials", on_click=lambda: ui.navigate.to("/keys"))
+            ui.button("Sign out", on_click=sign_out).classes("bg-red-500 text-white")
 
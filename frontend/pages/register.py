@@ -1,6 +1,7 @@
 ﻿from nicegui import ui
 
-from backend.auth import create_user
+from backend.auth import create_user_async
+from frontend.session import sign_in
 
 
 @ui.page("/register")
@@ -13,7 +14,7 @@ def register_page():
         password_input = ui.input("Password", password=True, password_toggle_button=True).props("outlined").classes("w-full")
         confirm_input = ui.input("Confirm password", password=True, password_toggle_button=True).props("outlined").classes("w-full")
 
-        def handle_register():
+        async def handle_register():
             username = (username_input.value or "").strip()
             email = (email_input.value or "").strip()
             password = password_input.value or ""
@@ -26,12 +27,12 @@ def register_page():
                 ui.notify("Passwords do not match", color="warning")
                 return
 
-            ok, res = create_user(username, password, email=email or None)
+            ok, res = await create_user_async(username, password, email=email or None)
             if ok:
                 user_id = res.get("user_id") if isinstance(res, dict) else None
                 ui.notify("Account created", color="positive")
-                if user_id:
-                    ui.navigate.to(f"/dashboard?user_id={user_id}")
+                if user_id and await sign_in(user_id):
+                    ui.navigate.to("/dashboard")
                 else:
                     ui.navigate.to("/")
             else:
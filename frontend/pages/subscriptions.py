@@ -1,6 +1,4 @@
-﻿from typing import Optional
-
-from nicegui import Client, ui
+﻿from nicegui import ui
 
 PLANS = [
     {
@@ -24,23 +22,12 @@ PLANS = [
 ]
 
 
-def _dashboard_url(user_id: Optional[str]) -> str:
-    if user_id:
-        return f"/dashboard?user_id={user_id}"
-    return "/dashboard"
-
-
-def _checkout_url(plan_title: str, user_id: Optional[str]) -> str:
-    base = f"/checkout?plan={plan_title}"
-    if user_id:
-        base += f"&user_id={user_id}"
-    return base
+def _checkout_url(plan_title: str) -> str:
+    return f"/checkout?plan={plan_title}"
 
 
 @ui.page("/subscriptions")
-def subscriptions_page(client: Client):
-    params = client.request.query_params if client and client.request else {}
-    user_id = params.get("user_id")
+def subscriptions_page():
 
     with ui.element("div").classes("bg-gray-100 min-h-screen w-full"):
         with ui.column().classes("max-w-6xl mx-auto py-16 gap-10 items-center"):
@@ -60,9 +47,9 @@ def subscriptions_page(client: Client):
 
                         ui.button(
                             plan["button"],
-                            on_click=lambda title=plan["title"]: ui.navigate.to(_checkout_url(title, user_id)),
+                            on_click=lambda title=plan["title"]: ui.navigate.to(_checkout_url(title)),
                         ).classes("bg-blue-500 hover:bg-blue-600 text-white mt-auto w-full")
             ui.button(
                 "Вернуться в дашборд",
-                on_click=lambda: ui.navigate.to(_dashboard_url(user_id)),
+                on_click=lambda: ui.navigate.to("/dashboard"),
             ).props("outline").classes("mt-8 text-blue-600 border-blue-500")
@@ -0,0 +1,88 @@
+import inspect
+from typing import Awaitable, Callable, Optional, Union
+
+from nicegui import app, ui
+
+from backend import sessions
+from backend.auth import unlock_master_key_async
+from backend.hashing import HashingBusyError
+
+_STORAGE_KEY = "session"
+
+
+async def sign_in(user_id: int) -> bool:
+    token = await sessions.create_session_async(user_id)
+    if not token:
+        return False
+    app.storage.user[_STORAGE_KEY] = token
+    return True
+
+
+async def sign_out() -> None:
+    await sessions.revoke_session_async(app.storage.user.pop(_STORAGE_KEY, None))
+    ui.navigate.to("/")
+
+
+async def current_session() -> Optional[dict]:
+    """Session of the current browser, or None when signed out, expired or revoked."""
+    return await sessions.resolve_session_async(app.storage.user.get(_STORAGE_KEY))
+
+
+def signed_out_card() -> None:
+    with ui.card().classes("max-w-md mx-auto mt-20 p-6"):
+        ui.label("Please sign in").classes("text-xl font-semibold mb-2")
+        ui.button("Back to login", on_click=lambda: ui.navigate.to("/")).classes("w-full")
+
+
+def is_unlocked(session: Optional[dict]) -> bool:
+    """True when the session needs no master key prompt: no key is set, or it was entered recently."""
+    if not session:
+        return False
+    return not session["has_master_key"] or sessions.is_unlocked(session["session_id"])
+
+
+Action = Callable[[], Union[None, Awaitable[None]]]
+
+
+async def _call(action: Action) -> None:
+    result = action()
+    if inspect.isawaitable(result):
+        await result
+
+
+def unlocked(action: Action) -> Callable[[], Awaitable[None]]:
+    """Wrap a plain or async click handler so it only runs on an unlocked session, prompting for the master key."""
+
+    async def handler() -> None:
+        session = await current_session()
+        if not session:
+            ui.notify("Session expired, please sign in again", color="warning")
+            return
+        if is_unlocked(session):
+            await _call(action)
+            return
+        _prompt_master_key(session, action)
+
+    return handler
+
+
+def _prompt_master_key(session: dict, action: Action) -> None:
+    with ui.dialog() as dialog, ui.card().classes("w-80 p-4 gap-3"):
+        ui.label("Enter master key").classes("text-lg font-semibold")
+        key_input = ui.input("Master key", password=True, password_toggle_button=True).classes("w-full")
+
+        async def submit() -> None:
+            try:
+                ok = await unlock_master_key_async(session["session_id"], session["user_id"], key_input.value or "")
+            except HashingBusyError:
+                ui.notify("Server is busy, try again in a moment", color="warning")
+                return
+            if not ok:
+                ui.notify("Master key is incorrect", color="negative")
+                return
+            dialog.close()
+            await _call(action)
+
+        ui.button("Unlock", on_click=submit).classes("w-full bg-blue-500 text-white")
+        ui.button("Cancel", on_click=dialog.close).props("flat")
+    dialog.open()
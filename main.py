@@ -1,21 +1,64 @@
-﻿from nicegui import ui
+﻿from fastapi import Request
+from nicegui import app, ui
 
-from backend.db import run_migrations
+from backend.backup import backup_scheduler
+from backend.db import describe_sqlite_settings, run_migrations
+from backend.hashing import ensure_calibrated
+from backend.login_activity import login_activity
+from backend.sessions import purge_expired_sessions, storage_secret
+from backend.sql_stats import query_scope
+from backend.user_index import user_index
 
 
 def bootstrap_database() -> bool:
     try:
         run_migrations()
         print("Database migrated successfully")
+        print(describe_sqlite_settings())
+        purge_expired_sessions()
+        user_index.start()
+        calibration = ensure_calibrated()
+        if calibration:
+            print(f"bcrypt cost calibrated to {calibration['rounds']} (target {calibration['target_ms']:.0f} ms)")
         return True
     except Exception as exc:  # pylint: disable=broad-except
         print(f"Failed to run migrations: {exc}")
         return False
 
 
-if bootstrap_database():
-    from frontend.pages import dashboard, keys, login, profile, register, subscriptions, checkout  # noqa: F401
+# Scope for requests no route matched (404s, scanners): one label, so arbitrary paths cannot grow the stats.
+UNMATCHED_SCOPE = "<unmatched>"
+_HTTP_METHODS = frozenset({"GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"})
 
-    ui.run(host="0.0.0.0", port=8000, reload=False)
-else:
-    print("Application terminated due to migration error")
+
+async def count_queries(request: Request, call_next):
+    """Query count per request for sql_stats; NiceGUI's own static assets are left out."""
+    if request.url.path.startswith("/_nicegui"):
+        return await call_next(request)
+    with query_scope(UNMATCHED_SCOPE) as scope:
+        response = await call_next(request)
+        route = request.scope.get("route")
+        # A route is also set for a method it does not allow, and clients can send any method name.
+        if route is not None and request.method in (getattr(route, "methods", None) or _HTTP_METHODS):
+            # Group by route template rather than by every concrete id in the path.
+            scope.name = f"{request.method} {route.path}"
+        return response
+
+
+def main() -> None:
+    if bootstrap_database():
+        from frontend.pages import dashboard, keys, login, profile, register, subscriptions, checkout  # noqa: F401
+
+        app.on_shutdown(login_activity.shutdown)
+        app.on_shutdown(user_index.shutdown)
+        app.on_shutdown(backup_scheduler.shutdown)
+        backup_scheduler.start()
+        app.middleware("http")(count_queries)
+        ui.run(host="0.0.0.0", port=8000, reload=False, storage_secret=storage_secret())
+    else:
+        print("Application terminated due to migration error")
+
+
+# Crypto and hashing pools spawn worker processes that re-import this module; only boot in the parent.
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+from datetime import datetime
+
+from sqlalchemy.exc import OperationalError
+
+from backend import login_activity as login_activity_module
+from backend.login_activity import LoginActivityBuffer
+
+WHEN = datetime(2026, 1, 1, 12, 0)
+
+
+class _Writer:
+    def __init__(self, buffer, fail=False):
+        self.buffer = buffer
+        self.fail = fail
+        self.seen = None
+
+    def run(self, op, rows):
+        self.seen = self.buffer.last_login(1)
+        if self.fail:
+            raise OperationalError("UPDATE users", {}, Exception("database is locked"))
+
+
+def test_batch_stays_readable_until_committed(monkeypatch):
+    buffer = LoginActivityBuffer(flush_interval=60)
+    fake = _Writer(buffer)
+    monkeypatch.setattr(login_activity_module, "writer", fake)
+    buffer._pending[1] = WHEN
+
+    assert buffer.flush() == 1
+    assert fake.seen == WHEN
+    assert buffer.last_login(1) is None
+
+
+def test_failed_batch_is_put_back(monkeypatch):
+    buffer = LoginActivityBuffer(flush_interval=60)
+    monkeypatch.setattr(login_activity_module, "writer", _Writer(buffer, fail=True))
+    buffer._pending[1] = WHEN
+
+    assert buffer.flush() == 0
+    assert buffer.last_login(1) == WHEN
+    assert buffer.stats()["pending"] == 1
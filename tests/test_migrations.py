@@ -0,0 +1,34 @@
+import pytest
+
+from backend.db import create_engines
+from backend.migrations import available_migrations, migrate
+from backend.shards import SHARDED_TABLES
+
+
+@pytest.fixture
+def engine(tmp_path):
+    write, read, async_read = create_engines(tmp_path / "shard.db", foreign_keys="OFF")
+    yield write
+    write.dispose()
+    read.dispose()
+    async_read.sync_engine.dispose()
+
+
+def _names(connection, kind):
+    rows = connection.exec_driver_sql(f"SELECT name FROM sqlite_master WHERE type = '{kind}' AND name NOT LIKE 'sqlite_%'")
+    return {row[0] for row in rows}
+
+
+def test_shard_gets_only_its_tables_and_every_version(engine):
+    migrate(bind=engine, tables=[table.name for table in SHARDED_TABLES])
+    with engine.connect() as connection:
+        assert _names(connection, "table") == {"credentials", "keys", "schema_version"}
+        assert {"ix_credentials_user_archived_created", "ix_keys_user_created"} <= _names(connection, "index")
+        versions = connection.exec_driver_sql("SELECT version FROM schema_version WHERE applied_at IS NOT NULL")
+        assert [row[0] for row in versions] == [version for version, _, _ in available_migrations()]
+
+
+def test_migrated_shard_is_not_migrated_again(engine):
+    tables = [table.name for table in SHARDED_TABLES]
+    migrate(bind=engine, tables=tables)
+    assert migrate(bind=engine, tables=tables) == []
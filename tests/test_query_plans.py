@@ -0,0 +1,80 @@
+"""Query plans of the per-request queries.
+
+Every query in QUERIES comes from the service's own builder and runs through
+EXPLAIN QUERY PLAN on a fresh database built by the migrations. A plan that
+scans a whole table or sorts in a temp B-tree fails: that is how a missing or
+mismatched index shows up long before a table is big enough for anyone to notice.
+The database is empty and never analyzed, so the plans follow from the schema alone.
+"""
+from datetime import datetime
+from typing import Callable, List, Tuple
+
+import pytest
+from sqlalchemy import bindparam, text
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql import Executable
+
+from backend import auth, credentials, data_keys, keys, sessions
+from backend.db import create_engines
+from backend.migrations import migrate
+from backend.models import UserSession
+
+_USER_ID = 1
+_NAMED = sqlite.dialect(paramstyle="named")
+_TICKET = {"user_id": _USER_ID, "otp_secret": "secret"}
+
+QUERIES: List[Tuple[str, Callable[[], Executable]]] = [
+    ("credentials.list", lambda: credentials._active_credentials(_USER_ID)),
+    ("credentials.get", lambda: credentials._one_credential(_USER_ID, 1)),
+    ("credentials.reveal", lambda: credentials._secret_query(_USER_ID, 1, "password")),
+    ("credentials.title_taken", lambda: credentials._title_query(_USER_ID, "title")),
+    ("credentials.title_taken_by_other", lambda: credentials._title_query(_USER_ID, "title", exclude_id=1)),
+    ("keys.list", lambda: keys._user_keys(_USER_ID)),
+    ("keys.get", lambda: keys._one_key(_USER_ID, 1)),
+    ("users.get", lambda: auth._user_query(_USER_ID)),
+    ("users.by_username", lambda: auth._username_query("user")),
+    ("users.taken", lambda: auth._taken_query([("username", "user"), ("email", "user@example.com")])),
+    ("users.ticket_secret", lambda: auth._ticket_secret_query(_TICKET)),
+    ("data_keys.get", lambda: data_keys._wrapped_key_query(_USER_ID)),
+    ("sessions.resolve", lambda: sessions._session_query("session")),
+    ("sessions.revoked_since", lambda: sessions._REVOCATIONS_QUERY.bindparams(since=datetime.utcnow())),
+    ("sessions.revoke_user", lambda: sessions._revoke_statement(UserSession.user_id == _USER_ID)),
+]
+
+
+def explain(connection: Connection, statement: Executable) -> List[str]:
+    """The detail column of EXPLAIN QUERY PLAN, one line per plan step."""
+    compiled = statement.compile(dialect=_NAMED)
+    query = text(f"EXPLAIN QUERY PLAN {compiled}").bindparams(
+        *(bindparam(name, type_=compiled.binds[name].type) for name in compiled.params)
+    )
+    return [row[3] for row in connection.execute(query, compiled.params)]
+
+
+def plan_problems(plan: List[str]) -> List[str]:
+    return [step for step in plan if step.startswith("SCAN ") or "USE TEMP B-TREE" in step]
+
+
+@pytest.fixture(scope="module")
+def connection(tmp_path_factory):
+    write, read, async_read = create_engines(tmp_path_factory.mktemp("plans") / "app.db")
+    migrate(bind=write)
+    try:
+        with read.connect() as connection:
+            yield connection
+    finally:
+        write.dispose()
+        read.dispose()
+        async_read.sync_engine.dispose()
+
+
+def test_migrations_build_the_schema(connection):
+    tables = {row[0] for row in connection.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert {"users", "credentials", "keys", "user_data_keys", "user_sessions", "schema_version"} <= tables
+
+
+@pytest.mark.parametrize("build", [build for _, build in QUERIES], ids=[name for name, _ in QUERIES])
+def test_query_plan_uses_an_index(connection, build):
+    plan = explain(connection, build())
+    assert not plan_problems(plan), "\n".join(plan)
@@ -0,0 +1,48 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from backend import security, sessions
+from backend.db import create_engines
+from backend.migrations import migrate
+from backend.models import User
+
+
+@pytest.fixture
+def isolated_keys(tmp_path, monkeypatch):
+    """Key files and the revocation poll on scratch paths, so nothing touches data/."""
+    monkeypatch.delenv(security.APP_FERNET_ENV, raising=False)
+    monkeypatch.delenv(sessions.STORAGE_SECRET_ENV, raising=False)
+    monkeypatch.setattr(security, "SECRET_DIR", tmp_path)
+    monkeypatch.setattr(security, "FERNET_KEY_PATH", tmp_path / "fernet.key")
+    monkeypatch.setattr(sessions, "SESSION_KEY_PATH", tmp_path / "session.key")
+    write, read, async_read = create_engines(tmp_path / "app.db")
+    migrate(bind=write)
+    monkeypatch.setattr(sessions, "read_engine", read)
+    security.keyring.invalidate()
+    yield
+    security.keyring.invalidate()
+    sessions._sessions.clear()
+    write.dispose()
+    read.dispose()
+    async_read.sync_engine.dispose()
+
+
+def test_session_survives_app_key_rotation(isolated_keys):
+    user = User(id=1, username="user", is_2fa_enabled=False, master_key=None)
+    token = sessions._started("session-id", user, datetime.utcnow() + timedelta(hours=1))
+    storage_secret = sessions.storage_secret()
+    app_key = security.keyring.primary_key()
+
+    security.add_primary_key()
+
+    assert security.keyring.primary_key() != app_key
+    assert sessions.resolve_session(token)["user_id"] == 1
+    assert sessions.storage_secret() == storage_secret
+
+
+def test_forged_token_is_rejected(isolated_keys):
+    user = User(id=1, username="user", is_2fa_enabled=False, master_key=None)
+    token = sessions._started("session-id", user, datetime.utcnow() + timedelta(hours=1))
+    session_id, _, _signature = token.rpartition(".")
+    assert sessions.resolve_session(security.sign_handle(session_id, bound_to="session")) is None
@@ -0,0 +1,42 @@
+from datetime import datetime
+
+from sqlalchemy import func, insert, select
+
+from backend.models import Credential, Key
+from backend.shards import delete_user_rows, open_storage
+
+
+def _add_rows(storage, user_id, title):
+    with storage.engine.begin() as connection:
+        connection.execute(insert(Credential), [{"user_id": user_id, "title": title, "login": "x", "password_encrypted": "x"}])
+        connection.execute(
+            insert(Key),
+            [{"user_id": user_id, "key_name": title, "key_value": f"{title}-{user_id}", "created_at": datetime.utcnow(), "is_active": True}],
+        )
+
+
+def _rows(storage, user_id):
+    with storage.engine.connect() as connection:
+        return [
+            connection.execute(select(func.count()).select_from(table).where(table.c.user_id == user_id)).scalar()
+            for table in (Credential.__table__, Key.__table__)
+        ]
+
+
+def test_delete_user_rows_cleans_every_storage(tmp_path):
+    # The user's current shard and a stale copy left by an interrupted rebalance.
+    current = open_storage(tmp_path / "shard-000.db")
+    stale = open_storage(tmp_path / "shard-001.db")
+    try:
+        _add_rows(current, 1, "mail")
+        _add_rows(stale, 1, "bank")
+        _add_rows(stale, 2, "bank")
+
+        assert delete_user_rows(1, [current, stale]) == {"credentials": 2, "keys": 2}
+        assert _rows(current, 1) == [0, 0]
+        assert _rows(stale, 1) == [0, 0]
+        assert _rows(stale, 2) == [1, 1]
+    finally:
+        for storage in (current, stale):
+            storage.writer.shutdown()
+            storage.engine.dispose()
@@ -0,0 +1,51 @@
+import time
+
+import pytest
+from sqlalchemy import insert
+
+from backend import user_index as user_index_module
+from backend.db import create_engines
+from backend.migrations import migrate
+from backend.models import User
+from backend.user_index import STALE_AFTER, UserIndex
+
+
+class _NoDatabase:
+    def connect(self):
+        raise AssertionError("definitely_missing() must not query the database")
+
+
+@pytest.fixture
+def engine(tmp_path):
+    write, read, async_read = create_engines(tmp_path / "app.db")
+    migrate(bind=write)
+    with write.begin() as connection:
+        connection.execute(insert(User), [{"username": "alice", "password_hash": "x", "email": "alice@example.com"}])
+    yield write
+    write.dispose()
+    read.dispose()
+    async_read.sync_engine.dispose()
+
+
+def test_unloaded_index_asks_the_database(monkeypatch):
+    monkeypatch.setattr(user_index_module, "engine", _NoDatabase())
+    assert not UserIndex().definitely_missing("username", "nobody")
+
+
+def test_lookups_stay_in_memory(engine, monkeypatch):
+    monkeypatch.setattr(user_index_module, "engine", engine)
+    index = UserIndex()
+    index.sync(force=True)
+    monkeypatch.setattr(user_index_module, "engine", _NoDatabase())
+
+    assert index.definitely_missing("username", "nobody")
+    assert not index.definitely_missing("username", "alice")
+    assert not index.definitely_missing("email", "alice@example.com")
+
+
+def test_stale_index_asks_the_database(engine, monkeypatch):
+    monkeypatch.setattr(user_index_module, "engine", engine)
+    index = UserIndex()
+    index.sync(force=True)
+    index._synced_at = time.monotonic() - STALE_AFTER - 1
+    assert not index.definitely_missing("username", "nobody")